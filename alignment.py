@@ -0,0 +1,153 @@
+"""
+    Optimal (maximum weight) alignment between gold and system mentions.
+
+    The scorer aligns mentions greedily by default, which is fast but may not give the highest possible overlap score
+    when a system mention overlaps with several gold mentions. Here we solve the assignment problem exactly with the
+    Hungarian algorithm. The overlap graph is usually very sparse, so we split it into connected components and only
+    solve the (small) dense problem for each component.
+"""
+
+import logging
+
+from utils import DisjointSet
+
+logger = logging.getLogger(__name__)
+
+
+def find_components(edges):
+    """
+    Split the bipartite overlap graph into connected components.
+    :param edges: List of (gold_index, system_index, score) tuples.
+    :return: List of components, each one is a list of edges.
+    """
+    disjoint_set = DisjointSet()
+    for gold_index, system_index, _ in edges:
+        disjoint_set.add(("g", gold_index), ("s", system_index))
+
+    edges_by_leader = {}
+    for edge in edges:
+        leader = disjoint_set.leader[("g", edge[0])]
+        try:
+            edges_by_leader[leader].append(edge)
+        except KeyError:
+            edges_by_leader[leader] = [edge]
+
+    return edges_by_leader.values()
+
+
+def hungarian(cost):
+    """
+    Solve the minimum cost assignment problem with the Hungarian algorithm (the potential based O(n^2 m) variant).
+    :param cost: A n by m cost matrix, where n <= m.
+    :return: A list of length n, the i-th element is the column assigned to row i.
+    """
+    n = len(cost)
+    m = len(cost[0])
+    inf = float('inf')
+
+    u = [0.0] * (n + 1)
+    v = [0.0] * (m + 1)
+    # p[j] is the row (1-based) assigned to column j, column 0 is a virtual column.
+    p = [0] * (m + 1)
+    way = [0] * (m + 1)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        min_v = [inf] * (m + 1)
+        used = [False] * (m + 1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = inf
+            j1 = 0
+            row = cost[i0 - 1]
+            for j in range(1, m + 1):
+                if not used[j]:
+                    cur = row[j - 1] - u[i0] - v[j]
+                    if cur < min_v[j]:
+                        min_v[j] = cur
+                        way[j] = j0
+                    if min_v[j] < delta:
+                        delta = min_v[j]
+                        j1 = j
+            for j in range(m + 1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_v[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while True:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+            if j0 == 0:
+                break
+
+    assignment = [-1] * n
+    for j in range(1, m + 1):
+        if p[j] != 0:
+            assignment[p[j] - 1] = j - 1
+    return assignment
+
+
+def solve_component(edges):
+    """
+    Find the maximum weight matching in one connected component.
+    :param edges: List of (gold_index, system_index, score) tuples.
+    :return: The matched edges.
+    """
+    if len(edges) == 1:
+        return edges
+
+    gold_ids = sorted(set(e[0] for e in edges))
+    system_ids = sorted(set(e[1] for e in edges))
+
+    # Hungarian algorithm requires rows to be no more than the columns.
+    transposed = len(gold_ids) > len(system_ids)
+    rows, columns = (system_ids, gold_ids) if transposed else (gold_ids, system_ids)
+
+    row_index = dict((r, i) for i, r in enumerate(rows))
+    column_index = dict((c, i) for i, c in enumerate(columns))
+
+    weights = [[0.0] * len(columns) for _ in rows]
+    for gold_index, system_index, score in edges:
+        if transposed:
+            weights[row_index[system_index]][column_index[gold_index]] = score
+        else:
+            weights[row_index[gold_index]][column_index[system_index]] = score
+
+    # Maximize the weights by minimizing the negative.
+    assignment = hungarian([[-w for w in row] for row in weights])
+
+    matched = []
+    for r, c in enumerate(assignment):
+        score = weights[r][c]
+        # Zero weight means these two are not connected, this is just padding from the dense matrix.
+        if c >= 0 and score > 0:
+            if transposed:
+                matched.append((columns[c], rows[r], score))
+            else:
+                matched.append((rows[r], columns[c], score))
+    return matched
+
+
+def get_optimal_mapping(edges, num_gold):
+    """
+    Compute the maximum weight one to one mapping between gold and system mentions.
+    :param edges: List of (gold_index, system_index, score) tuples, only positive scores are needed.
+    :param num_gold: Number of gold mentions.
+    :return: The total score and the gold to (system index, score) mapping, where unmapped gold get (-1, 0).
+    """
+    total_score = 0.0
+    mapping = [(-1, 0)] * num_gold
+
+    for component in find_components(edges):
+        for gold_index, system_index, score in solve_component(component):
+            mapping[gold_index] = (system_index, score)
+            total_score += score
+
+    return total_score, mapping
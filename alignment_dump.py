@@ -0,0 +1,164 @@
+"""
+    Columnar dump of the gold and system mention alignments.
+
+    The comparison output (-d) is meant to be read by human, this dump store every alignment (including the unmapped
+    ones) of every attribute combination as columns in a NumPy .npz file, so that large scale analysis can load them
+    directly:
+
+        alignments = numpy.load("alignments.npz")
+        wrong_types = alignments["combination"] == "mention_type"
+"""
+
+import logging
+
+from config import Config, EvalMethod
+
+logger = logging.getLogger(__name__)
+
+
+def import_numpy():
+    """
+    NumPy is only imported when the dump is requested, loading it takes longer than the rest of the scorer.
+    :return: The numpy module, or None if it is not installed.
+    """
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+
+def spans_to_string(spans, eval_mode):
+    """
+    Convert the parsed span back to the TBF form. Characters are merged into ranges, such as "4,8;13,16", while
+    token ids are joined by comma.
+    :param spans: The characters or token ids.
+    :param eval_mode: The evaluation method, which decides how the spans are parsed.
+    :return:
+    """
+    if eval_mode == EvalMethod.Token:
+        return Config.token_joiner.join(spans)
+
+    ranges = []
+    for c in sorted(spans):
+        if ranges and ranges[-1][1] == c:
+            ranges[-1][1] = c + 1
+        else:
+            ranges.append([c, c + 1])
+    return Config.span_seperator.join("%d%s%d" % (b, Config.span_joiner, e) for b, e in ranges)
+
+
+def span_boundary(spans, eval_mode):
+    """
+    The character boundary of the span, token based span does not have one.
+    :param spans: The characters or token ids.
+    :param eval_mode: The evaluation method, which decides how the spans are parsed.
+    :return: Begin and end of the span, or (-1, -1) if not available.
+    """
+    if eval_mode == EvalMethod.Token or len(spans) == 0:
+        return -1, -1
+    return min(spans), max(spans) + 1
+
+
+class AlignmentDump:
+    """
+    Accumulate the alignments as columns, and save them in one .npz file.
+    """
+
+    def __init__(self, eval_mode=EvalMethod.Char):
+        self.eval_mode = eval_mode
+        self.columns = {}
+        for name in AlignmentDump.column_names():
+            self.columns[name] = []
+
+    @staticmethod
+    def column_names():
+        names = ["run_id", "doc_id", "combination", "score"]
+        for side in ["gold", "system"]:
+            names.extend("%s_%s" % (side, field) for field in ["index", "mention_id", "span", "begin", "end", "text"])
+            names.extend("%s_%s" % (side, attribute) for attribute in Config.attribute_names)
+        return names
+
+    @staticmethod
+    def is_available():
+        return import_numpy() is not None
+
+    def add_mention(self, side, mention_index, mention_table):
+        if mention_index < 0:
+            self.columns[side + "_index"].append(-1)
+            self.columns[side + "_mention_id"].append("")
+            self.columns[side + "_span"].append("")
+            self.columns[side + "_begin"].append(-1)
+            self.columns[side + "_end"].append(-1)
+            self.columns[side + "_text"].append("")
+            for attribute in Config.attribute_names:
+                self.columns["%s_%s" % (side, attribute)].append("")
+            return
+
+        spans, attributes, mention_id, original_spans, text = mention_table[mention_index]
+        begin, end = span_boundary(spans, self.eval_mode)
+
+        self.columns[side + "_index"].append(mention_index)
+        self.columns[side + "_mention_id"].append(mention_id)
+        self.columns[side + "_span"].append(spans_to_string(original_spans, self.eval_mode))
+        self.columns[side + "_begin"].append(begin)
+        self.columns[side + "_end"].append(end)
+        self.columns[side + "_text"].append(text)
+        for attribute_index, attribute in enumerate(Config.attribute_names):
+            self.columns["%s_%s" % (side, attribute)].append(attributes[attribute_index])
+
+    def add_row(self, run_id, doc_id, combination, gold_index, system_index, score, gold_table, system_table):
+        self.columns["run_id"].append(run_id)
+        self.columns["doc_id"].append(doc_id)
+        self.columns["combination"].append(combination)
+        self.columns["score"].append(score)
+        self.add_mention("gold", gold_index, gold_table)
+        self.add_mention("system", system_index, system_table)
+
+    def add_mapping(self, run_id, doc_id, combination, gold_2_system_mapping, gold_table, system_table):
+        """
+        Add all the alignments of one mapping, the unmapped gold and system mentions are also added with -1 as the
+        index of the other side.
+        """
+        mapped_system_mentions = set()
+        for gold_index, (system_index, score) in enumerate(gold_2_system_mapping):
+            if system_index >= 0:
+                mapped_system_mentions.add(system_index)
+            else:
+                score = 0
+            self.add_row(run_id, doc_id, combination, gold_index, system_index, score, gold_table, system_table)
+
+        for system_index in xrange(len(system_table)):
+            if system_index not in mapped_system_mentions:
+                self.add_row(run_id, doc_id, combination, -1, system_index, 0, gold_table, system_table)
+
+    def add_document(self, run_id, doc_id, mention_only_mapping, all_attribute_mapping, all_attribute_combinations,
+                     gold_table, system_table):
+        """
+        Add the span only mapping and the mappings of every attribute combination of one document.
+        """
+        self.add_mapping(run_id, doc_id, "plain", mention_only_mapping, gold_table, system_table)
+        for comb, mapping in zip(all_attribute_combinations, all_attribute_mapping):
+            combination = "+".join(attr_pair[1] for attr_pair in comb)
+            self.add_mapping(run_id, doc_id, combination, mapping, gold_table, system_table)
+
+    def restore(self, columns):
+        """
+        Restore the columns saved in a checkpoint, the strings are read back as unicode, which are stored as UTF-8
+        here in the same way as the strings read from the files.
+        """
+        for name, values in columns.iteritems():
+            self.columns[name] = [v.encode("utf-8") if isinstance(v, unicode) else v for v in values]
+
+    def save(self, path):
+        numpy = import_numpy()
+        arrays = {}
+        for name, values in self.columns.iteritems():
+            if name == "score":
+                arrays[name] = numpy.array(values, dtype=numpy.float64)
+            elif name.endswith("_index") or name.endswith("_begin") or name.endswith("_end"):
+                arrays[name] = numpy.array(values, dtype=numpy.int64)
+            else:
+                arrays[name] = numpy.array(values)
+        numpy.savez_compressed(path, **arrays)
+        logger.info("Saved %d alignments to %s" % (len(self.columns["doc_id"]), path))
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+
+"""
+    Score all the submissions of an evaluation campaign, in place of bin/eval_kbp_2017.sh.
+
+    The submissions are discovered under the submission directory, in the same layout as the splitted TAC KBP
+    submissions, one directory per task and language, such as event-nugget-splitted/eng. Each submission file is
+    scored by the scorer as a separate job, the jobs run on a bounded pool of workers. The results of each job are
+    written to <result dir>/<task>/<language>/<submission>, together with the scorer command. Jobs whose results are
+    newer than their inputs and produced by the same command are skipped, and interrupted jobs are resumed from the
+    checkpoint of the scorer. A summary table of all submissions is written at the end.
+"""
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+import utils
+
+logger = logging.getLogger()
+
+scorer_executable = os.path.join(os.path.dirname(os.path.realpath(__file__)), "scorer_v1.8.py")
+
+# The submission directory of each task, and the scorer arguments specific to the task, relative to the job result
+# directory.
+task_dirs = [
+    ("nugget", "event-nugget-splitted", []),
+    ("coreference", "event-coref-splitted", [("-c", "coref.out")]),
+    ("sequencing", "event-sequencing-splitted", [("-a", "sequencing")]),
+]
+
+score_output = "eval.scores"
+json_output = "eval.json"
+diff_output = "gold_sys_diff"
+checkpoint_output = "checkpoint"
+command_output = "command.json"
+scorer_log = "scorer.log"
+
+summary_mention_scores = ["plain", "mention_type", "realis_status", "mention_type+realis_status"]
+summary_link_types = ["After", "Subevent"]
+
+
+class Job:
+    """
+    Scoring of one submission file of one task and language.
+    """
+
+    def __init__(self, task, language, system_name, system_file, gold_file, result_dir, task_args):
+        self.task = task
+        self.language = language
+        self.system_name = system_name
+        self.system_file = system_file
+        self.gold_file = gold_file
+        self.result_dir = result_dir
+        self.task_args = task_args
+
+    def output_path(self, name):
+        return os.path.join(self.result_dir, name)
+
+    def is_up_to_date(self, scorer_args):
+        """
+        The job is up to date if both outputs are produced by the same command, they are newer than the inputs and the
+        command, and the job is not interrupted. The command is saved before the scorer runs, so the outputs left by an
+        earlier command are older than it.
+        """
+        if os.path.exists(self.output_path(checkpoint_output)):
+            return False
+
+        outputs = [self.output_path(score_output), self.output_path(json_output)]
+        if not all(os.path.isfile(p) for p in outputs):
+            return False
+
+        if self.read_command() != self.command(scorer_args):
+            return False
+
+        newest_input = max(os.path.getmtime(p) for p in [self.system_file, self.gold_file, scorer_executable,
+                                                          self.output_path(command_output)])
+        return min(os.path.getmtime(p) for p in outputs) >= newest_input
+
+    def read_command(self):
+        """
+        :return: The scorer command of the last run, or None if the job has not run.
+        """
+        path = self.output_path(command_output)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def write_command(self, command):
+        with open(self.output_path(command_output), 'w') as out:
+            json.dump(command, out)
+
+    def command(self, scorer_args):
+        cmd = [sys.executable, scorer_executable, "-g", self.gold_file, "-s", self.system_file,
+               "-o", self.output_path(score_output), "-jo", self.output_path(json_output),
+               "-d", self.output_path(diff_output), "-cp", self.output_path(checkpoint_output)]
+        for flag, name in self.task_args:
+            cmd.extend([flag, self.output_path(name)])
+        return cmd + scorer_args
+
+
+def find_submissions(task_dir):
+    """
+    Find all the submission files under the directory, each one is named by its file name.
+    :return: A list of (submission name, path), sorted by name.
+    """
+    submissions = {}
+    for root, dirs, files in os.walk(task_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            if f in submissions:
+                logger.warning("Submission [%s] is found more than once, only %s is scored." % (f, submissions[f]))
+                continue
+            submissions[f] = path
+    return sorted(submissions.items())
+
+
+def find_languages(submission_dir):
+    languages = set()
+    for _, task_dir, _ in task_dirs:
+        path = os.path.join(submission_dir, task_dir)
+        if os.path.isdir(path):
+            languages.update(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+    return sorted(languages)
+
+
+def create_jobs(submission_dir, result_dir, gold_pattern, languages, tasks):
+    """
+    Create one job for each submission file of each task and language.
+    :param gold_pattern: Path of the gold standard, where {language} is replaced by the language.
+    :return: All jobs, ordered by language, task and submission name.
+    """
+    jobs = []
+    for language in languages:
+        gold_file = gold_pattern.format(language=language)
+        if not os.path.isfile(gold_file):
+            logger.error("Cannot find gold standard for language [%s] at %s, its submissions are not scored." % (
+                language, gold_file))
+            continue
+
+        for task, task_dir, task_args in task_dirs:
+            if task not in tasks:
+                continue
+            language_dir = os.path.join(submission_dir, task_dir, language)
+            if not os.path.isdir(language_dir):
+                logger.info("No %s submission found for language [%s]." % (task, language))
+                continue
+            for system_name, system_file in find_submissions(language_dir):
+                jobs.append(Job(task, language, system_name, system_file, gold_file,
+                                os.path.join(result_dir, task, language, system_name), task_args))
+    return jobs
+
+
+def run_job(job_and_args):
+    """
+    Run the scorer of one job, the output of the scorer is kept in the log of the job.
+    :return: The exit status of the scorer.
+    """
+    job, scorer_args = job_and_args
+    utils.supermakedirs(job.result_dir)
+    logger.info("Evaluating %s for %s [%s], writing results to %s" % (job.system_file, job.task, job.language,
+                                                                      job.result_dir))
+
+    command = job.command(scorer_args)
+    checkpoint = job.output_path(checkpoint_output)
+    if os.path.exists(checkpoint) and job.read_command() != command:
+        logger.info("The checkpoint at %s is created by another scorer command, the job is scored from the start." %
+                    checkpoint)
+        os.remove(checkpoint)
+    job.write_command(command)
+
+    with open(job.output_path(scorer_log), 'w') as log:
+        status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+    if status != 0:
+        logger.error("Scorer failed with status %d on %s, see %s" % (status, job.system_file,
+                                                                     job.output_path(scorer_log)))
+    return status
+
+
+def get_summary_row(job, status):
+    """
+    Read the main scores of a job from its JSON results, the scores not evaluated are left empty, as well as the
+    scores of a failed job, which may be left by an earlier run.
+    """
+    row = [job.language, job.task, job.system_name, status]
+
+    results = {}
+    if not status.startswith("failed") and os.path.isfile(job.output_path(json_output)):
+        with open(job.output_path(json_output)) as f:
+            results = json.load(f)
+
+    def score(value):
+        return "" if value is None else "%.2f" % value
+
+    micro = results.get("micro_average", {})
+    row.extend(score(micro[name]["f1"]) if name in micro else "" for name in summary_mention_scores)
+    row.append(score(results["coreference"]["conll_average"]) if "coreference" in results else "")
+    sequencing = results.get("sequencing", {})
+    row.extend(score(sequencing[t]["f1"]) if t in sequencing else "" for t in summary_link_types)
+    return row
+
+
+def write_summary(summary_path, jobs, statuses):
+    header = ["Language", "Task", "System", "Status"] + ["%s F1" % name for name in summary_mention_scores] + [
+        "CoNLL Average"] + ["%s F1" % t for t in summary_link_types]
+    utils.create_parent_dir(summary_path)
+    with open(summary_path, 'w') as out:
+        out.write("\t".join(header) + "\n")
+        for job, status in zip(jobs, statuses):
+            out.write("\t".join(str(x) for x in get_summary_row(job, status)) + "\n")
+    logger.info("Summary of %d submissions written to %s" % (len(jobs), summary_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Score all the submissions of an evaluation campaign, the submissions are found by task and "
+                    "language under the submission directory.")
+    parser.add_argument(
+        "-g", "--gold", required=True,
+        help="The gold standard file or evaluation pack, {language} in the path is replaced by each language, such as "
+             "gold/{language}.tbf")
+    parser.add_argument("-s", "--submission_dir", required=True, help="The directory containing the submissions")
+    parser.add_argument("-r", "--result_dir", required=True, help="Directory for the results")
+    parser.add_argument(
+        "-l", "--languages", nargs="+",
+        help="The language sub directories to be scored, all the languages found are scored by default.")
+    parser.add_argument(
+        "-ta", "--tasks", nargs="+", choices=[t for t, _, _ in task_dirs], default=[t for t, _, _ in task_dirs],
+        help="The tasks to be scored, all tasks by default.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of scorer processes running in parallel, default is 1.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Score all the submissions again, even if the results are up to date. The results are "
+                             "already out of date if the scorer arguments change.")
+    parser.add_argument("-so", "--summary_output",
+                        help="Path of the summary table, default is summary.tsv under the result directory.")
+    parser.add_argument(
+        "-sc", "--scorer_args", nargs=argparse.REMAINDER, default=[],
+        help="All the remaining arguments are passed to the scorer, such as the token path (-t) or the type white "
+             "list (-wl).")
+    parser.add_argument("-b", "--debug", help="turn debug mode on", action="store_true")
+
+    args = parser.parse_args()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s : %(message)s'))
+    logger.addHandler(stream_handler)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    if not os.path.isdir(args.submission_dir):
+        utils.terminate_with_error("Cannot find submission directory at " + args.submission_dir)
+    if args.jobs < 1:
+        utils.terminate_with_error("Number of jobs should be positive.")
+
+    languages = args.languages if args.languages is not None else find_languages(args.submission_dir)
+    logger.info("Languages to be scored: %s" % ", ".join(languages))
+
+    jobs = create_jobs(args.submission_dir, args.result_dir, args.gold, languages, args.tasks)
+
+    statuses = ["up to date"] * len(jobs)
+    pending = [index for index, job in enumerate(jobs) if args.force or not job.is_up_to_date(args.scorer_args)]
+    logger.info("Found %d submissions, %d of them are up to date." % (len(jobs), len(jobs) - len(pending)))
+
+    pool = ThreadPool(args.jobs)
+    for index, status in zip(pending, pool.map(run_job, [(jobs[index], args.scorer_args) for index in pending])):
+        statuses[index] = "done" if status == 0 else "failed (%d)" % status
+    pool.close()
+    pool.join()
+
+    summary_path = args.summary_output
+    if summary_path is None:
+        summary_path = os.path.join(args.result_dir, "summary.tsv")
+    write_summary(summary_path, jobs, statuses)
+
+    num_failed = sum(1 for s in statuses if s.startswith("failed"))
+    if num_failed > 0:
+        logger.error("%d submissions failed." % num_failed)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
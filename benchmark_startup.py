@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+"""
+    Measure the start-up time of the scorer and the validator.
+
+    Each command is run repeatedly in a new interpreter on the scoring demo data, as the evaluation scripts call them, so
+    that the time is dominated by loading the modules and parsing the arguments. The outputs are written to a temporary
+    directory, which is removed at the end.
+
+        ./benchmark_startup.py -n 20
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import utils
+
+logger = logging.getLogger()
+
+base_dir = os.path.dirname(os.path.realpath(__file__))
+scorer_executable = os.path.join(base_dir, "scorer_v1.8.py")
+validator_executable = os.path.join(base_dir, "validator.py")
+char_dir = os.path.join(base_dir, "data", "scoring_demo", "char_based")
+token_dir = os.path.join(base_dir, "data", "scoring_demo", "token_based")
+
+
+def get_commands(out_dir):
+    """
+    The commands to be measured, from the cheapest to the most expensive.
+    :param out_dir: Directory for the outputs of the commands.
+    :return: A list of (name, command).
+    """
+    char_gold = os.path.join(char_dir, "gold.tbf")
+    char_system = os.path.join(char_dir, "system_A.tbf")
+    token_gold = os.path.join(token_dir, "gold.tbf")
+    token_system = os.path.join(token_dir, "sample_system_C.tbf")
+    token_path = os.path.join(token_dir, "tkn")
+
+    return [
+        ("scorer help", [scorer_executable, "-h"]),
+        ("scorer mentions (char)", [scorer_executable, "-g", char_gold, "-s", char_system,
+                                    "-o", os.path.join(out_dir, "char.scores")]),
+        ("scorer mentions (token)", [scorer_executable, "-g", token_gold, "-s", token_system, "-t", token_path,
+                                     "-o", os.path.join(out_dir, "token.scores")]),
+        ("scorer sequencing", [scorer_executable, "-g", char_gold, "-s", os.path.join(char_dir, "temporal_sample.tbf"),
+                               "-o", os.path.join(out_dir, "temporal.scores"),
+                               "-a", os.path.join(out_dir, "temporal")]),
+        ("validator help", [validator_executable, "-h"]),
+        ("validator (token)", [validator_executable, "-s", os.path.join(token_dir, "sample_system_A.tbf"), "-tm",
+                               "-t", token_path]),
+    ]
+
+
+def time_command(command, repeat, out_dir):
+    """
+    Run the command repeatedly and measure the wall clock time of each run.
+    :return: The times in seconds, or None if the command fails.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            # The validator writes its error log to the working directory.
+            status = subprocess.call([sys.executable] + command, cwd=out_dir, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+            if status != 0:
+                logger.error("Command failed with status %d: %s" % (status, " ".join(command)))
+                return None
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the start-up time of the scorer and the validator.")
+    parser.add_argument("-n", "--repeat", type=int, default=10, help="Number of runs of each command, default is 10.")
+    parser.add_argument("-b", "--debug", help="turn debug mode on", action="store_true")
+
+    args = parser.parse_args()
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s : %(message)s'))
+    logger.addHandler(stream_handler)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    if args.repeat < 1:
+        utils.terminate_with_error("Number of runs should be positive.")
+
+    out_dir = tempfile.mkdtemp(prefix="startup_benchmark")
+    try:
+        print "%-26s%10s%10s%10s" % ("Command", "Min (ms)", "Median", "Mean")
+        for name, command in get_commands(out_dir):
+            logger.debug("Running %s" % " ".join(command))
+            times = time_command(command, args.repeat, out_dir)
+            if times is None:
+                print "%-26s%10s" % (name, "failed")
+                continue
+            times.sort()
+            print "%-26s%10.1f%10.1f%10.1f" % (name, times[0] * 1000, times[len(times) / 2] * 1000,
+                                              sum(times) / len(times) * 1000)
+    finally:
+        shutil.rmtree(out_dir)
+
+
+if __name__ == "__main__":
+    main()
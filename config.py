@@ -4,7 +4,8 @@ import os
 class Config:
     """
     Hold configuration variable for evaluation. These variables
-    should not be changed during evaluation.
+    should not be changed during evaluation, the settings of one
+    evaluation are set on the Config instance of its EvalContext.
     """
 
     def __init__(self):
@@ -28,6 +29,9 @@ class Config:
 
     missing_attribute_place_holder = "NOT_ANNOTATED"
 
+    # The first line of an evaluation pack compiled by gold_pack.py, followed by the format version.
+    pack_magic = "#TBFPack"
+
     default_token_file_ext = ".tab"
     default_token_offset_fields = [2, 3]
 
@@ -51,6 +55,9 @@ class Config:
     relative_perl_script_path = "/reference-coreference-scorers-8.01/scorer.pl"
     conll_scorer_executable = os.path.dirname(os.path.realpath(__file__)) + relative_perl_script_path
 
+    # Metrics of the reference scorer, in the order they are scored when all metrics are used.
+    conll_metrics = ["muc", "bcub", "ceafm", "ceafe", "blanc"]
+
     skipped_metrics = {"ceafm"}
 
     zero_for_empty_metrics = {"muc"}
@@ -89,6 +96,18 @@ class Config:
 
     eval_cluster_level_links = False
 
+    # Indent the TimeML files, the files are only read by the TimeML evaluator, which does not need the indentation.
+    pretty_time_ml = True
+
+    # Name of the archive under the script result directory, when all the TimeML files are stored in one archive.
+    time_ml_archive_name = "time_ml.zip"
+
+    # Number of documents evaluated between two checkpoints.
+    default_checkpoint_interval = 100
+
+    # Greedy and optimal true positives that differ less than this are considered the same.
+    alignment_gap_tolerance = 1e-6
+
 
 class EvalMethod:
     """
@@ -105,8 +124,8 @@ class EvalMethod:
 class MutableConfig:
     """
     Some configuration that might be changed at setup. Default
-    values are set here. Do not modify these variables outside
-    the Main() function (i.e. outside the setup stage)
+    values are set here. Do not modify these variables, the setup
+    stage changes the MutableConfig instance of the EvalContext.
     """
 
     def __init__(self):
@@ -115,46 +134,89 @@ class MutableConfig:
     remove_conll_tmp = False
     eval_mode = EvalMethod.Char
     coref_mention_threshold = 1.0
+    # Metrics scored by parallel reference scorer processes, all metrics are scored by one process if not set.
+    parallel_conll_metrics = None
+    # Number of shards scored in parallel by the reference scorer, the documents are not sharded if 0.
+    num_conll_shards = 0
+    # Run the coreference and the sequencing evaluation concurrently.
+    pipelined = False
+    # Evaluate event sequencing, the TimeML files are kept in memory if there is no script result directory.
+    eval_sequencing = False
+    # Thresholds of the coreference sweep, coreference is scored in process for each of them.
+    coref_mention_thresholds = []
+    # Coreference mapping criteria of the sweep, each one is scored at all the thresholds.
+    coref_sweep_criteria = []
+    optimal_alignment = False
 
 
 class EvalState:
     """
-    Hold evaluation state variables.
+    Hold evaluation state variables, each evaluation has its own instance.
     """
 
     def __init__(self):
-        pass
+        self.gold_docs = {}
+        self.system_docs = {}
+        self.doc_ids_to_score = []
+        self.all_possible_types = set()
+        self.evaluating_index = 0
+
+        self.doc_mention_scores = []
+        # CoNLL average and the in-process metric scores of each document, only populated when coreference is
+        # evaluated.
+        self.doc_coref_scores = []
+        self.doc_coref_metrics = {}
+        # The in-process metric scores of each document, by the (mapping criteria name, threshold) of the coreference
+        # sweep.
+        self.coref_sweep_metrics = {}
+        self.overall_coref_scores = {}
+        self.overall_coref_details = {}
+        self.doc_coref_details = {}
 
-    gold_docs = {}
-    system_docs = {}
-    doc_ids_to_score = []
-    all_possible_types = set()
-    evaluating_index = 0
+        # Event sequencing scores by link type.
+        self.overall_seq_scores = {}
+        self.overall_seq_cluster_scores = {}
 
-    doc_mention_scores = []
-    doc_coref_scores = []
-    overall_coref_scores = {}
+        # Greedy and optimal true positives of each document, only populated when optimal alignment is used.
+        self.doc_alignment_gaps = []
 
-    per_type_tp = {}
-    per_type_num_response = {}
-    per_type_num_gold = {}
+        self.per_type_tp = {}
+        self.per_type_num_response = {}
+        self.per_type_num_gold = {}
 
-    use_new_conll_file = True
+        # Writes the CoNLL files of all documents, only used when coreference is evaluated.
+        self.conll_writer = None
 
-    system_id = "_id_"
+        # The archive of the TimeML files, only used when the TimeML files are archived, and the path or the in memory
+        # file of the archive.
+        self.time_ml_archive = None
+        self.time_ml_archive_file = None
 
-    white_listed_types = None
+        self.system_id = "_id_"
 
-    @staticmethod
-    def advance_index():
-        EvalState.evaluating_index += 1
+        self.white_listed_types = None
 
-    @staticmethod
-    def has_next_doc():
-        return EvalState.evaluating_index < len(EvalState.doc_ids_to_score)
+        # The precompiled gold standard, the gold documents are parsed mention tables and relations if it is used.
+        self.gold_pack = None
 
-    @staticmethod
-    def claim_write_flag():
-        r = EvalState.use_new_conll_file
-        EvalState.use_new_conll_file = False
-        return r
+        # What is saved up to the last checkpoint, the next checkpoint only contains what is added after it.
+        self.last_checkpoint_marks = None
+
+    def advance_index(self):
+        self.evaluating_index += 1
+
+    def has_next_doc(self):
+        return self.evaluating_index < len(self.doc_ids_to_score)
+
+
+class EvalContext:
+    """
+    The configuration and the state of one evaluation. The class attributes of Config and MutableConfig are the
+    defaults, the settings of one evaluation are set on its own instances, so that several evaluations can be run in
+    the same process.
+    """
+
+    def __init__(self):
+        self.config = Config()
+        self.mutable_config = MutableConfig()
+        self.state = EvalState()
@@ -1,12 +1,58 @@
 import logging
 import os
+import re
+import shutil
 import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
 
+import coref_metrics
 import utils
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+recall_precision_f1 = r"Recall: \((\S+) / (\S+)\) (\S+)%\tPrecision: \((\S+) / (\S+)\) (\S+)%\tF1: (\S+)%"
+
+# Matches the summary lines of the reference scorer, such as "Coreference: Recall: (1 / 2) 50%	Precision: ...".
+score_line_pattern = re.compile(r"^(.+?): " + recall_precision_f1)
+
+# Matches the document level lines of the reference scorer, which come after the document header.
+doc_score_line_pattern = re.compile(r"^" + recall_precision_f1)
+doc_header_pattern = re.compile(r"^\((.*)\); part \d+:$")
+
+# Runs the reference scorer library in the same way as its scorer.pl, and additionally prints the summed counts
+# returned by the library at full precision, so that the counts of several runs can be merged exactly.
+counts_script = """
+use CorScorer;
+my $metric = shift(@ARGV);
+my @metrics = $metric eq 'all' ? ('muc', 'bcub', 'ceafm', 'ceafe', 'blanc') : ($metric);
+foreach my $m (@metrics) {
+  print "\\nMETRIC $m:\\n" if ($metric eq 'all');
+  my @counts = CorScorer::Score($m, @ARGV);
+  print "COUNTS " . join(" ", map { sprintf("%.17g", $_) } @counts) . "\\n";
+}
+"""
+counts_marker = "COUNTS "
+
+totals_marker = "====== TOTALS ======="
+score_separator = "--------------------------------------------------------------------------"
+
+
+def parse_score_fields(fields):
+    """
+    Convert the matched recall, precision and F1 fields into a map.
+    """
+    return {
+        "recall_numerator": float(fields[0]),
+        "recall_denominator": float(fields[1]),
+        "recall": float(fields[2]),
+        "precision_numerator": float(fields[3]),
+        "precision_denominator": float(fields[4]),
+        "precision": float(fields[5]),
+        "f1": float(fields[6]),
+    }
+
 
 class ConllEvaluator:
     def __init__(self, doc_id, system_id, sys_id_2_text, gold_id_2_text):
@@ -23,21 +69,72 @@ class ConllEvaluator:
         self.gold_id_2_text = gold_id_2_text
 
     @staticmethod
-    def run_conll_script(gold_path, system_path, script_out):
+    def get_conll_command(metric, gold_path, system_path, with_counts=False):
+        if with_counts:
+            library_dir = os.path.join(os.path.dirname(Config.conll_scorer_executable), "lib")
+            return ["perl", "-I", library_dir, "-e", counts_script, metric, gold_path, system_path]
+        return ["perl", Config.conll_scorer_executable, metric, gold_path, system_path]
+
+    @staticmethod
+    def run_conll_script(gold_path, system_path, script_out, metrics=None, with_counts=False):
         """
         Run the Conll script and output result to the path given
         :param gold_path:
         :param system_path:
         :param script_out: Path to output the scores
+        :param metrics: If provided, only these metrics are scored, each by a separate scorer process running in
+        parallel. The outputs are combined in the given order, in the same format as scoring all metrics.
+        :param with_counts: Also output the full precision counts of each metric, used to merge the scores.
         :return:
         """
-        logger.info("Running reference CoNLL scorer.")
+        if metrics is None:
+            logger.info("Running reference CoNLL scorer.")
+            with open(script_out, 'wb', 0) as out_file:
+                subprocess.call(ConllEvaluator.get_conll_command("all", gold_path, system_path, with_counts),
+                                stdout=out_file)
+            logger.info("Done running CoNLL scorer.")
+            return
+
+        logger.info("Running reference CoNLL scorer on metrics [%s] in parallel." % ", ".join(metrics))
+        processes = []
+        for metric in metrics:
+            metric_out = tempfile.TemporaryFile()
+            processes.append((metric, metric_out, subprocess.Popen(
+                ConllEvaluator.get_conll_command(metric, gold_path, system_path, with_counts), stdout=metric_out)))
+
         with open(script_out, 'wb', 0) as out_file:
-            subprocess.call(
-                ["perl", Config.conll_scorer_executable, "all", gold_path, system_path],
-                stdout=out_file)
+            for metric, metric_out, process in processes:
+                process.wait()
+                # The header is only printed by the scorer when scoring all metrics.
+                out_file.write("\nMETRIC %s:\n" % metric)
+                metric_out.seek(0)
+                shutil.copyfileobj(metric_out, out_file)
+                metric_out.close()
         logger.info("Done running CoNLL scorer.")
 
+    @staticmethod
+    def run_sharded_conll_script(shard_paths, script_out, metrics=None):
+        """
+        Run the Conll script on each shard in parallel, and merge the outputs as if all the shards are scored at once.
+        :param shard_paths: The gold and system path of each shard.
+        :param script_out: Path to output the merged scores.
+        :param metrics: The metrics to be scored, see run_conll_script.
+        :return:
+        """
+        shard_outs = [get_shard_path(script_out, index) for index in range(len(shard_paths))]
+
+        logger.info("Scoring %d coreference shards in parallel." % len(shard_paths))
+        # The scoring is done by the scorer processes, threads are enough to wait for them.
+        pool = ThreadPool(len(shard_paths))
+        pool.map(run_shard, [(gold_path, system_path, shard_out, metrics) for (gold_path, system_path), shard_out in
+                             zip(shard_paths, shard_outs)])
+        pool.close()
+
+        merge_conll_outputs(shard_outs, script_out)
+
+        for shard_out in shard_outs:
+            os.remove(shard_out)
+
     @staticmethod
     def get_conll_scores(score_path):
         metric = "UNKNOWN"
@@ -54,6 +151,64 @@ class ConllEvaluator:
 
         return scores_by_metric
 
+    @staticmethod
+    def get_conll_score_details(score_path):
+        """
+        Read the total recall and precision counts of each metric from the reference scorer output.
+        :param score_path: The output of the reference scorer.
+        :return: A map from metric name to the scores of each summary line (such as "Coreference" and
+        "Identification of Mentions"), the scores are stored as a map with numerators, denominators and percentages.
+        """
+        metric = "UNKNOWN"
+        details_by_metric = {}
+
+        with open(score_path, 'r') as f:
+            for l in f:
+                if l.startswith("METRIC"):
+                    metric = l.split()[-1].strip().strip(":")
+                    details_by_metric[metric] = {}
+                    continue
+
+                match = score_line_pattern.match(l)
+                if match is None:
+                    continue
+
+                fields = match.groups()
+                details_by_metric.setdefault(metric, {})[fields[0]] = parse_score_fields(fields[1:])
+
+        return details_by_metric
+
+    @staticmethod
+    def get_conll_doc_details(score_path):
+        """
+        Read the document level recall and precision counts of each metric from the reference scorer output. Note that
+        the reference scorer does not report document level counts for BLANC.
+        :param score_path: The output of the reference scorer.
+        :return: A map from metric name to a map from document id to the scores.
+        """
+        metric = "UNKNOWN"
+        doc_id = None
+        details_by_metric = {}
+
+        with open(score_path, 'r') as f:
+            for l in f:
+                if l.startswith("METRIC"):
+                    metric = l.split()[-1].strip().strip(":")
+                    doc_id = None
+                    continue
+
+                header = doc_header_pattern.match(l.rstrip())
+                if header is not None:
+                    doc_id = header.group(1)
+                    continue
+
+                match = doc_score_line_pattern.match(l)
+                if match is not None and doc_id is not None:
+                    details_by_metric.setdefault(metric, {})[doc_id] = parse_score_fields(match.groups())
+                    doc_id = None
+
+        return details_by_metric
+
     @staticmethod
     def create_aligned_tables(gold_2_system_one_2_one_mapping, gold_mention_table, system_mention_table,
                               threshold=1.0):
@@ -77,7 +232,8 @@ class ConllEvaluator:
                 aligned_system_table.append(None)
                 continue
             system_index, alignment_score = system_aligned
-            if alignment_score >= threshold:
+            # Unmapped gold mentions are marked by a negative system index, which should not pass a zero threshold.
+            if system_index >= 0 and alignment_score >= threshold:
                 aligned_system_table.append(
                     (system_mention_table[system_index][0], system_mention_table[system_index][2]))
                 aligned_system_mentions.add(system_index)
@@ -117,33 +273,67 @@ class ConllEvaluator:
         :param threshold: To what extent we treat two mention can be aligned, default 1 for exact match
         :return:
         """
+        gold_coref_fields, sys_coref_fields = self.prepare_coref_fields(gold_corefs, sys_corefs, gold_mention_table,
+                                                                        system_mention_table,
+                                                                        gold_2_system_one_2_one_mapping, threshold)
+        return self.generate_lines(gold_coref_fields), self.generate_lines(sys_coref_fields)
+
+    def prepare_coref_fields(self, gold_corefs, sys_corefs, gold_mention_table, system_mention_table,
+                             gold_2_system_one_2_one_mapping, threshold=1.0):
+        """
+        Align the gold and system mentions, and find the cluster of each mention, one row per mention in the CoNLL
+        files. The arguments are the same as prepare_conll_lines.
+        :return: The (mention string, cluster id) of each row for gold and system, the cluster id is "-" if the row is
+        not a mention on that side.
+        """
         aligned_gold_table, aligned_system_table = self.create_aligned_tables(gold_2_system_one_2_one_mapping,
                                                                               gold_mention_table,
                                                                               system_mention_table,
                                                                               threshold)
         logger.debug("Preparing CoNLL files using mapping threhold %.2f" % threshold)
 
-        gold_conll_lines = self.prepare_lines(gold_corefs, aligned_gold_table, self.gold_id_2_text)
+        gold_coref_fields = self.prepare_fields(gold_corefs, aligned_gold_table, self.gold_id_2_text)
 
-        sys_conll_lines = self.prepare_lines(sys_corefs, aligned_system_table, self.sys_id_2_text)
+        sys_coref_fields = self.prepare_fields(sys_corefs, aligned_system_table, self.sys_id_2_text)
 
-        if not gold_conll_lines:
-            utils.terminate_with_error("Gold standard has data problem for doc [%s], please refer to log. Quitting..."
-                                       % self.doc_id)
+        if gold_coref_fields is None:
+            raise utils.ScoringError("Gold standard has data problem for doc [%s], please refer to log." % self.doc_id)
 
-        if not sys_conll_lines:
-            utils.terminate_with_error("System has data problem for doc [%s], please refer to log. Quitting..."
-                                       % self.doc_id)
+        if sys_coref_fields is None:
+            raise utils.ScoringError("System has data problem for doc [%s], please refer to log." % self.doc_id)
 
-        return gold_conll_lines, sys_conll_lines
+        return gold_coref_fields, sys_coref_fields
 
-    def prepare_lines(self, corefs, mention_table, id_2_text):
-        clusters = {}
+    @staticmethod
+    def get_mention_2_cluster(corefs):
+        """
+        Map each mention id to the index of its coreference cluster.
+        :param corefs: The coreference clusters.
+        :return: The mention to cluster map, or None if a mention is found in multiple clusters, i.e. the transitive
+        closure is not resolved.
+        """
+        mention_2_cluster = {}
         for cluster_id, one_coref_cluster in enumerate(corefs):
-            clusters[cluster_id] = set(one_coref_cluster[2])
+            for event_mention_id in one_coref_cluster[2]:
+                if mention_2_cluster.get(event_mention_id, cluster_id) != cluster_id:
+                    logger.error("Non empty intersection between clusters found. Please resolve transitive closure "
+                                 "before submit.")
+                    logger.error(set(corefs[mention_2_cluster[event_mention_id]][2]))
+                    logger.error(set(one_coref_cluster[2]))
+                    return None
+                mention_2_cluster[event_mention_id] = cluster_id
+        return mention_2_cluster
+
+    def prepare_fields(self, corefs, mention_table, id_2_text):
+        """
+        Find the CoNLL fields of each row from the clusters of one document.
+        :return: A list of (mention string, cluster id), which is empty if the document has no mention, or None if the
+        clusters are not valid.
+        """
+        mention_2_cluster = self.get_mention_2_cluster(corefs)
 
-        if utils.transitive_not_resolved(clusters):
-            return False
+        if mention_2_cluster is None:
+            return None
 
         singleton_cluster_id = len(corefs)
 
@@ -155,12 +345,7 @@ class ConllEvaluator:
 
             event_mention_id = mention[1]
 
-            non_singleton_cluster_id = None
-
-            for cluster_id, cluster_mentions in clusters.iteritems():
-                if event_mention_id in cluster_mentions:
-                    non_singleton_cluster_id = cluster_id
-                    break
+            non_singleton_cluster_id = mention_2_cluster.get(event_mention_id)
 
             if non_singleton_cluster_id is not None:
                 output_cluster_id = non_singleton_cluster_id
@@ -170,20 +355,233 @@ class ConllEvaluator:
 
             merged_mention_str = "_".join(id_2_text[event_mention_id].split())
 
-            # merged_mention_str = "_".join([get_or_terminate(self.id2token, tid, Config.token_miss_msg % tid)
-            #                                for tid in event_mention_id2sorted_tokens[event_mention_id]])
-
             coref_fields.append((merged_mention_str, output_cluster_id))
 
-        # for cluster_id, cluster in clusters.iteritems():
-        #     if within_cluster_span_duplicate(cluster, event_mention_id2sorted_tokens):
-        #         return False
+        return coref_fields
 
-        lines = []
+    @staticmethod
+    def get_clusters(coref_fields):
+        """
+        Group the rows into clusters, the same way the reference scorer reads the CoNLL lines, where a mention is
+        identified by its row.
+        :return: A list of clusters, each one is a list of row indices.
+        """
+        clusters = {}
+        for index, (_, cluster_id) in enumerate(coref_fields):
+            if cluster_id != "-":
+                clusters.setdefault(cluster_id, []).append(index)
+        return [clusters[cluster_id] for cluster_id in sorted(clusters)]
 
-        lines.append("%s (%s); part 000%s" % (Config.conll_bod_marker, self.doc_id, os.linesep))
+    def generate_lines(self, coref_fields):
+        yield "%s (%s); part 000%s" % (Config.conll_bod_marker, self.doc_id, os.linesep)
         for index, (merged_mention_str, cluster_id) in enumerate(coref_fields):
-            lines.append("%s\t%s\t%s\t(%s)\n" % (self.doc_id, index, merged_mention_str, cluster_id))
-        lines.append(Config.conll_eod_marker + os.linesep)
+            yield "%s\t%s\t%s\t(%s)\n" % (self.doc_id, index, merged_mention_str, cluster_id)
+        yield Config.conll_eod_marker + os.linesep
+
+
+def run_shard(shard):
+    gold_path, system_path, shard_out, metrics = shard
+    ConllEvaluator.run_conll_script(gold_path, system_path, shard_out, metrics, with_counts=True)
+
+
+def get_shard_path(path, index):
+    return "%s.%d" % (path, index)
+
+
+def format_perl_number(number):
+    """
+    Format a number in the same way as Perl prints it, i.e. integers without decimal points, and 15 significant digits.
+    """
+    return "%.15g" % number
+
+
+def format_rpf(recall_numerator, recall_denominator, precision_numerator, precision_denominator, f1=None):
+    """
+    Format the recall, precision and F1 line in the same way as the reference scorer (ShowRPF), where the percentages
+    are truncated to two decimals.
+    """
+    precision = float(precision_numerator) / precision_denominator if precision_denominator else 0
+    recall = float(recall_numerator) / recall_denominator if recall_denominator else 0
+    if f1 is None:
+        f1 = 2 * precision * recall / (precision + recall) if recall + precision else 0
+
+    def percentage(x):
+        return format_perl_number(int(x * 10000) / 100.0)
+
+    return "Recall: (%s / %s) %s%%\tPrecision: (%s / %s) %s%%\tF1: %s%%\n%s\n" % (
+        format_perl_number(recall_numerator), format_perl_number(recall_denominator), percentage(recall),
+        format_perl_number(precision_numerator), format_perl_number(precision_denominator), percentage(precision),
+        percentage(f1), score_separator)
+
+
+def read_conll_output(score_path):
+    """
+    Split the reference scorer output by metric.
+    :return: The version line, the metric names in order, and a map from metric name to (the lines before the totals,
+    the counts of each totals line). The counts are replaced by the full precision ones if available.
+    """
+    version = None
+    metric_names = []
+    metric_outputs = {}
+
+    metric = None
+    in_totals = False
+
+    with open(score_path, 'r') as f:
+        for l in f:
+            if l.startswith("version:"):
+                version = l
+                continue
+
+            if l.startswith("METRIC"):
+                metric = l.split()[-1].strip().strip(":")
+                in_totals = False
+                continue
+
+            if metric is None:
+                continue
+
+            if metric not in metric_outputs:
+                metric_names.append(metric)
+                metric_outputs[metric] = ([], {})
+
+            body, totals = metric_outputs[metric]
+
+            if l.strip() == totals_marker:
+                in_totals = True
+                # Remove the blank line before the totals.
+                if len(body) > 0 and body[-1].strip() == "":
+                    body.pop()
+                continue
+
+            if l.startswith(counts_marker):
+                counts = [float(x) for x in l[len(counts_marker):].split()]
+                if metric == "blanc":
+                    totals["Coreference links"] = counts[:4]
+                    totals["Non-coreference links"] = counts[4:]
+                else:
+                    totals["Coreference"] = counts
+                continue
+
+            if in_totals:
+                match = score_line_pattern.match(l)
+                if match is not None:
+                    fields = match.groups()
+                    totals[fields[0]] = [float(fields[i]) for i in (1, 2, 4, 5)]
+            else:
+                body.append(l)
+
+    return version, metric_names, metric_outputs
+
+
+def merge_conll_outputs(shard_outs, script_out):
+    """
+    Merge the reference scorer outputs of all shards. The document results are concatenated, and the totals are
+    computed from the summed counts, in the same way as the reference scorer sums the counts of all documents.
+    :param shard_outs: The reference scorer output of each shard.
+    :param script_out: Path to output the merged scores.
+    """
+    version = None
+    metric_names = []
+    bodies = {}
+    summed_totals = {}
+
+    for shard_out in shard_outs:
+        shard_version, shard_metric_names, metric_outputs = read_conll_output(shard_out)
+        if version is None:
+            version = shard_version
+
+        for metric in shard_metric_names:
+            body, totals = metric_outputs[metric]
+            if metric not in bodies:
+                metric_names.append(metric)
+                bodies[metric] = []
+                summed_totals[metric] = {}
+            bodies[metric].extend(body)
+            for name, counts in totals.iteritems():
+                if name in summed_totals[metric]:
+                    summed_totals[metric][name] = [a + b for a, b in zip(summed_totals[metric][name], counts)]
+                else:
+                    summed_totals[metric][name] = counts
+
+    with open(script_out, 'w') as out:
+        if version is not None:
+            out.write(version)
+
+        for metric in metric_names:
+            totals = summed_totals[metric]
+            out.write("\nMETRIC %s:\n" % metric)
+            out.writelines(bodies[metric])
+            out.write("\n%s\n" % totals_marker)
+            out.write("Identification of Mentions: " + format_rpf(*totals["Identification of Mentions"]))
+            if metric == "blanc":
+                out.write("\nCoreference:\n")
+                out.write("Coreference links: " + format_rpf(*totals["Coreference links"]))
+                out.write("Non-coreference links: " + format_rpf(*totals["Non-coreference links"]))
+                recall, precision, f1 = coref_metrics.blanc_scores(
+                    totals["Coreference links"] + totals["Non-coreference links"])
+                out.write("BLANC: " + format_rpf(recall, 1, precision, 1, f1))
+            else:
+                out.write("Coreference: " + format_rpf(*totals["Coreference"]))
+
+
+class ConllWriter:
+    """
+    Write the gold and system CoNLL files of all documents, the files are kept open for the whole run. The documents
+    can also be distributed to shards, each one is a smaller pair of gold and system files.
+    """
+
+    def __init__(self, gold_path, system_path, num_shards=0, positions=None):
+        """
+        :param positions: If provided, continue writing the files at these positions, as returned by get_positions.
+        """
+        utils.create_parent_dir(gold_path)
+        utils.create_parent_dir(system_path)
+
+        self.shard_paths = [(get_shard_path(gold_path, index), get_shard_path(system_path, index)) for index in
+                            range(num_shards)]
+
+        all_paths = [gold_path, system_path] + [p for paths in self.shard_paths for p in paths]
+        offsets = [None] * len(all_paths) if positions is None else positions["offsets"]
+        outs = [utils.open_output(p, offset) for p, offset in zip(all_paths, offsets)]
+
+        self.gold_out, self.system_out = outs[:2]
+        self.shard_outs = zip(outs[2::2], outs[3::2])
+        self.num_docs = 0 if positions is None else positions["num_docs"]
+
+    def write_document(self, gold_conll_lines, sys_conll_lines):
+        if len(self.shard_outs) > 0:
+            gold_conll_lines = list(gold_conll_lines)
+            sys_conll_lines = list(sys_conll_lines)
+            shard_gold_out, shard_system_out = self.shard_outs[self.num_docs % len(self.shard_outs)]
+            shard_gold_out.writelines(gold_conll_lines)
+            shard_system_out.writelines(sys_conll_lines)
+
+        self.gold_out.writelines(gold_conll_lines)
+        self.system_out.writelines(sys_conll_lines)
+        self.num_docs += 1
+
+    def get_positions(self):
+        """
+        :return: The sizes of all files written so far, and the number of documents, to resume writing the files.
+        """
+        outs = [self.gold_out, self.system_out] + [out for outs in self.shard_outs for out in outs]
+        return {"offsets": [utils.get_position(out) for out in outs], "num_docs": self.num_docs}
+
+    def close(self):
+        self.gold_out.close()
+        self.system_out.close()
+        for shard_gold_out, shard_system_out in self.shard_outs:
+            shard_gold_out.close()
+            shard_system_out.close()
+
+    def get_shard_paths(self):
+        """
+        :return: The gold and system paths of the shards that contain at least one document.
+        """
+        return self.shard_paths[:self.num_docs]
 
-        return lines
+    def remove_shards(self):
+        for gold_path, system_path in self.shard_paths:
+            os.remove(gold_path)
+            os.remove(system_path)
@@ -0,0 +1,244 @@
+"""
+    Coreference metrics computed in process.
+
+    The overall coreference scores are produced by the reference CoNLL scorer, which is too slow to be run for every
+    single document. The metrics here follow the reference scorer (v8.01) on the same input, i.e. the clusters written
+    to the CoNLL files, where each row of the file is one mention. The counts (numerators and denominators) are the same
+    as the ones reported by the reference scorer for each document.
+"""
+
+import logging
+
+from alignment import hungarian
+
+logger = logging.getLogger(__name__)
+
+metric_names = ["muc", "bcub", "ceafm", "ceafe", "blanc"]
+
+count_names = ["recall_numerator", "recall_denominator", "precision_numerator", "precision_denominator"]
+
+
+def get_mention_2_cluster(clusters):
+    mention_2_cluster = {}
+    for cluster_index, cluster in enumerate(clusters):
+        for mention in cluster:
+            mention_2_cluster[mention] = cluster_index
+    return mention_2_cluster
+
+
+def get_overlaps(key, response):
+    """
+    Count the common mentions of each pair of key and response clusters that overlap.
+    :return: Map from (key index, response index) to the number of common mentions.
+    """
+    response_index = get_mention_2_cluster(response)
+    overlaps = {}
+    for key_index, cluster in enumerate(key):
+        for mention in cluster:
+            if mention in response_index:
+                pair = (key_index, response_index[mention])
+                overlaps[pair] = overlaps.get(pair, 0) + 1
+    return overlaps
+
+
+def muc(key, response, overlaps):
+    """
+    Link based MUC, a cluster of n mentions contains n - 1 links. The correct links of a response cluster are its
+    mentions in the key, minus the number of key clusters they are partitioned into.
+    """
+    # Each overlapping pair of clusters is one partition.
+    correct = sum(overlaps.itervalues()) - len(overlaps)
+
+    key_links = sum(len(c) - 1 for c in key)
+    response_links = sum(len(c) - 1 for c in response)
+    return correct, key_links, correct, response_links
+
+
+def b_cubed(key, response, overlaps):
+    """
+    Mention based B-cubed, each common mention of a key and a response cluster contributes the overlap size divided by
+    the cluster size.
+    """
+    recall = 0.0
+    precision = 0.0
+    for (key_index, response_index), count in overlaps.iteritems():
+        recall += float(count * count) / len(key[key_index])
+        precision += float(count * count) / len(response[response_index])
+
+    return recall, sum(len(c) for c in key), precision, sum(len(c) for c in response)
+
+
+def ceaf(key, response, overlaps, entity_based):
+    """
+    CEAF with the optimal one to one alignment between key and response clusters.
+    :param entity_based: Use the entity based similarity (CEAF-e) or the mention based one (CEAF-m).
+    """
+    if entity_based:
+        similarity = dict((pair, 2.0 * count / (len(key[pair[0]]) + len(response[pair[1]]))) for pair, count in
+                          overlaps.iteritems())
+        key_total = len(key)
+        response_total = len(response)
+    else:
+        similarity = dict((pair, float(count)) for pair, count in overlaps.iteritems())
+        key_total = sum(len(c) for c in key)
+        response_total = sum(len(c) for c in response)
+
+    total_similarity = 0.0
+    if len(similarity) > 0:
+        key_ids = sorted(set(p[0] for p in similarity))
+        response_ids = sorted(set(p[1] for p in similarity))
+
+        # The Hungarian algorithm requires rows to be no more than the columns.
+        transposed = len(key_ids) > len(response_ids)
+        rows, columns = (response_ids, key_ids) if transposed else (key_ids, response_ids)
+
+        cost = []
+        for r in rows:
+            pairs = [(c, r) if transposed else (r, c) for c in columns]
+            cost.append([-similarity.get(pair, 0.0) for pair in pairs])
+
+        for r, c in enumerate(hungarian(cost)):
+            total_similarity -= cost[r][c]
+
+    return total_similarity, key_total, total_similarity, response_total
+
+
+def blanc_counts(key, response, overlaps):
+    """
+    Count the coreference and non-coreference links of BLANC, following the reference scorer, key and response are
+    allowed to have different mentions.
+    :return: Correct, key, correct, response counts of coreference links, then the same counts for non-coreference
+    links.
+    """
+    def num_pairs(n):
+        return n * (n - 1) / 2
+
+    key_coref = sum(num_pairs(len(c)) for c in key)
+    response_coref = sum(num_pairs(len(c)) for c in response)
+    correct_coref = sum(num_pairs(count) for count in overlaps.itervalues())
+
+    num_key = sum(len(c) for c in key)
+    num_response = sum(len(c) for c in response)
+    key_non_coref = num_pairs(num_key) - key_coref
+    response_non_coref = num_pairs(num_response) - response_coref
+
+    # Pairs of mentions that are in both key and response, and are not coreferent in either of them.
+    common_by_key = {}
+    common_by_response = {}
+    for (key_index, response_index), count in overlaps.iteritems():
+        common_by_key[key_index] = common_by_key.get(key_index, 0) + count
+        common_by_response[response_index] = common_by_response.get(response_index, 0) + count
+    num_common = sum(common_by_key.itervalues())
+    correct_non_coref = num_pairs(num_common) - sum(num_pairs(n) for n in common_by_key.itervalues()) - sum(
+        num_pairs(n) for n in common_by_response.itervalues()) + correct_coref
+
+    return (correct_coref, key_coref, correct_coref, response_coref,
+            correct_non_coref, key_non_coref, correct_non_coref, response_non_coref)
+
+
+def blanc_scores(counts):
+    """
+    Compute BLANC recall, precision and F1 from the link counts, in the same way as the totals of the reference
+    scorer, where a link type without any key link is not considered.
+    """
+    nra, dra, npa, dpa, nrr, drr, npr, dpr = counts
+
+    recall_coref = float(nra) / dra if dra else -1
+    recall_non_coref = float(nrr) / drr if drr else -1
+    precision_coref = float(npa) / dpa if dpa else 0
+    precision_non_coref = float(npr) / dpr if dpr else 0
+
+    f1_coref = compute_f1(precision_coref, recall_coref)
+    f1_non_coref = compute_f1(precision_non_coref, recall_non_coref)
+
+    if recall_coref == -1 and recall_non_coref == -1:
+        return 0.0, 0.0, 0.0
+    elif recall_coref == -1:
+        return recall_non_coref, precision_non_coref, f1_non_coref
+    elif recall_non_coref == -1:
+        return recall_coref, precision_coref, f1_coref
+
+    return (recall_coref + recall_non_coref) / 2, (precision_coref + precision_non_coref) / 2, (
+        f1_coref + f1_non_coref) / 2
+
+
+def compute_f1(precision, recall):
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def to_score_fields(counts):
+    recall_numerator, recall_denominator, precision_numerator, precision_denominator = counts
+    recall = float(recall_numerator) / recall_denominator if recall_denominator else 0.0
+    precision = float(precision_numerator) / precision_denominator if precision_denominator else 0.0
+    return {
+        "recall_numerator": recall_numerator,
+        "recall_denominator": recall_denominator,
+        "recall": recall * 100,
+        "precision_numerator": precision_numerator,
+        "precision_denominator": precision_denominator,
+        "precision": precision * 100,
+        "f1": compute_f1(precision, recall) * 100,
+    }
+
+
+def to_blanc_fields(counts):
+    recall, precision, f1 = blanc_scores(counts)
+    return {
+        "coreference_links": to_score_fields(counts[:4]),
+        "non_coreference_links": to_score_fields(counts[4:]),
+        "recall": recall * 100,
+        "precision": precision * 100,
+        "f1": f1 * 100,
+    }
+
+
+def score_document(key, response):
+    """
+    Compute all the coreference metrics for one document.
+    :param key: The key clusters, each one is a list of mentions, singletons included.
+    :param response: The response clusters.
+    :return: Map from metric name to the counts and scores (in percentage), in the same fields as the parsed
+    reference scorer output. BLANC contains the link counts and the combined scores.
+    """
+    key = [c for c in key if len(c) > 0]
+    response = [c for c in response if len(c) > 0]
+    overlaps = get_overlaps(key, response)
+
+    scores = {
+        "muc": to_score_fields(muc(key, response, overlaps)),
+        "bcub": to_score_fields(b_cubed(key, response, overlaps)),
+        "ceafm": to_score_fields(ceaf(key, response, overlaps, False)),
+        "ceafe": to_score_fields(ceaf(key, response, overlaps, True)),
+    }
+
+    scores["blanc"] = to_blanc_fields(blanc_counts(key, response, overlaps))
+
+    return scores
+
+
+def get_counts(score_fields):
+    return [score_fields[name] for name in count_names]
+
+
+def sum_scores(all_doc_scores):
+    """
+    Combine the document scores into the corpus scores, the reference scorer sums the counts of all documents, and
+    BLANC is computed from the summed link counts.
+    :param all_doc_scores: The scores of each document, as returned by score_document.
+    :return: The corpus scores in the same format.
+    """
+    totals = dict((metric, [0] * len(count_names)) for metric in metric_names if metric != "blanc")
+    blanc_totals = [0] * (2 * len(count_names))
+
+    for doc_scores in all_doc_scores:
+        for metric, counts in totals.iteritems():
+            for index, count in enumerate(get_counts(doc_scores[metric])):
+                counts[index] += count
+        link_counts = get_counts(doc_scores["blanc"]["coreference_links"]) + get_counts(
+            doc_scores["blanc"]["non_coreference_links"])
+        for index, count in enumerate(link_counts):
+            blanc_totals[index] += count
+
+    scores = dict((metric, to_score_fields(counts)) for metric, counts in totals.iteritems())
+    scores["blanc"] = to_blanc_fields(blanc_totals)
+    return scores
@@ -0,0 +1,397 @@
+"""
+    Sufficient statistics of an evaluation, which can be merged.
+
+    The averages only depend on the document level counts, so a large evaluation can be split into shards (such as
+    one pair of gold and system files per node), each one scored with --emit_stats, and the statistics of all shards
+    merged into the final report with --merge_stats. The statistics file is JSON, it contains:
+        - The mention counts of each document, including each attribute combination, and the alignment gaps.
+        - The per type counts.
+        - The reference coreference scorer output and the in process coreference metrics of each document.
+        - The TimeML evaluator counts of each link type, which are summed over documents by the evaluator.
+
+    The statistics of the documents evaluated so far are also saved in the checkpoints of a long evaluation, from
+    which the evaluation can be resumed.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+import utils
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+stats_version = 1
+checkpoint_version = 2
+
+count_fields = ["precision_matched", "recall_matched", "system_total", "gold_total"]
+
+# The statistics that are lists in the order the documents are evaluated, and the per type counts of all documents.
+doc_list_fields = ["doc_mention_scores", "doc_alignment_gaps", "doc_coref_scores"]
+per_type_fields = ["per_type_tp", "per_type_num_gold", "per_type_num_response"]
+
+
+def get_sweep_settings(context):
+    return {
+        "coref_sweep_criteria": [utils.get_criteria_name(c) for c in
+                                 context.mutable_config.coref_sweep_criteria],
+        "coref_mention_thresholds": context.mutable_config.coref_mention_thresholds,
+    }
+
+
+def get_stats(context):
+    """
+    Collect the statistics accumulated in the context, the coreference scorer output and the sequencing counts are only
+    available when the evaluation is finished.
+    :param context: The evaluation context.
+    :return: The statistics, which can be serialized to JSON.
+    """
+    state = context.state
+    doc_ids = [doc_scores[-1] for doc_scores in state.doc_mention_scores]
+
+    conll_output = None
+    if len(state.overall_coref_scores) > 0:
+        with open(context.config.conll_out) as f:
+            conll_output = f.read()
+
+    stats = {
+        "version": stats_version,
+        "system_id": state.system_id,
+        "settings": get_sweep_settings(context),
+        "doc_mention_scores": state.doc_mention_scores,
+        "doc_alignment_gaps": state.doc_alignment_gaps,
+        "per_type_tp": state.per_type_tp,
+        "per_type_num_gold": state.per_type_num_gold,
+        "per_type_num_response": state.per_type_num_response,
+        "doc_coref_scores": state.doc_coref_scores,
+        "doc_coref_metrics": state.doc_coref_metrics,
+        "conll_output": conll_output,
+        # The sweep metrics are stored in the same order as the documents.
+        "coref_sweep_metrics": [[criteria_name, threshold, dict(zip(doc_ids, doc_metrics))] for
+                                (criteria_name, threshold), doc_metrics in state.coref_sweep_metrics.iteritems()],
+        "sequencing": state.overall_seq_scores,
+        "sequencing_cluster": state.overall_seq_cluster_scores,
+    }
+    return stats
+
+
+def write_stats(context, stats_path):
+    """
+    Write the statistics accumulated in the context, the evaluation should be finished.
+    :param context: The evaluation context.
+    :param stats_path: Path of the statistics file.
+    """
+    utils.create_parent_dir(stats_path)
+    with open(stats_path, 'w') as out:
+        json.dump(get_stats(context), out)
+    logger.info("Evaluation statistics saved at %s" % stats_path)
+
+
+def read_stats(stats_path):
+    with open(stats_path) as f:
+        stats = json.load(f)
+    if stats.get("version") != stats_version:
+        utils.terminate_with_error("Statistics file [%s] is not of version %d." % (stats_path, stats_version))
+    return stats
+
+
+def merge_stats(context, stats_paths):
+    """
+    Merge the statistics of all the files into the context, as if all their documents are evaluated in one run. The
+    documents are ordered by id, the same order as the scorer.
+    :param context: The evaluation context, the coreference and sequencing outputs are written to its output paths
+    if provided.
+    :param stats_paths: Paths of the statistics files, each document should be in only one of them.
+    """
+    # The sequencing module is only loaded when merging, the checkpoints do not need it.
+    from temporal import get_eval_scores, write_eval_output
+
+    state = context.state
+    mutable_config = context.mutable_config
+
+    all_stats = [read_stats(p) for p in stats_paths]
+
+    settings = all_stats[0]["settings"]
+    for stats_path, stats in zip(stats_paths, all_stats):
+        if stats["settings"] != settings:
+            utils.terminate_with_error("Statistics file [%s] is not emitted with the same coreference sweep settings "
+                                       "as [%s]." % (stats_path, stats_paths[0]))
+
+    state.system_id = all_stats[0]["system_id"]
+    criteria_by_name = dict((utils.get_criteria_name(c), c) for c in Config.possible_coref_mapping)
+    mutable_config.coref_sweep_criteria = [criteria_by_name[name] for name in settings["coref_sweep_criteria"]]
+    mutable_config.coref_mention_thresholds = settings["coref_mention_thresholds"]
+
+    doc_ids = set()
+    sweep_metrics = {}
+    conll_outputs = []
+    seq_counts = {}
+    seq_cluster_counts = {}
+
+    for stats_path, stats in zip(stats_paths, all_stats):
+        for doc_scores in stats["doc_mention_scores"]:
+            doc_id = doc_scores[-1]
+            if doc_id in doc_ids:
+                utils.terminate_with_error("Document [%s] in [%s] is already merged from another statistics "
+                                           "file." % (doc_id, stats_path))
+            doc_ids.add(doc_id)
+            state.doc_mention_scores.append(doc_scores)
+
+        state.doc_alignment_gaps.extend(stats["doc_alignment_gaps"])
+
+        for merged, counts in [(state.per_type_tp, stats["per_type_tp"]),
+                               (state.per_type_num_gold, stats["per_type_num_gold"]),
+                               (state.per_type_num_response, stats["per_type_num_response"])]:
+            for mention_type, count in counts.iteritems():
+                utils.put_or_increment(merged, mention_type, count)
+
+        state.doc_coref_scores.extend(stats["doc_coref_scores"])
+        state.doc_coref_metrics.update(stats["doc_coref_metrics"])
+        if stats["conll_output"] is not None:
+            conll_outputs.append(stats["conll_output"])
+
+        for criteria_name, threshold, doc_metrics in stats["coref_sweep_metrics"]:
+            sweep_metrics.setdefault((criteria_name, threshold), {}).update(doc_metrics)
+
+        for merged, link_scores in [(seq_counts, stats["sequencing"]),
+                                    (seq_cluster_counts, stats["sequencing_cluster"])]:
+            for link_type, scores in link_scores.iteritems():
+                counts = merged.setdefault(link_type, [0] * len(count_fields))
+                for index, field in enumerate(count_fields):
+                    counts[index] += scores[field]
+
+    state.doc_mention_scores.sort(key=lambda doc_scores: doc_scores[-1])
+    state.doc_alignment_gaps.sort(key=lambda gaps: gaps[-1])
+    state.doc_coref_scores.sort(key=lambda doc_score: doc_score[-1])
+
+    for key, doc_metrics in sweep_metrics.iteritems():
+        state.coref_sweep_metrics[key] = [doc_metrics[doc_id] for doc_id in sorted(doc_metrics)]
+
+    if len(conll_outputs) > 0:
+        merge_coref_outputs(context, conll_outputs)
+
+    for link_type, counts in seq_counts.iteritems():
+        state.overall_seq_scores[link_type] = get_eval_scores(*counts)
+        if link_type in seq_cluster_counts:
+            state.overall_seq_cluster_scores[link_type] = get_eval_scores(*seq_cluster_counts[link_type])
+
+    if len(seq_counts) > 0 and context.config.script_result_dir is not None:
+        for link_type, scores in state.overall_seq_scores.iteritems():
+            write_eval_output(scores, os.path.join(context.config.script_result_dir, link_type, Config.script_out))
+        for link_type, scores in state.overall_seq_cluster_scores.iteritems():
+            write_eval_output(scores, os.path.join(context.config.script_result_dir, link_type,
+                                                   Config.script_out_cluster))
+
+    logger.info("Merged %d documents from %d statistics files." % (len(doc_ids), len(stats_paths)))
+
+
+def merge_coref_outputs(context, conll_outputs):
+    """
+    Merge the reference coreference scorer outputs in the same way as the coreference shards, and read the scores. The
+    merged output is kept at the CoNLL output path if provided.
+    """
+    from conll_coref import ConllEvaluator, merge_conll_outputs
+
+    state = context.state
+
+    output_paths = []
+    for conll_output in conll_outputs:
+        fd, path = tempfile.mkstemp(suffix=".conll_out")
+        with os.fdopen(fd, 'w') as out:
+            out.write(conll_output)
+        output_paths.append(path)
+
+    conll_out = context.config.conll_out
+    if conll_out is None:
+        fd, conll_out = tempfile.mkstemp(suffix=".conll_out")
+        os.close(fd)
+
+    merge_conll_outputs(output_paths, conll_out)
+
+    state.overall_coref_scores = ConllEvaluator.get_conll_scores(conll_out)
+    state.overall_coref_details = ConllEvaluator.get_conll_score_details(conll_out)
+    state.doc_coref_details = ConllEvaluator.get_conll_doc_details(conll_out)
+
+    for path in output_paths:
+        os.remove(path)
+    if context.config.conll_out is None:
+        os.remove(conll_out)
+
+
+def get_checkpoint_marks(context, appended_outputs):
+    """
+    What is saved up to the checkpoint, the next checkpoint only contains what is added after it.
+    """
+    state = context.state
+    return {
+        "num_docs": state.evaluating_index,
+        "list_sizes": dict((field, len(getattr(state, field))) for field in doc_list_fields),
+        "per_type": dict((field, dict(getattr(state, field))) for field in per_type_fields),
+        "appended_sizes": dict((output, dict((name, len(values)) for name, values in columns.iteritems())) for
+                               output, columns in appended_outputs.iteritems()),
+    }
+
+
+def get_new_stats(context, last_marks):
+    """
+    The statistics added since the last checkpoint, the per type counts are the increments of the changed types.
+    """
+    state = context.state
+    list_sizes = dict((field, 0) for field in doc_list_fields) if last_marks is None else last_marks["list_sizes"]
+    last_per_type = dict((field, {}) for field in per_type_fields) if last_marks is None else last_marks["per_type"]
+
+    stats = {"settings": get_sweep_settings(context)}
+    for field in doc_list_fields:
+        stats[field] = getattr(state, field)[list_sizes[field]:]
+    for field in per_type_fields:
+        last_counts = last_per_type[field]
+        stats[field] = dict((t, count - last_counts.get(t, 0)) for t, count in getattr(state, field).iteritems() if
+                            last_counts.get(t) != count)
+
+    # The sweep metrics are stored in the same order as the documents.
+    num_scored = list_sizes["doc_mention_scores"]
+    doc_ids = [doc_scores[-1] for doc_scores in stats["doc_mention_scores"]]
+    stats["doc_coref_metrics"] = dict((doc_id, state.doc_coref_metrics[doc_id]) for doc_id in doc_ids if
+                                      doc_id in state.doc_coref_metrics)
+    stats["coref_sweep_metrics"] = [[criteria_name, threshold, dict(zip(doc_ids, doc_metrics[num_scored:]))] for
+                                    (criteria_name, threshold), doc_metrics in state.coref_sweep_metrics.iteritems()]
+    return stats
+
+
+def write_checkpoint(context, checkpoint_path, outputs, appended_outputs=None):
+    """
+    Save the statistics of the documents evaluated since the last checkpoint, so that the evaluation can be resumed.
+    Each checkpoint is appended as one line to the checkpoint file, and only contains what is added after the previous
+    one, so that saving a checkpoint costs the same throughout the evaluation. The line is synced to the disk before
+    the evaluation continues, an incomplete line left by an interruption is discarded when resuming.
+    :param context: The evaluation context.
+    :param checkpoint_path: Path of the checkpoint.
+    :param outputs: The states of the outputs written so far, such as the file sizes, restored when resuming.
+    :param appended_outputs: The outputs accumulated in memory as columns of values, only the values added after the
+    previous checkpoint are saved.
+    """
+    state = context.state
+    last_marks = state.last_checkpoint_marks
+    appended_outputs = {} if appended_outputs is None else appended_outputs
+
+    if last_marks is not None and last_marks["num_docs"] == state.evaluating_index:
+        logger.debug("No document is evaluated since the last checkpoint.")
+        return
+
+    num_saved_docs = 0 if last_marks is None else last_marks["num_docs"]
+    appended_sizes = {} if last_marks is None else last_marks["appended_sizes"]
+
+    checkpoint = {
+        "version": checkpoint_version,
+        "doc_ids": state.doc_ids_to_score[num_saved_docs:state.evaluating_index],
+        "stats": get_new_stats(context, last_marks),
+        "outputs": outputs,
+        "appended_outputs": dict(
+            (output, dict((name, values[appended_sizes.get(output, {}).get(name, 0):]) for name, values in
+                          columns.iteritems())) for output, columns in appended_outputs.iteritems()),
+    }
+
+    utils.create_parent_dir(checkpoint_path)
+    with open(checkpoint_path, 'a') as out:
+        out.write(json.dumps(checkpoint) + "\n")
+        out.flush()
+        os.fsync(out.fileno())
+
+    state.last_checkpoint_marks = get_checkpoint_marks(context, appended_outputs)
+    logger.info("Checkpoint saved at %s after %d documents." % (checkpoint_path, state.evaluating_index))
+
+
+def read_checkpoint(checkpoint_path):
+    """
+    Read and combine the checkpoints saved in the file. An incomplete last line, written when the evaluation is
+    interrupted, is discarded and removed from the file, so that the next checkpoint is appended after the complete
+    ones.
+    :param checkpoint_path: Path of the checkpoint.
+    :return: The combined checkpoint, in the same form as one checkpoint with all the documents, or None if no
+    checkpoint is complete.
+    """
+    checkpoints = []
+    complete_size = 0
+    with open(checkpoint_path) as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                checkpoint = json.loads(line)
+            except ValueError:
+                break
+            if checkpoint.get("version") != checkpoint_version:
+                utils.terminate_with_error("Checkpoint [%s] is not of version %d." % (checkpoint_path,
+                                                                                     checkpoint_version))
+            checkpoints.append(checkpoint)
+            complete_size += len(line)
+
+    if complete_size < os.path.getsize(checkpoint_path):
+        logger.warning("The incomplete last checkpoint in %s is discarded." % checkpoint_path)
+        with open(checkpoint_path, 'r+') as f:
+            f.truncate(complete_size)
+
+    if len(checkpoints) == 0:
+        return None
+
+    stats = dict((field, []) for field in doc_list_fields)
+    stats.update((field, {}) for field in per_type_fields)
+    stats["settings"] = checkpoints[0]["stats"]["settings"]
+    stats["doc_coref_metrics"] = {}
+    sweep_metrics = {}
+
+    combined = {"doc_ids": [], "stats": stats, "outputs": {}, "appended_outputs": {}}
+    for checkpoint in checkpoints:
+        combined["doc_ids"].extend(checkpoint["doc_ids"])
+        combined["outputs"] = checkpoint["outputs"]
+        for output, columns in checkpoint["appended_outputs"].iteritems():
+            for name, values in columns.iteritems():
+                combined["appended_outputs"].setdefault(output, {}).setdefault(name, []).extend(values)
+
+        new_stats = checkpoint["stats"]
+        for field in doc_list_fields:
+            stats[field].extend(new_stats[field])
+        for field in per_type_fields:
+            for mention_type, count in new_stats[field].iteritems():
+                utils.put_or_increment(stats[field], mention_type, count)
+        stats["doc_coref_metrics"].update(new_stats["doc_coref_metrics"])
+        for criteria_name, threshold, doc_metrics in new_stats["coref_sweep_metrics"]:
+            sweep_metrics.setdefault((criteria_name, threshold), {}).update(doc_metrics)
+
+    stats["coref_sweep_metrics"] = [[criteria_name, threshold, doc_metrics] for (criteria_name, threshold), doc_metrics
+                                    in sweep_metrics.iteritems()]
+    return combined
+
+
+def restore_checkpoint(context, checkpoint):
+    """
+    Restore the statistics of the documents evaluated before the checkpoint, the evaluation continues from the next
+    document. The documents should be read already.
+    :param context: The evaluation context.
+    :param checkpoint: The checkpoint, as read by read_checkpoint.
+    """
+    state = context.state
+    stats = checkpoint["stats"]
+    doc_ids = checkpoint["doc_ids"]
+
+    if state.doc_ids_to_score[:len(doc_ids)] != doc_ids:
+        utils.terminate_with_error("The documents evaluated in the checkpoint are not the same as the documents to be "
+                                   "evaluated, the checkpoint is created from other inputs.")
+    if stats["settings"] != get_sweep_settings(context):
+        utils.terminate_with_error("The checkpoint is created with other coreference sweep settings.")
+
+    state.evaluating_index = len(doc_ids)
+    state.doc_mention_scores = stats["doc_mention_scores"]
+    state.doc_alignment_gaps = stats["doc_alignment_gaps"]
+    state.per_type_tp = stats["per_type_tp"]
+    state.per_type_num_gold = stats["per_type_num_gold"]
+    state.per_type_num_response = stats["per_type_num_response"]
+    state.doc_coref_scores = stats["doc_coref_scores"]
+    state.doc_coref_metrics = stats["doc_coref_metrics"]
+    for criteria_name, threshold, doc_metrics in stats["coref_sweep_metrics"]:
+        state.coref_sweep_metrics[(criteria_name, threshold)] = [doc_metrics[doc_id] for doc_id in doc_ids]
+
+    state.last_checkpoint_marks = get_checkpoint_marks(context, checkpoint["appended_outputs"])
+    logger.info("Resume evaluation after %d documents." % len(doc_ids))
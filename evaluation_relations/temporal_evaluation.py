@@ -72,9 +72,11 @@ def change_DURING_relation(filetext):
 
 
 def get_relations(file):
-    text = open(file).read()
+    return get_relations_from_text(open(file).read(), extract_name(file))
+
+
+def get_relations_from_text(text, name):
     newtext = ''
-    name = extract_name(file)
     relations = re.findall('<TLINK[^>]*>', text)
     for each in relations:
         core = ''
@@ -275,8 +277,14 @@ def evaluate_two_files_implicit_in_recall(arg1, arg2):
 
     if debug >= 1:
         print '\n\n Evaluate', arg1, arg2
-    gold_annotation = get_relations(arg1)
-    system_annotation = get_relations(arg2)
+    return evaluate_relations_implicit_in_recall(get_relations(arg1), get_relations(arg2))
+
+
+def evaluate_relations_implicit_in_recall(gold_annotation, system_annotation):
+    global global_prec_matched
+    global global_rec_matched
+    global global_system_total
+    global global_gold_total
 
     tg_gold, tg_system = get_timegraphs(gold_annotation, system_annotation)
     gold_relations = get_triples(gold_annotation)
@@ -508,6 +516,24 @@ def evaluate_two_folders(gold, system):
 #                break 
 #            count += 1 
 
+def evaluate_archive(archive, gold, system):
+    """
+    Evaluate the files stored in a zip archive, the gold and system files are found under the two given directories
+    of the archive. Only the implicit_in_recall method is supported.
+    """
+    gold_prefix = gold.rstrip('/') + '/'
+    system_prefix = system.rstrip('/') + '/'
+    for member in archive.namelist():
+        if not member.startswith(gold_prefix) or member.endswith('/'):
+            continue
+        name = member[len(gold_prefix):]
+        if debug >= 2:
+            print member, system_prefix + name
+        evaluate_relations_implicit_in_recall(get_relations_from_text(archive.read(member), extract_name(name)),
+                                              get_relations_from_text(archive.read(system_prefix + name),
+                                                                      extract_name(name)))
+
+
 def get_fscore(p, r):
     if p + r == 0:
         return 0
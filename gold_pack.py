@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+"""
+    Precompiled gold standard, the evaluation pack.
+
+    The scorer parses the gold standard TBF file, reads the token tables and canonicalizes the types in every run. The
+    pack stores the result of all these steps in one binary file: the mention tables (spans, canonicalized attributes,
+    mention ids, original spans and text), the parsed relations (coreference clusters and directed links), and the
+    token ids and the invisible token ids of each document in token mode. The ids are interned, so that each one is
+    only stored once in the pack.
+
+    Compile a pack:
+
+        ./gold_pack.py -g gold.tbf -t tkn -wl TAC_KBP_eval_type_2016.txt -o gold.pack
+
+    The scorer loads a pack given as the gold standard (-g) in one read, the validator could take the token tables from
+    a pack (-gp) instead of the token files.
+"""
+
+import argparse
+import cPickle as pickle
+import logging
+import os
+import sys
+
+import utils
+from config import Config, EvalContext, EvalMethod
+
+logger = logging.getLogger(__name__)
+
+# The format version after the first line of a pack (Config.pack_magic), the pack should be compiled again if the
+# version changes.
+pack_version = 1
+
+
+class GoldPack:
+    """
+    The gold standard of all documents, as parsed by the scorer.
+    """
+
+    def __init__(self, docs, token_based, white_listed_types=None, token_ids=None, invisible_ids=None, source=None):
+        """
+        :param docs: Map from doc id to the (mention table, relations), each mention is created by the scorer, and each
+        relation is (relation name, relation id, mention ids).
+        :param token_based: Whether the spans are token ids, otherwise characters.
+        :param white_listed_types: The canonicalized types of the white list, the mentions of other types are not in
+        the pack. None if all types are kept.
+        :param token_ids: Map from doc id to all the token ids of the document, only in token mode.
+        :param invisible_ids: Map from doc id to the invisible token ids of the document, only in token mode.
+        :param source: The gold standard file the pack is compiled from.
+        """
+        self.docs = docs
+        self.token_based = token_based
+        self.white_listed_types = white_listed_types
+        self.token_ids = {} if token_ids is None else token_ids
+        self.invisible_ids = {} if invisible_ids is None else invisible_ids
+        self.source = source
+
+    def eval_mode(self):
+        return EvalMethod.Token if self.token_based else EvalMethod.Char
+
+    def save(self, path):
+        # The fields are stored as plain containers, so that the pack does not depend on where this class is loaded.
+        fields = {
+            "docs": self.docs,
+            "token_based": self.token_based,
+            "white_listed_types": self.white_listed_types,
+            "token_ids": self.token_ids,
+            "invisible_ids": self.invisible_ids,
+            "source": self.source,
+        }
+        utils.create_parent_dir(path)
+        with open(path, 'wb') as out:
+            out.write("%s\t%d\n" % (Config.pack_magic, pack_version))
+            pickle.dump(fields, out, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            header = f.readline().split("\t")
+            if header[0] != Config.pack_magic:
+                utils.terminate_with_error("[%s] is not an evaluation pack." % path)
+            if int(header[1]) != pack_version:
+                utils.terminate_with_error("Evaluation pack [%s] is of version %s, but version %d is required, please "
+                                           "compile it again." % (path, header[1].strip(), pack_version))
+            fields = pickle.loads(f.read())
+        return GoldPack(**fields)
+
+
+def intern_mention(mention):
+    spans, attributes, event_id, original_spans, text = mention
+    if isinstance(spans, set):
+        spans = set(intern(t) for t in spans)
+        original_spans = [intern(t) for t in original_spans]
+    return spans, [intern(a) for a in attributes], intern(event_id), original_spans, text
+
+
+def intern_relation(relation):
+    name, relation_id, mention_ids = relation
+    return intern(name), relation_id, [intern(m) for m in mention_ids]
+
+
+def compile_pack(gold_path, token_dir=None, token_file_ext=None, token_offset_fields=None, white_list=None):
+    """
+    Parse the gold standard in the same way as the scorer.
+    :param gold_path: The gold standard TBF file.
+    :param token_dir: The directory of the token tables, the spans are token ids if provided, otherwise characters.
+    :param token_file_ext: The extension of the token table files.
+    :param token_offset_fields: The fields of the token offsets in the token table files.
+    :param white_list: The types to be kept, one type subtype pair per line, all types are kept if None.
+    :return: The evaluation pack.
+    """
+    # The scorer is only needed to compile, it could not be imported by name.
+    import scorer_api
+    scorer = scorer_api.scorer
+
+    context = EvalContext()
+    context.mutable_config.eval_mode = EvalMethod.Char if token_dir is None else EvalMethod.Token
+
+    if white_list is not None:
+        context.state.white_listed_types = set(intern(scorer.canonicalize_string(l)) for l in white_list)
+
+    if token_offset_fields is None:
+        token_offset_fields = Config.default_token_offset_fields
+
+    with open(gold_path) as gf:
+        raw_docs, _ = scorer.read_docs_with_doc_id_and_name(gf)
+
+    docs = {}
+    token_ids = {}
+    invisible_ids = {}
+    for doc_id, (mention_lines, relation_lines) in raw_docs.iteritems():
+        doc_invisible_ids = set()
+        if token_dir is not None:
+            doc_invisible_ids, id2token, _ = scorer.read_token_ids(token_dir, doc_id, token_file_ext,
+                                                                   token_offset_fields)
+            token_ids[doc_id] = set(intern(t) for t in id2token)
+            invisible_ids[doc_id] = set(intern(t) for t in doc_invisible_ids)
+
+        mention_table = [intern_mention(m) for m in
+                         (scorer.parse_line(context, l, doc_invisible_ids) for l in mention_lines) if m]
+        docs[doc_id] = mention_table, [intern_relation(utils.parse_relation_line(l)) for l in relation_lines]
+
+    return GoldPack(docs, token_dir is not None, context.state.white_listed_types, token_ids, invisible_ids,
+                    os.path.abspath(gold_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compile the gold standard into an evaluation pack, which can be given to the scorer as the gold "
+                    "standard.")
+    parser.add_argument("-g", "--gold", help="Golden Standard", required=True)
+    parser.add_argument("-o", "--output", help="Path of the evaluation pack", required=True)
+    parser.add_argument(
+        "-t", "--token_path", help="Path to the directory containing the token mappings file, the pack is token based "
+                                   "if provided.")
+    parser.add_argument(
+        "-of", "--offset_field", help="A pair of integer indicates which column we should read the offset in the token "
+                                      "mapping file, index starts at 0, default value will be %s"
+                                      % Config.default_token_offset_fields)
+    parser.add_argument(
+        "-te", "--token_table_extension",
+        help="any extension appended after docid of token table files. Default is [%s]" % Config.default_token_file_ext)
+    parser.add_argument("-wl", "--type_white_list", type=argparse.FileType('r'),
+                        help="Provide a file, where each line list a mention type subtype pair to be evaluated. Types "
+                             "that are out of this white list will not be in the pack.")
+
+    args = parser.parse_args()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s : %(message)s'))
+    logging.getLogger().addHandler(stream_handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    if not os.path.isfile(args.gold):
+        utils.terminate_with_error("Cannot find gold standard file at " + args.gold)
+
+    token_dir = None
+    if args.token_path is not None:
+        if not os.path.isdir(args.token_path):
+            utils.terminate_with_error("Cannot find token directory at " + args.token_path)
+        token_dir = args.token_path
+
+    token_offset_fields = None
+    if args.offset_field is not None:
+        try:
+            token_offset_fields = [int(x) for x in args.offset_field.split(",")]
+        except ValueError as _:
+            utils.terminate_with_error("Token offset argument should be two integer with comma in between, i.e. 2,3")
+
+    try:
+        pack = compile_pack(args.gold, token_dir, args.token_table_extension, token_offset_fields,
+                            args.type_white_list)
+    except utils.ScoringError as e:
+        utils.terminate_on_error(e)
+    pack.save(args.output)
+
+    logger.info("Compiled %d documents into evaluation pack %s" % (len(pack.docs), args.output))
+
+
+if __name__ == "__main__":
+    main()
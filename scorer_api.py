@@ -0,0 +1,187 @@
+"""
+    Score event mentions, coreference and sequencing from objects in memory, in the same way as the scorer
+(scorer_v1.8.py), without reading or writing any file and without running the reference scorers in subprocesses. The
+coreference metrics are computed in process (see coref_metrics), and the TimeML files of sequencing are kept in memory.
+
+    The documents are given as a map from doc id to (mentions, relations):
+        mention: (mention id, spans, text, mention type, realis), where spans are the [begin, end) character offsets
+            as a list of pairs, or the token ids when scoring tokens.
+        relation: (relation name, relation id, mention ids), such as ("Coreference", "C1", ["E1", "E3"]).
+
+    The gold documents can be read once from a TBF file and reused for all the evaluations:
+
+        import scorer_api
+        gold, _ = scorer_api.read_documents("gold.tbf")
+        results = scorer_api.score(gold, system, coreference=True)
+        print results["micro_average"]["mention_type"]["f1"]
+
+    The results have the same structure as the JSON output of the scorer (-jo), except for the overall coreference
+scores, which are summed from the in process metrics instead of read from the reference scorer output:
+    - The percentages are not truncated to two decimals, so the scores (and the CoNLL average) may differ slightly
+      from the ones of the scorer.
+    - The details of each metric do not contain the "Identification of Mentions" scores.
+
+    The process is never terminated, the documents that cannot be scored raise utils.ScoringError instead.
+"""
+
+import imp
+import os
+
+import coref_metrics
+import utils
+from config import Config, EvalContext, EvalMethod
+from temporal import TemporalEval
+
+# The scorer script name is not a valid module name, so it is loaded from its path.
+scorer = imp.load_source("scorer", os.path.join(os.path.dirname(os.path.realpath(__file__)), "scorer_v1.8.py"))
+
+
+def read_documents(tbf_path, token_based=False):
+    """
+    Read the documents of a TBF file.
+    :param tbf_path: Path to the TBF file.
+    :param token_based: Whether the spans are token ids, otherwise character offsets.
+    :return: The documents as a map from doc id to (mentions, relations), and the run id of the file.
+    :raise utils.ScoringError: If the lines are not in the TBF format.
+    """
+    with open(tbf_path) as f:
+        raw_docs, run_id = scorer.read_docs_with_doc_id_and_name(f)
+
+    num_attributes = len(Config.attribute_names)
+
+    documents = {}
+    for doc_id, (mention_lines, relation_lines) in raw_docs.iteritems():
+        mentions = []
+        for l in mention_lines:
+            fields = l.split("\t")
+            if len(fields) < 5 + num_attributes:
+                raise utils.ScoringError("Line has too few fields:\n ---> %s" % l)
+            if token_based:
+                spans = fields[3].split(Config.token_joiner)
+            else:
+                spans = [tuple(int(x) for x in span.split(Config.span_joiner)) for span in
+                         fields[3].split(Config.span_seperator)]
+            mentions.append(tuple([fields[2], spans, fields[4]] + fields[5:5 + num_attributes]))
+        documents[doc_id] = mentions, [utils.parse_relation_line(l) for l in relation_lines]
+
+    return documents, run_id
+
+
+def get_mention_table(context, mentions):
+    """
+    Convert the mentions into the mention table of the scorer, the mentions out of the type white list are removed.
+    """
+    token_based = context.mutable_config.eval_mode == EvalMethod.Token
+
+    mention_table = []
+    for mention in mentions:
+        mention_id, spans, text = mention[:3]
+        if token_based:
+            parsed_spans = set(spans)
+            original_spans = list(spans)
+        else:
+            parsed_spans = [c for begin, end in spans for c in range(begin, end)]
+            original_spans = parsed_spans
+        row = scorer.create_mention(context, parsed_spans, original_spans, mention[3:], mention_id, text)
+        if row is not None:
+            mention_table.append(row)
+    return mention_table
+
+
+def set_coref_scores(state):
+    """
+    Sum the coreference metrics of all documents into the overall scores, which are read from the reference scorer
+    output otherwise. The details are in the same form, except that the mention identification is not reported. The
+    BLANC counts are the averaged recall and precision over 1, as reported by the reference scorer.
+    """
+    overall_metrics = coref_metrics.sum_scores([state.doc_coref_metrics[doc_id] for _, doc_id in
+                                                state.doc_coref_scores])
+
+    state.overall_coref_scores = dict((metric, scores["f1"]) for metric, scores in overall_metrics.iteritems())
+
+    state.overall_coref_details = {}
+    for metric, scores in overall_metrics.iteritems():
+        if metric == "blanc":
+            state.overall_coref_details[metric] = {
+                "Coreference links": scores["coreference_links"],
+                "Non-coreference links": scores["non_coreference_links"],
+                "BLANC": {"recall_numerator": scores["recall"] / 100, "recall_denominator": 1.0,
+                          "recall": scores["recall"], "precision_numerator": scores["precision"] / 100,
+                          "precision_denominator": 1.0, "precision": scores["precision"], "f1": scores["f1"]},
+            }
+        else:
+            state.overall_coref_details[metric] = {"Coreference": scores}
+
+    # The reference scorer does not report document level counts for BLANC.
+    state.doc_coref_details = {}
+    for _, doc_id in state.doc_coref_scores:
+        for metric, scores in state.doc_coref_metrics[doc_id].iteritems():
+            if metric != "blanc":
+                state.doc_coref_details.setdefault(metric, {})[doc_id] = scores
+
+
+def score(gold_documents, system_documents, system_id="_id_", token_based=False, coreference=False,
+          sequencing=False, coref_mapping=1, coref_threshold=None, coref_thresholds=None, all_coref_mappings=False,
+          optimal_alignment=False, script_validation=True, type_white_list=None):
+    """
+    Score the system documents against the gold documents, all the gold documents are scored, the ones missing in
+    the system are scored as empty.
+    :param gold_documents: Map from doc id to the gold (mentions, relations).
+    :param system_documents: Map from doc id to the system (mentions, relations).
+    :param system_id: The system id reported in the results.
+    :param token_based: Whether the spans are token ids, otherwise character offsets.
+    :param coreference: Whether to score coreference.
+    :param sequencing: Whether to score event sequencing (After and Subevent).
+    :param coref_mapping: Index of the coreference mapping criteria in Config.possible_coref_mapping.
+    :param coref_threshold: Threshold for coreference mention mapping.
+    :param coref_thresholds: Thresholds of the coreference sweep.
+    :param all_coref_mappings: Whether to sweep all the coreference mapping criteria.
+    :param optimal_alignment: Use the optimal mention alignment instead of the greedy one.
+    :param script_validation: Whether the sequencing links should be validated.
+    :param type_white_list: If provided, only the mention types in it are scored.
+    :return: The results, in the same structure as the JSON output of the scorer.
+    :raise ValueError: If the coreference mapping is not one of Config.possible_coref_mapping.
+    :raise utils.ScoringError: If the documents cannot be scored, such as overlapping coreference clusters, or
+    sequencing links that do not form a valid script graph.
+    """
+    context = EvalContext()
+    config = context.config
+    mutable_config = context.mutable_config
+    state = context.state
+
+    if coref_mapping not in range(len(Config.possible_coref_mapping)):
+        raise ValueError("Must provide a mapping between 0 to %d" % (len(Config.possible_coref_mapping) - 1))
+
+    mutable_config.eval_mode = EvalMethod.Token if token_based else EvalMethod.Char
+    config.coref_criteria = Config.possible_coref_mapping[coref_mapping]
+    if coref_threshold is not None:
+        mutable_config.coref_mention_threshold = coref_threshold
+    scorer.set_coref_sweep(context, coref_thresholds, all_coref_mappings)
+    mutable_config.optimal_alignment = optimal_alignment
+
+    if type_white_list is not None:
+        state.white_listed_types = set(scorer.canonicalize_string(t) for t in type_white_list)
+
+    if sequencing:
+        mutable_config.eval_sequencing = True
+        config.no_script_validation = not script_validation
+        TemporalEval.open_archive(context)
+
+    state.system_id = system_id
+
+    attribute_comb = scorer.get_attr_combinations(Config.attribute_names)
+
+    for doc_id in sorted(gold_documents):
+        gold_mentions, gold_relations = gold_documents[doc_id]
+        system_mentions, system_relations = system_documents.get(doc_id, ([], []))
+        scorer.evaluate_document(context, doc_id, system_id, get_mention_table(context, gold_mentions),
+                                 get_mention_table(context, system_mentions), gold_relations, system_relations,
+                                 attribute_comb, coreference)
+
+    if coreference:
+        set_coref_scores(state)
+
+    if sequencing:
+        TemporalEval.eval_time_ml(context)
+
+    return scorer.get_structured_results(context, attribute_comb)
@@ -7,8 +7,11 @@
     calling the functions and checking the return values might be a better way, a standalone tester like this is easier
 """
 import glob
+import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 
 
@@ -22,16 +25,32 @@ class Config:
     test_log_output = "test.log"
 
     conll_scorer_executable = "./reference-coreference-scorers-8.01/scorer.pl"
+    converter_executable = "util/brat2tbf.py"
+    rich_ere_converter_executable = "util/rich_ere2tbf.py"
+    validator_executable = "validator.py"
+    pack_executable = "gold_pack.py"
+    significance_executable = "significance.py"
+    batch_executable = "batch_eval.py"
 
     # Test types.
     mention_detection_tests = "mention_detection_tests"
     conll_tests = "conll_tests"
     wrong_format_tests = "wrong_format_tests"
+    conversion_tests = "conversion_tests"
+    consistency_tests = "consistency_tests"
+    api_tests = "api_tests"
+    validator_tests = "validator_tests"
+    batch_tests = "batch_tests"
 
     # Test cases for each type.
     detection_test_cases = os.path.join(test_base, mention_detection_tests)
     conll_test_cases = os.path.join(test_base, conll_tests)
     wrong_format_test_cases = os.path.join(test_base, wrong_format_tests)
+    conversion_test_cases = os.path.join(test_base, conversion_tests)
+    consistency_test_cases = os.path.join(test_base, consistency_tests)
+    char_demo = "data/scoring_demo/char_based"
+    token_demo = "data/scoring_demo/token_based"
+    rich_ere_data = "util/converter/data"
 
     # Suffix of test cases.
     tbf_response_suffix = ".response.tbf"
@@ -40,6 +59,10 @@ class Config:
     conll_key_suffix = ".key.conll"
     format_test_suffix = ".reason"
     mention_test_suffix = ".score"
+    conversion_expected = "expected.tbf"
+    rich_ere_tests = "rich_ere"
+    consistency_key = "gold.key.tbf"
+    consistency_response = "system.response.tbf"
 
 
 def run_scorer(gold_path, system_path, token_path, result_out, coref_log):
@@ -62,6 +85,42 @@ def run_scorer(gold_path, system_path, token_path, result_out, coref_log):
     return " ".join(cmd)
 
 
+def run_scorer_with_args(args, log_path):
+    """
+        Run the scorer script with the given arguments, the outputs are given in the arguments
+    :param args: The arguments of the scorer
+    :param log_path: Path to output the log of the scorer
+    :return: The command and its exit status
+    """
+    cmd = ["python", Config.scorer_executable] + args
+
+    with open(log_path, 'wb', 0) as out_file:
+        status = subprocess.call(cmd, stdout=out_file, stderr=subprocess.STDOUT)
+    return " ".join(cmd), status
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def split_documents(tbf_path, doc_ids, out_path):
+    """
+        Write the documents of the TBF file to a new file
+    :param tbf_path: The path to the TBF file
+    :param doc_ids: The ids of the documents to be written
+    :param out_path: Path to output the documents
+    :return:
+    """
+    doc_id = None
+    with open(tbf_path) as f, open(out_path, 'w') as out:
+        for l in f:
+            if l.startswith("#BeginOfDocument"):
+                doc_id = l.split()[1]
+            if doc_id in doc_ids:
+                out.write(l)
+
+
 def extract_key_metrics(result_out, coref_log):
     pass
 
@@ -118,6 +177,9 @@ class ScorerTest:
         print "Running mention tests"
 
     def conll_result_check(self, conll_out_reference, conll_out_test):
+        # The scorer does not write the CoNLL output if it quits with error.
+        if not (os.path.isfile(conll_out_reference) and os.path.isfile(conll_out_test)):
+            return False
         return cmp(self.get_conll_scores(conll_out_reference), self.get_conll_scores(conll_out_test)) == 0
 
     @staticmethod
@@ -226,11 +288,884 @@ class ScorerTest:
                 else:
                     self.record_fail("Test [%s] is not passed, expected format error not found in output." % f)
 
+    def run_validator(self, name, system_path, *args):
+        """
+        Run the validator in its own directory under the temporary directory, where it writes the error log.
+        :return: The exit status and the content of the error log.
+        """
+        run_dir = os.path.dirname(self.prepare_temp_file(Config.validator_tests, name, "validator.log"))
+        error_log = os.path.join(run_dir, os.path.basename(system_path) + ".errlog")
+        if os.path.isfile(error_log):
+            os.remove(error_log)
+
+        cmd = ["python", os.path.abspath(Config.validator_executable), "-s", os.path.abspath(system_path)] + list(args)
+        self.logger.info("Test command is  : %s" % " ".join(cmd))
+        with open(os.path.join(run_dir, "validator.log"), 'w') as out:
+            status = subprocess.call(cmd, cwd=run_dir, stdout=out, stderr=subprocess.STDOUT)
+
+        with open(error_log) as f:
+            return status, f.read()
+
+    def run_validator_tests(self, wrong_format_test_dir):
+        """
+        Run the validator on the wrong format test cases, in parallel the results should be the same as sequentially.
+        The check level and the maximum number of errors should limit the validation.
+        :param wrong_format_test_dir:
+        :return:
+        """
+        self.logger.info("Running validator tests.")
+        print "Running validator tests."
+        token_path = os.path.abspath(os.path.join(wrong_format_test_dir, "tkn"))
+        token_args = ["-tm", "-t", token_path]
+
+        mismatches = []
+        for f in sorted(glob.glob(os.path.join(wrong_format_test_dir, "*.tbf"))):
+            basename = os.path.basename(f)
+            statuses = [self.run_validator("jobs_%d" % jobs, f, "-j", str(jobs), *token_args)[0] for jobs in [1, 2]]
+            if statuses[0] != statuses[1]:
+                mismatches.append(basename)
+        if len(mismatches) == 0:
+            self.record_pass()
+        else:
+            self.record_fail("Test [parallel validation] is not passed, exit status changes with 2 jobs for %s." %
+                             ", ".join(mismatches))
+
+        # The invented token and the invented mention in a relation are only found from the token and the coreference
+        # levels.
+        for basename in ["system_with_invented_token.response.tbf", "invented_mention.response.tbf"]:
+            f = os.path.join(wrong_format_test_dir, basename)
+            format_status, _ = self.run_validator("format_level", f, "-cl", "format", *token_args)
+            full_status, _ = self.run_validator("all_levels", f, *token_args)
+            if format_status == 0 and full_status != 0:
+                self.record_pass()
+            else:
+                self.record_fail("Test [validation check level] is not passed, %s is not only valid in format." % f)
+
+        # The same invalid document repeated, the validation should stop after the errors in the first one.
+        repeated = self.prepare_temp_file(Config.validator_tests, "repeated.tbf")
+        repeated_tokens = os.path.dirname(self.prepare_temp_file(Config.validator_tests, "tkn", "example.tab"))
+        with open(os.path.join(wrong_format_test_dir, "invented_mention.response.tbf")) as f:
+            invalid_doc = f.read()
+        with open(repeated, 'w') as out:
+            for index in range(3):
+                out.write(invalid_doc.replace("example", "example_%d" % index))
+                with open(os.path.join(token_path, "example.tab")) as tokens, open(
+                        os.path.join(repeated_tokens, "example_%d.tab" % index), 'w') as token_out:
+                    token_out.write(tokens.read())
+
+        for jobs in [1, 2]:
+            status, error_log = self.run_validator("max_errors_%d" % jobs, repeated, "-me", "1", "-j", str(jobs), "-tm",
+                                                   "-t", os.path.abspath(repeated_tokens))
+            if status != 0 and "Stop validation after finding" in error_log and (
+                    jobs > 1 or "example_2" not in error_log):
+                self.record_pass()
+            else:
+                self.record_fail("Test [validation max errors] is not passed, validation does not stop early with %d "
+                                 "jobs." % jobs)
+
+        # A document without mentions that is missing in the evaluation pack.
+        pack = self.prepare_temp_file(Config.validator_tests, "example.pack")
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(["python", Config.pack_executable, "-g",
+                             os.path.join(wrong_format_test_dir, "correct_example.key.tbf"), "-t", token_path, "-o",
+                             pack], stdout=devnull, stderr=subprocess.STDOUT)
+        not_in_pack = self.prepare_temp_file(Config.validator_tests, "not_in_pack.tbf")
+        with open(os.path.join(wrong_format_test_dir, "correct_example.key.tbf")) as f, open(not_in_pack, 'w') as out:
+            out.write(f.read())
+            out.write("#BeginOfDocument not_in_pack\n#EndOfDocument\n")
+        status, _ = self.run_validator("not_in_pack", not_in_pack, "-tm", "-gp", os.path.abspath(pack))
+        if status != 0:
+            self.record_pass()
+        else:
+            self.record_fail("Test [validation with pack] is not passed, missing document in the pack is accepted.")
+
+    def run_conversion_tests(self, conversion_test_dir):
+        """
+        Run the Brat converter on the annotation files, sequentially and in parallel, both outputs should be the same
+        as the expected output. Some of the mentions cannot be found in the token files (one token file is missing),
+        they should be removed together with their relations.
+        :param conversion_test_dir:
+        :return:
+        """
+        self.logger.info("Running conversion tests.")
+        print "Running conversion tests."
+        expected = os.path.join(conversion_test_dir, Config.conversion_expected)
+
+        for jobs in [1, 2]:
+            out = self.prepare_temp_file(Config.conversion_tests, "converted_%d" % jobs)
+            cmd = ["python", Config.converter_executable, "-d", os.path.join(conversion_test_dir, "ann"), "-t",
+                   os.path.join(conversion_test_dir, "tkn"), "-o", out, "-w", "-j", str(jobs)]
+            self.logger.info("Test command is  : %s" % " ".join(cmd))
+
+            with open(os.devnull, 'w') as devnull:
+                status = subprocess.call(cmd, stderr=devnull)
+
+            if status == 0 and open(out + ".tbf").read() == open(expected).read():
+                self.record_pass()
+            else:
+                self.record_fail("Conversion with %d jobs is not the same as %s." % (jobs, expected))
+
+        self.check_rich_ere_conversion(os.path.join(conversion_test_dir, Config.rich_ere_tests))
+
+    def check_rich_ere_conversion(self, rich_ere_test_dir):
+        """
+        Run the Rich ERE converter on the sample annotation files, in character and token mode, and on a file with
+        invalid ids, where the invalid mentions and hoppers should be skipped. The outputs should be the same as the
+        expected outputs.
+        :param rich_ere_test_dir:
+        :return:
+        """
+        cases = [
+            ("character", Config.rich_ere_data, [], "expected_char.tbf"),
+            ("token", Config.rich_ere_data, ["-t", os.path.join(rich_ere_test_dir, "tkn")], "expected_token.tbf"),
+            ("invalid ids", os.path.join(rich_ere_test_dir, "invalid"), [], "expected_invalid.tbf"),
+        ]
+
+        for name, annotation_dir, args, expected_name in cases:
+            expected = os.path.join(rich_ere_test_dir, expected_name)
+            out = self.prepare_temp_file(Config.conversion_tests, "rich_ere_" + expected_name[:-len(".tbf")])
+            cmd = ["python", Config.rich_ere_converter_executable, "-d", annotation_dir, "-o", out, "-w"] + args
+            self.logger.info("Test command is  : %s" % " ".join(cmd))
+
+            with open(os.devnull, 'w') as devnull:
+                status = subprocess.call(cmd, stderr=devnull)
+
+            if status == 0 and open(out + ".tbf").read() == open(expected).read():
+                self.record_pass()
+            else:
+                self.record_fail("Rich ERE conversion in %s mode is not the same as %s." % (name, expected))
+
+    def run_consistency_tests(self, consistency_test_dir):
+        """
+        Run through the test cases that score the same key-response pair in different ways, the results should be
+        consistent with each other.
+        :param consistency_test_dir:
+        :return:
+        """
+        self.logger.info("Running consistency tests.")
+        print "Running consistency tests."
+        key = os.path.join(consistency_test_dir, Config.consistency_key)
+        response = os.path.join(consistency_test_dir, Config.consistency_response)
+
+        self.check_json_results(key, response)
+        self.check_alignment_dump(key, response)
+        self.check_optimal_alignment(key, response)
+        self.check_coref_metrics(key, response)
+
+        # The reference scorer runs separately for each metric (including the skipped ones), the results are the same
+        # as running them all at once.
+        self.check_same_scores("parallel coreference", key, response, self.coref_args("parallel") + ["-pc", "-ss"],
+                               self.coref_args("single"))
+
+        # The documents are split into shards scored separately, the counts of the shards are summed.
+        self.check_same_scores("sharded coreference", key, response, self.coref_args("sharded") + ["-cs", "2"],
+                               self.coref_args("single"))
+        self.check_same_scores("parallel sharded coreference", key, response,
+                               self.coref_args("parallel_sharded") + ["-cs", "3", "-pc", "-ss"],
+                               self.coref_args("single"))
+
+        # The sweep scores coreference in process, the counts should be the same as the reference scorer at each
+        # threshold.
+        self.check_coref_sweep("coreference threshold sweep", key, response, ["-cts", "0", "0.5", "1.0"],
+                               [({"mapping": "mention_type", "threshold": t}, ["-ct", str(t)]) for t in
+                                [0, 0.5, 1.0]])
+        self.check_coref_sweep("all coreference mappings", key, response, ["-am"],
+                               [({"mapping": mapping}, ["-m", str(index)]) for index, mapping in
+                                enumerate(["span_only", "mention_type", "realis_status",
+                                           "mention_type+realis_status"])])
+
+        self.check_gold_pack("char pack", key, response)
+        self.check_gold_pack("token pack", os.path.join(Config.token_demo, "gold.tbf"),
+                             os.path.join(Config.token_demo, "sample_system_A.tbf"),
+                             os.path.join(Config.token_demo, "tkn"))
+
+        self.check_sequencing_archive(os.path.join(Config.char_demo, "gold.tbf"),
+                                      os.path.join(Config.char_demo, "temporal_sample.tbf"))
+
+        # The reference scorer runs in the background while the sequencing is evaluated, the results are the same as
+        # running them one after another.
+        for test_name, args in [("pipelined coreference", ["-pl"]),
+                                ("pipelined parallel coreference", ["-pl", "-pc", "-ss"])]:
+            name = test_name.replace(" ", "_")
+            self.check_same_scores(test_name, os.path.join(Config.char_demo, "gold.tbf"),
+                                   os.path.join(Config.char_demo, "temporal_sample.tbf"),
+                                   self.coref_args(name) + ["-a", self.sequencing_dir(name)] + args,
+                                   self.coref_args(name + "_reference") + ["-a",
+                                                                           self.sequencing_dir(name + "_reference")])
+
+        self.check_significance(key, response)
+
+        self.check_stats_merge(key, response, [["doc1", "doc2"], ["doc3", "doc4", "doc5"]])
+        self.check_checkpoint_resume(key, response)
+
+    def score(self, name, key, response, *args):
+        """
+        Score the response into a score report and a JSON result in the temporary directory.
+        :return: The score report and the JSON result, or None if the scorer fails.
+        """
+        score_out = self.prepare_temp_file(Config.consistency_tests, name + ".score_tmp")
+        json_out = self.prepare_temp_file(Config.consistency_tests, name + ".json")
+        log = self.prepare_temp_file(Config.consistency_tests, name + ".log")
+        command_run, status = run_scorer_with_args(
+            ["-g", key, "-s", response, "-o", score_out, "-jo", json_out] + list(args), log)
+        self.logger.info("Test command is  : %s" % command_run)
+        if status != 0:
+            return None
+        with open(score_out) as f:
+            return f.read(), read_json(json_out)
+
+    def score_to_json(self, name, key, response, *args):
+        scores = self.score(name, key, response, *args)
+        return None if scores is None else scores[1]
+
+    def check_same_scores(self, test_name, key, response, args, reference_args):
+        """
+        Scoring with the arguments should produce the same score report and JSON result as with the reference
+        arguments.
+        """
+        scores = self.score(test_name.replace(" ", "_"), key, response, *args)
+        reference_scores = self.score(test_name.replace(" ", "_") + "_reference", key, response, *reference_args)
+        if scores is not None and scores == reference_scores:
+            self.record_pass()
+        else:
+            self.record_fail("Test [%s] is not passed, scores are not the same as [%s]." % (
+                test_name, " ".join(reference_args)))
+
+    def check_coref_sweep(self, test_name, key, response, sweep_args, reference_runs):
+        """
+        Each entry of the coreference sweep should have the same counts and scores as the reference scorer run
+        separately with its arguments.
+        :param reference_runs: The fields that select one sweep entry, and the arguments of the corresponding run.
+        """
+        name = test_name.replace(" ", "_")
+        results = self.score_to_json(name, key, response, *sweep_args)
+        if results is None or "coreference_sweep" not in results:
+            self.record_fail("Test [%s] is not passed, scorer failed." % test_name)
+            return
+
+        passed = len(results["coreference_sweep"]) == len(reference_runs)
+        for index, (selector, args) in enumerate(reference_runs):
+            entries = [entry for entry in results["coreference_sweep"] if
+                       all(entry[field] == value for field, value in selector.iteritems())]
+            reference = self.score_to_json("%s_reference%d" % (name, index), key, response,
+                                           *(self.coref_args("%s_reference%d" % (name, index)) + args))
+            if len(entries) != 1 or reference is None:
+                passed = False
+                continue
+
+            metrics = entries[0]["metrics"]
+            reference_metrics = reference["coreference"]["metrics"]
+            passed &= set(metrics) == set(reference_metrics)
+            for metric, reference_metric in reference_metrics.iteritems():
+                # The reference scorer truncates the scores to two decimals.
+                passed &= metric in metrics and 0 <= metrics[metric]["f1"] - reference_metric["f1"] < 0.01 + 1e-9
+                if metric == "blanc":
+                    for links, reference_name in [("coreference_links", "Coreference links"),
+                                                  ("non_coreference_links", "Non-coreference links")]:
+                        passed &= self.same_counts(metrics[metric][links], reference_metric["details"][reference_name])
+                elif metric in metrics:
+                    passed &= self.same_counts(metrics[metric], reference_metric["details"]["Coreference"])
+
+        if passed:
+            self.record_pass()
+        else:
+            self.record_fail("Test [%s] is not passed, scores are not the same as the separate runs." % test_name)
+
+    def check_gold_pack(self, test_name, key, response, token_path=None):
+        """
+        Scoring with the evaluation pack compiled from the key should produce the same score report and JSON result as
+        with the key itself. The pack is token based if the token path is provided.
+        """
+        name = test_name.replace(" ", "_")
+        pack = self.prepare_temp_file(Config.consistency_tests, name + ".pack")
+        token_args = [] if token_path is None else ["-t", token_path]
+
+        cmd = ["python", Config.pack_executable, "-g", key, "-o", pack] + token_args
+        self.logger.info("Test command is  : %s" % " ".join(cmd))
+        with open(self.prepare_temp_file(Config.consistency_tests, name + "_compile.log"), 'w') as out:
+            status = subprocess.call(cmd, stdout=out, stderr=subprocess.STDOUT)
+
+        # The token ids of the gold standard are taken from the pack.
+        scores = self.score(name, pack, response, *self.coref_args(name))
+        reference_scores = self.score(name + "_reference", key, response,
+                                      *(self.coref_args(name + "_reference") + token_args))
+        if status == 0 and scores is not None and scores == reference_scores:
+            self.record_pass()
+        else:
+            self.record_fail("Test [%s] is not passed, scores are not the same as with %s." % (test_name, key))
+
+    def sequencing_dir(self, name):
+        return os.path.dirname(self.prepare_temp_file(Config.consistency_tests, name, "seq"))
+
+    def check_sequencing_archive(self, key, response):
+        """
+        Storing the TimeML files in an archive should produce the same sequencing scores, and the same evaluator
+        outputs, as writing them as separate files.
+        """
+        archive_dir = self.sequencing_dir("archive_sequencing")
+        files_dir = self.sequencing_dir("files_sequencing")
+
+        scores = self.score("archive_sequencing", key, response, "-a", archive_dir, "-sa")
+        reference_scores = self.score("files_sequencing", key, response, "-a", files_dir)
+
+        same_outputs = True
+        for link_type in ["After", "Subevent", "All"]:
+            archive_output = os.path.join(archive_dir, link_type, "seq.out")
+            files_output = os.path.join(files_dir, link_type, "seq.out")
+            if not (os.path.isfile(archive_output) and os.path.isfile(files_output)) or open(
+                    archive_output).read() != open(files_output).read():
+                same_outputs = False
+
+        if scores is not None and scores == reference_scores and same_outputs:
+            self.record_pass()
+        else:
+            self.record_fail("Test [sequencing archive] is not passed, scores are not the same as separate TimeML "
+                             "files.")
+
+    @staticmethod
+    def read_significance(path):
+        """
+        Read the significance report.
+        :return: Map from metric name to the (score, low, high) of each run, and the p-value of each pair of runs.
+        """
+        results = {}
+        with open(path) as f:
+            for l in f:
+                l = l.strip()
+                if l.startswith("======="):
+                    scores = {}
+                    p_values = {}
+                    results[l.strip("=")] = scores, p_values
+                elif "\tp-value\t" in l:
+                    fields = l.split("\t")
+                    p_values[tuple(fields[0].split(" vs. "))] = float(fields[-1])
+                elif l.endswith("]"):
+                    fields = l.split("\t")
+                    low, high = fields[2].strip("[]").split(", ")
+                    scores[fields[0].strip()] = float(fields[1]), float(low), float(high)
+        return results
+
+    def check_significance(self, key, response):
+        """
+        A run compared with itself should get a p-value of 1, and a clearly better run (the key itself) a small p-value
+        in the paired bootstrap, whose confidence intervals should contain the scores. The p-values of both methods are
+        never 0.
+        """
+        runs = []
+        for name, run_response in [("run", response), ("same_run", response), ("perfect_run", key)]:
+            self.score(name, key, run_response, *self.coref_args(name))
+            runs.append(self.prepare_temp_file(Config.consistency_tests, name + ".json"))
+
+        passed = True
+        for method in ["bootstrap", "randomization"]:
+            out = self.prepare_temp_file(Config.consistency_tests, "significance_%s.txt" % method)
+            cmd = ["python", Config.significance_executable, "-r"] + runs + ["-n", "1000", "-m", method, "-o", out]
+            self.logger.info("Test command is  : %s" % " ".join(cmd))
+            with open(os.devnull, 'w') as devnull:
+                status = subprocess.call(cmd, stdout=devnull, stderr=devnull)
+            if status != 0:
+                passed = False
+                continue
+
+            results = self.read_significance(out)
+            # The mention and coreference metrics, and the CoNLL average.
+            if len(results) < 10:
+                passed = False
+            for metric, (scores, p_values) in results.iteritems():
+                if p_values.get(("run.json", "same_run.json")) != 1.0 or min(p_values.values()) <= 0:
+                    self.logger.error("Unexpected p-values of %s with %s: %s" % (metric, method, p_values))
+                    passed = False
+                if method != "bootstrap":
+                    continue
+                if p_values.get(("run.json", "perfect_run.json")) >= 0.05:
+                    self.logger.error("Perfect run is not significantly better in %s: %s" % (metric, p_values))
+                    passed = False
+                for score, low, high in scores.values():
+                    if not low <= score <= high:
+                        self.logger.error("Score is not in the confidence interval of %s: %s" % (metric, scores))
+                        passed = False
+
+        if passed:
+            self.record_pass()
+        else:
+            self.record_fail("Test [significance] is not passed, p-values or confidence intervals are not expected.")
+
+    def coref_args(self, name):
+        return ["-c", self.prepare_temp_file(Config.consistency_tests, name + ".conll_log")]
+
+    def check_stats_merge(self, key, response, shard_doc_ids):
+        """
+        The statistics of the shards of documents are emitted separately, merging them should produce the same results
+        as scoring all the documents at once, including the coreference sweep.
+        """
+        sweep_args = ["-cts", "0.5", "1.0"]
+
+        all_stats = []
+        for index, doc_ids in enumerate(shard_doc_ids):
+            # The system id is the name of the response file, so the shards keep the same name.
+            shard_key = self.prepare_temp_file(Config.consistency_tests, "shard%d" % index, Config.consistency_key)
+            shard_response = self.prepare_temp_file(Config.consistency_tests, "shard%d" % index,
+                                                    Config.consistency_response)
+            split_documents(key, doc_ids, shard_key)
+            split_documents(response, doc_ids, shard_response)
+
+            stats = self.prepare_temp_file(Config.consistency_tests, "shard%d" % index, "eval.stats")
+            if self.score("shard%d" % index, shard_key, shard_response,
+                          *(self.coref_args("shard%d" % index) + sweep_args + ["-es", stats])) is None:
+                self.record_fail("Test [statistics merge] is not passed, scorer failed on shard %d." % index)
+                return
+            all_stats.append(stats)
+
+        score_out = self.prepare_temp_file(Config.consistency_tests, "merged.score_tmp")
+        json_out = self.prepare_temp_file(Config.consistency_tests, "merged.json")
+        command_run, status = run_scorer_with_args(["-ms"] + all_stats + ["-o", score_out, "-jo", json_out] +
+                                                   self.coref_args("merged"),
+                                                   self.prepare_temp_file(Config.consistency_tests, "merged.log"))
+        self.logger.info("Test command is  : %s" % command_run)
+
+        reference_scores = self.score("merge_reference", key, response, *(self.coref_args("merge_reference") +
+                                                                            sweep_args))
+        if status == 0 and (open(score_out).read(), read_json(json_out)) == reference_scores:
+            self.record_pass()
+        else:
+            self.record_fail("Test [statistics merge] is not passed, merged scores are not the same as scoring all "
+                             "documents at once.")
+
+    def check_checkpoint_resume(self, key, response):
+        """
+        The scorer is interrupted by a broken response after saving some checkpoints, resuming it with the correct
+        response should produce the same outputs as an uninterrupted evaluation.
+        """
+        # The system id is the name of the response file, so the broken copy keeps the same name.
+        broken_response = self.prepare_temp_file(Config.consistency_tests, "interrupted", Config.consistency_response)
+        with open(response) as f, open(broken_response, 'w') as out:
+            for l in f:
+                fields = l.split("\t")
+                if len(fields) > 3 and fields[1] == "doc4" and fields[2] == "E41":
+                    fields[3] = fields[3].replace(",", "-")
+                out.write("\t".join(fields))
+
+        checkpoint = self.prepare_temp_file(Config.consistency_tests, "interrupted", "eval.checkpoint")
+        if os.path.isfile(checkpoint):
+            os.remove(checkpoint)
+
+        def resume_args(name):
+            return self.coref_args(name) + ["-cp", checkpoint, "-ci", "1", "-d",
+                                            self.prepare_temp_file(Config.consistency_tests, name + ".diff")]
+
+        interrupted = self.score("resumed", key, broken_response, *resume_args("resumed"))
+        if interrupted is not None or not os.path.isfile(checkpoint):
+            self.record_fail("Test [checkpoint resume] is not passed, scorer is not interrupted after a checkpoint.")
+            return
+
+        # A checkpoint interrupted while being written is discarded.
+        with open(checkpoint, 'a') as out:
+            out.write('{"version": ')
+
+        scores = self.score("resumed", key, response, *resume_args("resumed"))
+        reference_scores = self.score("resume_reference", key, response, *(self.coref_args("resume_reference") + [
+            "-d", self.prepare_temp_file(Config.consistency_tests, "resume_reference.diff")]))
+
+        with open(self.prepare_temp_file(Config.consistency_tests, "resumed.diff")) as f:
+            diff = f.read()
+        with open(self.prepare_temp_file(Config.consistency_tests, "resume_reference.diff")) as f:
+            reference_diff = f.read()
+
+        if scores is not None and scores == reference_scores and diff == reference_diff and not os.path.isfile(
+                checkpoint):
+            self.record_pass()
+        else:
+            self.record_fail("Test [checkpoint resume] is not passed, resumed outputs are not the same as an "
+                             "uninterrupted evaluation.")
+
+    @staticmethod
+    def read_report_sections(report):
+        """
+        Split the score report into its sections.
+        :return: A map from the section title to its non empty lines.
+        """
+        sections = {}
+        lines = None
+        for line in report.splitlines():
+            title = re.match(r"^=+(.+?)=+$", line)
+            if title:
+                lines = sections.setdefault(title.group(1), [])
+            elif lines is not None and line.strip():
+                lines.append(line)
+        return sections
+
+    @staticmethod
+    def same_printed(printed, value, scale=1):
+        """
+        Compare a score printed with two decimals to the JSON value, NaN is printed for the undefined scores.
+        """
+        if printed == "nan":
+            return value is None
+        return value is not None and abs(float(printed) * scale - value) <= 0.005 * scale + 1e-9
+
+    def check_json_results(self, key, response):
+        """
+        The JSON result should contain all the fields, with the same scores and counts as printed in the score report.
+        """
+        scores = self.score("json", key, response, *self.coref_args("json"))
+        if scores is None:
+            self.record_fail("Test [JSON results] is not passed, scorer failed.")
+            return
+        report, results = scores
+        sections = self.read_report_sections(report)
+
+        score_fields = ["precision", "recall", "f1"]
+        passed = set(results) == {"system_id", "num_documents", "num_valid_documents", "num_gold", "num_system",
+                                  "documents", "types", "micro_average", "macro_average", "coreference"}
+        passed &= results["system_id"] == os.path.basename(response)
+
+        def check(printed_values, score_map, scale=1):
+            return len(printed_values) == len(score_fields) and all(
+                self.same_printed(printed, score_map[field], scale) for printed, field in
+                zip(printed_values, score_fields))
+
+        def values(line):
+            return [field.strip() for field in line.split("\t") if field.strip() not in ("", "|")]
+
+        # The score names are in the header, the second header line names the columns.
+        doc_lines = sections["Document Mention Detection Results"]
+        score_names = values(doc_lines[0])
+        documents = dict((doc["doc_id"], doc) for doc in results["documents"])
+        passed &= len(documents) == results["num_documents"] == len(doc_lines) - 2
+        for line in doc_lines[2:]:
+            fields = values(line)
+            doc_scores = documents[fields[0]]["scores"]
+            passed &= set(doc_scores) == set(score_names)
+            for index, name in enumerate(score_names):
+                passed &= check(fields[1 + 3 * index: 4 + 3 * index], doc_scores[name])
+        passed &= sum(doc["num_gold"] for doc in documents.itervalues()) == results["num_gold"]
+        passed &= sum(doc["num_system"] for doc in documents.itervalues()) == results["num_system"]
+
+        # Per type scores are printed as fractions.
+        type_lines = sections["Mention Type Results"]
+        passed &= len(results["types"]) == len(type_lines) - 1
+        for line in type_lines[1:]:
+            fields = values(line)
+            type_scores = results["types"][fields[0]]
+            passed &= check(fields[1:4], type_scores, 100)
+            passed &= [type_scores["num_gold"], type_scores["num_system"]] == [int(x) for x in fields[4:6]]
+
+        average_lines = sections["Final Mention Detection Results"]
+        passed &= len(average_lines) - 2 == len(score_names)
+        for line in average_lines[2:]:
+            fields = values(line)
+            passed &= check(fields[1:4], results["micro_average"][fields[0]])
+            passed &= check(fields[4:7], results["macro_average"][fields[0]])
+
+        coreference = results["coreference"]
+        for line in sections["Document Mention Corefrence Results (CoNLL Average)"]:
+            doc_id, printed = values(line)
+            passed &= any(doc["doc_id"] == doc_id and self.same_printed(printed, doc["conll_average"]) for doc in
+                          coreference["documents"])
+
+        coref_lines = sections["Final Mention Coreference Results"]
+        metric_lines = [line for line in coref_lines if line.startswith("Metric : ")]
+        passed &= len(metric_lines) == len(coreference["metrics"])
+        for line in metric_lines:
+            fields = values(line[len("Metric : "):])
+            metric = coreference["metrics"][fields[0]]
+            passed &= self.same_printed(fields[2].rstrip(" *"), metric["f1"])
+            passed &= metric["in_average"] == (not fields[2].endswith("*"))
+        passed &= any(values(line)[-1:] and self.same_printed(values(line)[-1], coreference["conll_average"]) for
+                      line in coref_lines if line.startswith("Overall Average CoNLL score"))
+
+        if passed:
+            self.record_pass()
+        else:
+            self.record_fail("Test [JSON results] is not passed, JSON results are not the same as the score report.")
+
+    @staticmethod
+    def read_tbf_mentions(tbf_path):
+        """
+        Read the mention lines of a TBF file.
+        :return: A map from (doc id, mention id) to the span and the text.
+        """
+        mentions = {}
+        with open(tbf_path) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if line.startswith("#") or line.startswith("@") or len(fields) < 5:
+                    continue
+                mentions[(fields[1], fields[2])] = (fields[3], fields[4])
+        return mentions
+
+    def check_alignment_dump(self, key, response):
+        """
+        Every gold and system mention should be dumped once for each attribute combination with its span and text,
+        and the scores of the alignments of each document should sum up to the true positives in the JSON result.
+        """
+        dump = self.prepare_temp_file(Config.consistency_tests, "alignment_dump.npz")
+        results = self.score_to_json("alignment_dump", key, response, "-ad", dump)
+        if results is None:
+            self.record_fail("Test [alignment dump] is not passed, scorer failed.")
+            return
+
+        import numpy
+        columns = numpy.load(dump)
+
+        tbf_mentions = [("gold", self.read_tbf_mentions(key)), ("system", self.read_tbf_mentions(response))]
+
+        passed = True
+        for doc in results["documents"]:
+            for combination, scores in doc["scores"].iteritems():
+                rows = (columns["doc_id"] == doc["doc_id"]) & (columns["combination"] == combination)
+                passed &= abs(columns["score"][rows].sum() - scores["tp"]) < 1e-9
+
+                for side, all_mentions in tbf_mentions:
+                    mentions = dict((mention_id, mention) for (doc_id, mention_id), mention in
+                                    all_mentions.iteritems() if doc_id == doc["doc_id"])
+                    dumped = [(mention_id, (span, text)) for index, mention_id, span, text in
+                              zip(*[columns["%s_%s" % (side, name)][rows] for name in
+                                    ["index", "mention_id", "span", "text"]]) if index >= 0]
+                    passed &= len(dumped) == len(mentions) and dict(dumped) == mentions
+
+        if passed:
+            self.record_pass()
+        else:
+            self.record_fail("Test [alignment dump] is not passed, dumped alignments are not the same as the input.")
+
+    def check_optimal_alignment(self, key, response):
+        """
+        The optimal alignment should find at least the true positives of the greedy alignment in every document, and
+        more in the document where the greedy one is not optimal.
+        """
+        greedy = self.score_to_json("greedy", key, response)
+        optimal = self.score_to_json("optimal", key, response, "-oa")
+        if greedy is None or optimal is None:
+            self.record_fail("Test [optimal alignment] is not passed, scorer failed.")
+            return
+
+        greedy_tps = dict((doc["doc_id"], doc["scores"]["plain"]["tp"]) for doc in greedy["documents"])
+        num_improved = 0
+        passed = True
+        for gap in optimal.get("alignment_gaps", []):
+            greedy_tp = gap["greedy_tps"]["plain"]
+            optimal_tp = gap["optimal_tps"]["plain"]
+            if abs(greedy_tp - greedy_tps[gap["doc_id"]]) > 1e-9 or optimal_tp < greedy_tp - 1e-9:
+                passed = False
+            if optimal_tp > greedy_tp + 1e-9:
+                num_improved += 1
+
+        if passed and num_improved == 1 and optimal["micro_average"]["plain"]["f1"] > greedy["micro_average"]["plain"][
+                "f1"]:
+            self.record_pass()
+        else:
+            self.record_fail("Test [optimal alignment] is not passed, optimal alignment is not better than greedy.")
+
+    @staticmethod
+    def same_counts(counts, reference_counts):
+        """
+        Compare the recall and precision counts, the reference scorer prints the counts with limited precision.
+        """
+        for name in ["recall_numerator", "recall_denominator", "precision_numerator", "precision_denominator"]:
+            if abs(counts[name] - reference_counts[name]) > 1e-6 * max(1, abs(reference_counts[name])):
+                return False
+        return True
+
+    def check_coref_metrics(self, key, response):
+        """
+        The coreference counts computed in process for each document should be the same as the ones of the reference
+        scorer, and so are the sums of them.
+        """
+        results = self.score_to_json("coref", key, response, "-c",
+                                     self.prepare_temp_file(Config.consistency_tests, "coref.conll_log"))
+        if results is None:
+            self.record_fail("Test [in process coreference metrics] is not passed, scorer failed.")
+            return
+
+        coreference = results["coreference"]
+        doc_metrics = dict((doc["doc_id"], doc["metrics"]) for doc in coreference["documents"])
+        passed = len(doc_metrics) == results["num_documents"]
+
+        for metric, reference_docs in coreference["document_details"].iteritems():
+            totals = dict((name, 0) for name in ["recall_numerator", "recall_denominator", "precision_numerator",
+                                                 "precision_denominator"])
+            for doc_id, metrics in doc_metrics.iteritems():
+                if doc_id not in reference_docs or not self.same_counts(metrics[metric], reference_docs[doc_id]):
+                    self.logger.error("Coreference counts of %s in [%s] are not the same." % (metric, doc_id))
+                    passed = False
+                    continue
+                for name in totals:
+                    totals[name] += metrics[metric][name]
+            if not self.same_counts(totals, coreference["metrics"][metric]["details"]["Coreference"]):
+                self.logger.error("Summed coreference counts of %s are not the same." % metric)
+                passed = False
+
+        # The reference scorer only reports the link counts of BLANC in total.
+        blanc_details = coreference["metrics"]["blanc"]["details"]
+        for links, reference_name in [("coreference_links", "Coreference links"),
+                                      ("non_coreference_links", "Non-coreference links")]:
+            totals = dict((name, sum(metrics["blanc"][links][name] for metrics in doc_metrics.itervalues())) for name in
+                          ["recall_numerator", "recall_denominator", "precision_numerator", "precision_denominator"])
+            if not self.same_counts(totals, blanc_details[reference_name]):
+                self.logger.error("Summed BLANC %s are not the same." % reference_name)
+                passed = False
+
+        if passed:
+            self.record_pass()
+        else:
+            self.record_fail("Test [in process coreference metrics] is not passed, counts are not the same as the "
+                             "reference scorer.")
+
+    def run_api_tests(self, demo_dir):
+        """
+        Score the demo data with the API, the results should be the same as the JSON output of the scorer. The
+        documents that cannot be scored should raise errors instead of terminating the process.
+        :param demo_dir:
+        :return:
+        """
+        self.logger.info("Running API tests.")
+        print "Running API tests."
+        # The API loads the scorer in this process, so it is only imported when tested.
+        import scorer_api
+        import utils
+
+        gold_path = os.path.join(demo_dir, "gold.tbf")
+        gold, _ = scorer_api.read_documents(gold_path)
+
+        for basename, sequencing in [("system_A.tbf", False), ("temporal_sample.tbf", True)]:
+            system_path = os.path.join(demo_dir, basename)
+            name = basename[:-len(".tbf")]
+            json_out = self.prepare_temp_file(Config.api_tests, name + ".json")
+            args = ["-g", gold_path, "-s", system_path, "-jo", json_out, "-o",
+                    self.prepare_temp_file(Config.api_tests, name + ".score_tmp")]
+            if sequencing:
+                args += ["-a", self.prepare_temp_file(Config.api_tests, name + "_sequencing")]
+            command_run, status = run_scorer_with_args(args, self.prepare_temp_file(Config.api_tests, name + ".log"))
+            self.logger.info("Test command is  : %s" % command_run)
+
+            system, run_id = scorer_api.read_documents(system_path)
+            results = scorer_api.score(gold, system, system_id=run_id, sequencing=sequencing)
+            # The JSON output has lists instead of tuples.
+            if status == 0 and json.loads(json.dumps(results)) == read_json(json_out):
+                self.record_pass()
+            else:
+                self.record_fail("Test [API] is not passed, API results of %s are not the same as the scorer." %
+                                 system_path)
+
+        doc_id = "example2"
+        mentions, _ = gold[doc_id]
+        mention_ids = [m[0] for m in mentions]
+        bad_inputs = [
+            ("cyclic after links", {"sequencing": True},
+             [("After", "A1", mention_ids[:2]), ("After", "A2", [mention_ids[1], mention_ids[0]])]),
+            ("overlapping clusters", {"coreference": True},
+             [("Coreference", "C1", mention_ids[:2]), ("Coreference", "C2", mention_ids[1:3])]),
+        ]
+        for test_name, kwargs, relations in bad_inputs:
+            try:
+                scorer_api.score(gold, {doc_id: (mentions, relations)}, **kwargs)
+                self.record_fail("Test [API %s] is not passed, no error is raised." % test_name)
+            except utils.ScoringError:
+                self.record_pass()
+
+        try:
+            scorer_api.score(gold, gold, coref_mapping=len(scorer_api.Config.possible_coref_mapping))
+            self.record_fail("Test [API coreference mapping] is not passed, no error is raised.")
+        except ValueError:
+            self.record_pass()
+
+    def run_batch_tests(self, demo_dir):
+        """
+        Score the demo submissions of all tasks with the batch scorer. The summary should have the same scores as
+        running the scorer on each submission. Running it again should skip all the submissions, unless the scorer
+        arguments are changed.
+        :param demo_dir:
+        :return:
+        """
+        self.logger.info("Running batch scoring tests.")
+        print "Running batch scoring tests."
+        submission_dir = os.path.dirname(self.prepare_temp_file(Config.batch_tests, "submissions", "dummy"))
+        if os.path.exists(submission_dir):
+            shutil.rmtree(submission_dir)
+        result_dir = os.path.dirname(self.prepare_temp_file(Config.batch_tests, "results", "dummy"))
+        if os.path.exists(result_dir):
+            shutil.rmtree(result_dir)
+
+        gold_path = os.path.join(demo_dir, "gold.tbf")
+        shutil.copy(gold_path, self.prepare_temp_file(Config.batch_tests, "gold", "eng.tbf"))
+
+        # The scorer arguments of each task, for the separate runs.
+        submissions = [
+            ("nugget", "event-nugget-splitted", "system_A.tbf", lambda name: []),
+            ("coreference", "event-coref-splitted", "system_A.tbf", self.coref_args),
+            ("sequencing", "event-sequencing-splitted", "temporal_sample.tbf",
+             lambda name: ["-a", self.sequencing_dir(name)]),
+        ]
+
+        def score(value):
+            return "" if value is None else "%.2f" % value
+
+        expected_scores = {}
+        for task, task_dir, basename, task_args in submissions:
+            system_path = os.path.join(demo_dir, basename)
+            shutil.copy(system_path, self.prepare_temp_file(Config.batch_tests, "submissions", task_dir, "eng",
+                                                            basename))
+            results = self.score_to_json("batch_" + task, gold_path, system_path, *task_args("batch_" + task))
+            if results is None:
+                self.record_fail("Test [batch scoring] is not passed, scorer failed on %s." % system_path)
+                return
+
+            sequencing = results.get("sequencing", {})
+            expected_scores[(task, basename)] = [score(results["micro_average"][name]["f1"]) for name in
+                                                 ["plain", "mention_type", "realis_status",
+                                                  "mention_type+realis_status"]] + [
+                score(results["coreference"]["conll_average"]) if "coreference" in results else ""] + [
+                score(sequencing[t]["f1"]) if t in sequencing else "" for t in ["After", "Subevent"]]
+
+        def run_batch(run_name, *args):
+            cmd = ["python", Config.batch_executable, "-g",
+                   os.path.join(Config.test_temp, Config.batch_tests, "gold", "{language}.tbf"), "-s",
+                   submission_dir, "-r", result_dir, "-j", "2"] + list(args)
+            self.logger.info("Test command is  : %s" % " ".join(cmd))
+            with open(self.prepare_temp_file(Config.batch_tests, run_name + ".log"), 'w') as out:
+                status = subprocess.call(cmd, stdout=out, stderr=subprocess.STDOUT)
+
+            summary = {}
+            summary_path = os.path.join(result_dir, "summary.tsv")
+            if status == 0 and os.path.isfile(summary_path):
+                with open(summary_path) as f:
+                    for line in f.readlines()[1:]:
+                        fields = line.rstrip("\n").split("\t")
+                        summary[(fields[1], fields[2])] = (fields[0], fields[3], fields[4:])
+            return summary
+
+        def check_run(test_name, summary, expected_status, passed=True):
+            if passed and summary == dict((job, ("eng", expected_status, scores)) for job, scores in
+                                          expected_scores.iteritems()):
+                self.record_pass()
+            else:
+                self.record_fail("Test [%s] is not passed, the summary is not the same as the separate runs with "
+                                 "status [%s]." % (test_name, expected_status))
+
+        check_run("batch scoring", run_batch("first_run"), "done")
+
+        # The results are kept, while the submissions are not scored again.
+        json_paths = [os.path.join(result_dir, task, "eng", basename, "eval.json") for task, _, basename, _ in
+                      submissions]
+        modified_times = [os.path.getmtime(p) for p in json_paths if os.path.isfile(p)]
+        summary = run_batch("second_run")
+        check_run("batch scoring up to date", summary, "up to date",
+                  modified_times == [os.path.getmtime(p) for p in json_paths])
+
+        # The default threshold does not change the scores, but the changed command is scored again.
+        check_run("batch scoring arguments changed", run_batch("changed_run", "-sc", "-ct", "1.0"), "done")
+
     def run_all(self):
         self.logger.info("Start tests.")
         self.run_mention_detection_tests(Config.detection_test_cases)
         self.run_format_error_tests(Config.wrong_format_test_cases)
+        self.run_validator_tests(Config.wrong_format_test_cases)
         self.run_conll_tests(Config.conll_test_cases)
+        self.run_conversion_tests(Config.conversion_test_cases)
+        self.run_consistency_tests(Config.consistency_test_cases)
+        self.run_api_tests(Config.char_demo)
+        self.run_batch_tests(Config.char_demo)
         test_finish = self.test_finish_info()
         self.logger.info(test_finish)
         print test_finish
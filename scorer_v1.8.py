@@ -80,29 +80,57 @@
 import argparse
 import heapq
 import itertools
+import json
 import logging
 import math
 import os
 import re
 import sys
+import threading
 
+import alignment
 import utils
-from config import Config, MutableConfig, EvalMethod, EvalState
-from conll_coref import ConllEvaluator
-from temporal import TemporalEval
+from config import Config, EvalContext, EvalMethod
 
 logger = logging.getLogger()
 stream_handler = logging.StreamHandler(sys.stdout)
 stream_handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s : %(message)s'))
-logger.addHandler(stream_handler)
 
 
 def main():
+    parser = create_arg_parser()
+    args = parser.parse_args()
+
+    if args.merge_stats is None and (args.gold is None or args.system is None):
+        parser.error("The gold standard and the system output are required, unless statistics are merged.")
+
+    logger.addHandler(stream_handler)
+
+    if args.debug:
+        stream_handler.setLevel(logging.DEBUG)
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Entered debug mode.")
+    else:
+        stream_handler.setLevel(logging.INFO)
+        logger.setLevel(logging.INFO)
+
+    # The evaluation functions are shared with the API, which raises the errors to the caller instead of terminating.
+    try:
+        context = create_context(args)
+        if args.merge_stats is not None:
+            return merge_evaluation(context, args)
+        return run_evaluation(context, args)
+    except utils.ScoringError as e:
+        utils.terminate_on_error(e)
+
+
+def create_arg_parser():
     parser = argparse.ArgumentParser(
         description="Event mention scorer, provides support to Event Nugget scoring, Event Coreference and Event "
                     "Sequencing scoring.")
-    parser.add_argument("-g", "--gold", help="Golden Standard", required=True)
-    parser.add_argument("-s", "--system", help="System output", required=True)
+    parser.add_argument("-g", "--gold", help="Golden Standard, either a TBF file or an evaluation pack compiled by "
+                                             "gold_pack.py, required unless statistics are merged")
+    parser.add_argument("-s", "--system", help="System output, required unless statistics are merged")
     parser.add_argument("-d", "--comparison_output",
                         help="Compare and help show the difference between "
                              "system and gold")
@@ -117,6 +145,15 @@ def main():
     parser.add_argument(
         "-nv", "--no_script_validation", help="Whether to turn off script validation", action="store_true"
     )
+    parser.add_argument(
+        "-np", "--no_pretty_time_ml", help="Do not indent the TimeML files written for sequencing evaluation",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-sa", "--sequencing_archive", action="store_true",
+        help="Store all the TimeML files of sequencing evaluation in one zip archive under the sequencing output "
+             "directory, instead of one file per document and link type"
+    )
     parser.add_argument(
         "-t", "--token_path", help="Path to the directory containing the token mappings file, only used in token mode.")
     parser.add_argument(
@@ -131,8 +168,60 @@ def main():
         "-te", "--token_table_extension",
         help="any extension appended after docid of token table files. Default is [%s], only used in token mode."
              % Config.default_token_file_ext)
+    parser.add_argument(
+        "-pc", "--parallel_coref", action="store_true",
+        help="Run the reference coreference scorer as one process per metric in parallel, the metrics not included in "
+             "the CoNLL average (%s) are skipped." % ",".join(sorted(Config.skipped_metrics)))
+    parser.add_argument(
+        "-ss", "--score_skipped_metrics", action="store_true",
+        help="Also score the metrics not included in the CoNLL average when running the coreference scorer in "
+             "parallel.")
+    parser.add_argument(
+        "-cs", "--coref_shards", type=int,
+        help="Split the documents into this number of shards, which are scored by the reference coreference scorer in "
+             "parallel, the counts of the shards are merged into the overall scores.")
+    parser.add_argument(
+        "-pl", "--pipelined", action="store_true",
+        help="Run the reference coreference scorer in the background while the event sequencing is evaluated.")
     parser.add_argument("-ct", "--coreference_threshold", type=float, help="Threshold for coreference mention mapping")
+    parser.add_argument(
+        "-cts", "--coreference_thresholds", type=float, nargs="+",
+        help="A list of thresholds for coreference mention mapping, coreference is scored in process for each of them "
+             "in the same run, the reference scorer is not needed.")
+    parser.add_argument(
+        "-am", "--all_coref_mappings", action="store_true",
+        help="Score coreference in process with all the coreference mapping criteria in the same run, at the "
+             "coreference thresholds if provided.")
     parser.add_argument("-b", "--debug", help="turn debug mode on", action="store_true")
+    parser.add_argument(
+        "-jo", "--json_out", help="Optional machine readable evaluation result, write all the scores in JSON to this "
+                                  "path")
+    parser.add_argument(
+        "-ad", "--alignment_dump", help="Optional columnar dump of all the gold and system alignments, saved as a "
+                                        "NumPy .npz file at this path")
+    parser.add_argument(
+        "-es", "--emit_stats",
+        help="Optional path to write the sufficient statistics of all documents, the statistics of several evaluations "
+             "can be merged into one report with --merge_stats.")
+    parser.add_argument(
+        "-ms", "--merge_stats", nargs="+",
+        help="Merge the statistics files written by --emit_stats into one report, instead of evaluating. The "
+             "documents of each file should be different. The outputs (-o, -jo) are written as usual, the merged "
+             "coreference scorer output is written to the coreference output (-c) and the sequencing evaluator "
+             "outputs under the sequencing output (-a) if provided.")
+    parser.add_argument(
+        "-cp", "--checkpoint",
+        help="Optional path to save a checkpoint of the evaluation periodically, if the checkpoint exists, the "
+             "evaluation is resumed from it with the same arguments. The checkpoint is removed when the evaluation is "
+             "done.")
+    parser.add_argument(
+        "-ci", "--checkpoint_interval", type=int, default=Config.default_checkpoint_interval,
+        help="Number of documents evaluated between two checkpoints, default is %d."
+             % Config.default_checkpoint_interval)
+    parser.add_argument(
+        "-oa", "--optimal_alignment", action="store_true",
+        help="Use the optimal (maximum overlap) mention alignment instead of the greedy one. The difference between "
+             "the greedy and the optimal true positives will be reported.")
 
     # parser.add_argument("--eval_mode", choices=["char", "token"], default="char",
     #                     help="Use Span or Token mode. The Span mode will take a span as range [start:end], while the "
@@ -147,64 +236,236 @@ def main():
     )
 
     parser.set_defaults(debug=False)
-    args = parser.parse_args()
+    return parser
 
-    if args.debug:
-        stream_handler.setLevel(logging.DEBUG)
-        logger.setLevel(logging.DEBUG)
-        logger.debug("Entered debug mode.")
-    else:
-        stream_handler.setLevel(logging.INFO)
-        logger.setLevel(logging.INFO)
+
+def create_context(args):
+    """
+    Create the context of one evaluation from the command line arguments.
+    :param args: The parsed command line arguments.
+    :return: The evaluation context, containing the settings of this evaluation.
+    """
+    context = EvalContext()
+    config = context.config
+    mutable_config = context.mutable_config
 
     if args.type_white_list is not None:
         logger.info("Only the following types in the white list will be evaluated.")
-        EvalState.white_listed_types = set()
+        context.state.white_listed_types = set()
         for line in args.type_white_list:
             logger.info(line.strip())
-            EvalState.white_listed_types.add(canonicalize_string(line))
+            context.state.white_listed_types.add(canonicalize_string(line))
+
+    if args.coref is not None:
+        config.conll_out = args.coref
+        config.conll_gold_file = args.coref + "_gold.conll"
+        config.conll_sys_file = args.coref + "_sys.conll"
+
+        logger.info("CoNLL script output will be output at " + config.conll_out)
+
+        logger.info(
+            "Gold and system conll files will generated at " + config.conll_gold_file + " and " + config.conll_sys_file)
+
+        if args.coref_shards is not None:
+            if args.coref_shards < 1:
+                utils.terminate_with_error("Number of coreference shards should be positive.")
+            mutable_config.num_conll_shards = args.coref_shards
 
+        if args.parallel_coref:
+            mutable_config.parallel_conll_metrics = [m for m in Config.conll_metrics if
+                                                     args.score_skipped_metrics or m not in Config.skipped_metrics]
 
+    if args.sequencing is not None:
+        config.script_result_dir = args.sequencing
+        mutable_config.eval_sequencing = True
+
+        if args.sequencing_archive and args.checkpoint is not None:
+            utils.terminate_with_error("The TimeML archive cannot be resumed from a checkpoint, please do not store "
+                                       "the TimeML files in an archive when checkpoints are used.")
+
+        if args.no_script_validation:
+            config.no_script_validation = True
+
+        if args.no_pretty_time_ml:
+            config.pretty_time_ml = False
+
+    if args.coref_mapping is not None:
+        if args.coref_mapping < 4:
+            config.coref_criteria = Config.possible_coref_mapping[args.coref_mapping]
+        else:
+            logger.error("Possible mapping : 0: Span only 1: Mention Type 2: Realis 3 Type and Realis")
+            utils.terminate_with_error("Must provide a mapping between 0 to 3")
+    else:
+        config.coref_criteria = Config.possible_coref_mapping[1]
+
+    if args.token_path is not None:
+        mutable_config.eval_mode = EvalMethod.Token
+        logger.info("Eval mode is set to token.")
+    else:
+        mutable_config.eval_mode = EvalMethod.Char
+
+    if args.gold is not None and os.path.isfile(args.gold) and utils.is_pack(args.gold):
+        from gold_pack import GoldPack
+        use_gold_pack(context, GoldPack.load(args.gold), args.type_white_list is not None)
+
+    if args.coreference_threshold is not None:
+        mutable_config.coref_mention_threshold = args.coreference_threshold
+
+    set_coref_sweep(context, args.coreference_thresholds, args.all_coref_mappings)
+
+    if args.pipelined:
+        mutable_config.pipelined = True
+
+    if args.optimal_alignment:
+        mutable_config.optimal_alignment = True
+        logger.info("Mentions will be aligned optimally.")
+
+    return context
+
+
+def use_gold_pack(context, pack, white_list_provided):
+    """
+    Use the precompiled gold standard, the evaluation mode and the type white list are taken from the pack.
+    :param context: The evaluation context.
+    :param pack: The evaluation pack.
+    :param white_list_provided: Whether a type white list is also provided, which should be a subset of the one of the
+    pack.
+    """
+    state = context.state
+
+    logger.info("Gold standard is loaded from the evaluation pack of %s." % pack.source)
+
+    if pack.eval_mode() != context.mutable_config.eval_mode:
+        if pack.token_based:
+            logger.info("Eval mode is set to token, the token ids are taken from the evaluation pack.")
+        else:
+            utils.terminate_with_error("The evaluation pack is character based, it cannot be used in token mode.")
+        context.mutable_config.eval_mode = pack.eval_mode()
+
+    if pack.white_listed_types is not None:
+        if not white_list_provided:
+            state.white_listed_types = pack.white_listed_types
+        elif not state.white_listed_types.issubset(pack.white_listed_types):
+            utils.terminate_with_error("The type white list contains types that are not in the evaluation pack.")
+
+    state.gold_pack = pack
+
+
+def set_coref_sweep(context, thresholds, all_coref_mappings):
+    """
+    Set the thresholds and the mapping criteria of the coreference sweep, which is scored in process.
+    :param context: The evaluation context, the coreference mapping criteria should be already set.
+    :param thresholds: The mention mapping thresholds, or None to use the coreference threshold.
+    :param all_coref_mappings: Whether to sweep all the mapping criteria, or only the one of the context.
+    """
+    mutable_config = context.mutable_config
+
+    if thresholds is not None:
+        mutable_config.coref_mention_thresholds = sorted(set(thresholds))
+        logger.info("Coreference will be scored with mention mapping thresholds: %s." % ", ".join(
+            "%.2f" % t for t in mutable_config.coref_mention_thresholds))
+    elif all_coref_mappings:
+        mutable_config.coref_mention_thresholds = [mutable_config.coref_mention_threshold]
+
+    if all_coref_mappings:
+        mutable_config.coref_sweep_criteria = Config.possible_coref_mapping
+        logger.info("Coreference will be scored with all mapping criteria.")
+    elif len(mutable_config.coref_mention_thresholds) > 0:
+        mutable_config.coref_sweep_criteria = [context.config.coref_criteria]
+
+
+def open_eval_output(args):
     if args.output is not None:
         out_path = args.output
         utils.create_parent_dir(out_path)
-        mention_eval_out = open(out_path, 'w')
         logger.info("Evaluation output will be saved at %s" % out_path)
+        return open(out_path, 'w')
     else:
-        mention_eval_out = sys.stdout
         logger.info("Evaluation output at standard out.")
+        return sys.stdout
+
+
+def write_results(context, args, mention_eval_out, attribute_comb):
+    print_eval_results(context, mention_eval_out, attribute_comb)
+
+    if args.json_out is not None:
+        utils.create_parent_dir(args.json_out)
+        with open(args.json_out, 'w') as json_out:
+            write_json_results(context, json_out, attribute_comb)
+        logger.info("JSON evaluation output saved at %s" % args.json_out)
+
+
+def merge_evaluation(context, args):
+    """
+    Merge the statistics files into one report, the same as evaluating all their documents in one run.
+    :param context: The evaluation context, created from the same arguments.
+    :param args: The parsed command line arguments, where the statistics and the output paths are taken.
+    :return: The exit status.
+    """
+    mention_eval_out = open_eval_output(args)
+
+    script_result_dir = context.config.script_result_dir
+    if script_result_dir is not None:
+        for t in Config.script_types + ["All"]:
+            utils.supermakedirs(os.path.join(script_result_dir, t))
 
-    if os.path.isfile(args.gold):
+    import eval_stats
+    eval_stats.merge_stats(context, args.merge_stats)
+
+    write_results(context, args, mention_eval_out, get_attr_combinations(Config.attribute_names))
+
+    logger.info("Evaluation Done.")
+    return 0
+
+
+def run_evaluation(context, args):
+    """
+    Run one evaluation, all the results are accumulated in the context.
+    :param context: The evaluation context, created from the same arguments.
+    :param args: The parsed command line arguments, where the input and output paths are taken.
+    :return: The exit status.
+    """
+    mention_eval_out = open_eval_output(args)
+
+    # The modules of the optional outputs are only loaded when they are written, so that scoring the mentions starts
+    # faster.
+    checkpoint = None
+    if args.checkpoint is not None:
+        import eval_stats
+        if args.checkpoint_interval < 1:
+            utils.terminate_with_error("Checkpoint interval should be positive.")
+        if os.path.isfile(args.checkpoint):
+            logger.info("Evaluation will be resumed from the checkpoint at %s" % args.checkpoint)
+            checkpoint = eval_stats.read_checkpoint(args.checkpoint)
+    outputs = {} if checkpoint is None else checkpoint["outputs"]
+
+    if context.state.gold_pack is not None:
+        gf = None
+    elif os.path.isfile(args.gold):
         gf = open(args.gold)
     else:
         logger.error("Cannot find gold standard file at " + args.gold)
         sys.exit(1)
 
-    if args.coref is not None:
-        Config.conll_out = args.coref
-        Config.conll_gold_file = args.coref + "_gold.conll"
-        Config.conll_sys_file = args.coref + "_sys.conll"
-
-        logger.info("CoNLL script output will be output at " + Config.conll_out)
-
-        logger.info(
-            "Gold and system conll files will generated at " + Config.conll_gold_file + " and " + Config.conll_sys_file)
+    script_result_dir = context.config.script_result_dir
+    if script_result_dir is not None:
+        # The coreference and sequencing modules are only loaded when they are evaluated, so that scoring the mentions
+        # starts faster.
+        from temporal import TemporalEval
 
-    if args.sequencing is not None:
-        Config.script_result_dir = args.sequencing
-
-        logger.info("Temporal files will be output at " + Config.script_result_dir)
-        utils.supermakedirs(Config.script_result_dir)
+        logger.info("Temporal files will be output at " + script_result_dir)
+        utils.supermakedirs(script_result_dir)
 
         logger.info("Will evaluate link type: %s." % ",".join(Config.script_types))
-        for t in Config.script_types:
-            utils.supermakedirs(os.path.join(Config.script_result_dir, t))
+        for t in Config.script_types + ["All"]:
+            utils.supermakedirs(os.path.join(script_result_dir, t))
 
-        utils.remove_file_by_extension(Config.script_result_dir, ".tml")
-        utils.remove_file_by_extension(Config.script_result_dir, ".tml")
+        # The TimeML files of the documents before the checkpoint are kept.
+        if checkpoint is None:
+            utils.remove_file_by_extension(script_result_dir, ".tml")
 
-        if args.no_script_validation:
-            Config.no_script_validation = True
+        if args.sequencing_archive:
+            TemporalEval.open_archive(context)
 
     if os.path.isfile(args.system):
         sf = open(args.system)
@@ -212,34 +473,29 @@ def main():
         logger.error("Cannot find system file at " + args.system)
         sys.exit(1)
 
-    if args.coref_mapping is not None:
-        if args.coref_mapping < 4:
-            Config.coref_criteria = Config.possible_coref_mapping[args.coref_mapping]
-        else:
-            logger.error("Possible mapping : 0: Span only 1: Mention Type 2: Realis 3 Type and Realis")
-            utils.terminate_with_error("Must provide a mapping between 0 to 3")
-    else:
-        Config.coref_criteria = Config.possible_coref_mapping[1]
-
     diff_out = None
     if args.comparison_output is not None:
         diff_out_path = args.comparison_output
         utils.create_parent_dir(diff_out_path)
-        diff_out = open(diff_out_path, 'w')
+        diff_out = utils.open_output(diff_out_path, outputs.get("comparison"))
+
+    alignment_dump = None
+    if args.alignment_dump is not None:
+        from alignment_dump import AlignmentDump
+        if not AlignmentDump.is_available():
+            utils.terminate_with_error("NumPy is required to write the alignment dump.")
+        alignment_dump = AlignmentDump(context.mutable_config.eval_mode)
+        if checkpoint is not None and "alignment_dump" in checkpoint["appended_outputs"]:
+            alignment_dump.restore(checkpoint["appended_outputs"]["alignment_dump"])
 
     token_dir = "."
     if args.token_path is not None:
-        MutableConfig.eval_mode = EvalMethod.Token
-        logger.info("Eval mode is set to token.")
         if os.path.isdir(args.token_path):
             logger.debug("Will search token files in " + args.token_path)
             token_dir = args.token_path
         else:
             logger.debug("Cannot find given token directory at [%s], "
                          "will try search for current directory" % args.token_path)
-    else:
-        MutableConfig.eval_mode = EvalMethod.Char
-
 
     token_offset_fields = Config.default_token_offset_fields
     if args.offset_field is not None:
@@ -248,43 +504,117 @@ def main():
         except ValueError as _:
             logger.error("Token offset argument should be two integer with comma in between, i.e. 2,3")
 
-    if args.coreference_threshold is not None:
-        MutableConfig.coref_mention_threshold = args.coreference_threshold
-
     # Read all documents.
-    read_all_doc(gf, sf, args.doc_id_to_eval)
+    read_all_doc(context, gf, sf, args.doc_id_to_eval)
+
+    if checkpoint is not None:
+        eval_stats.restore_checkpoint(context, checkpoint)
 
     # Take all attribute combinations, which will be used to produce scores.
     attribute_comb = get_attr_combinations(Config.attribute_names)
 
-    logger.info("Coreference mentions need to match %s before consideration" % Config.coref_criteria[0][1])
+    logger.info("Coreference mentions need to match %s before consideration" % context.config.coref_criteria[0][1])
+
+    if args.coref is not None:
+        from conll_coref import ConllWriter
+        context.state.conll_writer = ConllWriter(context.config.conll_gold_file, context.config.conll_sys_file,
+                                                 context.mutable_config.num_conll_shards, outputs.get("conll"))
 
     while True:
-        if not evaluate(token_dir, args.coref, attribute_comb,
+        if not evaluate(context, token_dir, args.coref, attribute_comb,
                         token_offset_fields, args.token_table_extension,
-                        diff_out):
+                        diff_out, alignment_dump):
             break
 
+        if args.checkpoint is not None and context.state.evaluating_index % args.checkpoint_interval == 0:
+            save_checkpoint(context, args.checkpoint, diff_out, alignment_dump)
+
+    # The last checkpoint contains all documents, so that only the final scoring is repeated if interrupted.
+    if args.checkpoint is not None:
+        save_checkpoint(context, args.checkpoint, diff_out, alignment_dump)
+
     # Run the CoNLL script on the combined files, which is concatenated from the best alignment of all documents.
+    coref_thread = None
     if args.coref is not None:
-        logger.debug("Running coreference script for the final scores.")
-        ConllEvaluator.run_conll_script(Config.conll_gold_file, Config.conll_sys_file, Config.conll_out)
-        # Get the CoNLL scores from output
-        EvalState.overall_coref_scores = ConllEvaluator.get_conll_scores(Config.conll_out)
+        context.state.conll_writer.close()
+        if context.mutable_config.pipelined:
+            # The reference scorer runs in separate processes, the thread only waits for them, while the TimeML
+            # evaluation runs in this thread.
+            coref_thread = threading.Thread(target=eval_coref, args=(context,))
+            coref_thread.start()
+        else:
+            eval_coref(context)
 
     # Run the TimeML evaluation script.
-    if Config.script_result_dir:
-        TemporalEval.eval_time_ml()
+    if context.mutable_config.eval_sequencing:
+        from temporal import TemporalEval
+        TemporalEval.eval_time_ml(context)
+
+    if coref_thread is not None:
+        coref_thread.join()
+        if len(context.state.overall_coref_scores) == 0:
+            utils.terminate_with_error("Coreference scores cannot be read from %s." % context.config.conll_out)
+
+    if args.emit_stats is not None:
+        import eval_stats
+        eval_stats.write_stats(context, args.emit_stats)
 
-    print_eval_results(mention_eval_out, attribute_comb)
+    write_results(context, args, mention_eval_out, attribute_comb)
+
+    if alignment_dump is not None:
+        utils.create_parent_dir(args.alignment_dump)
+        alignment_dump.save(args.alignment_dump)
 
     # Clean up, close files.
     close_if_not_none(diff_out)
 
+    if args.checkpoint is not None:
+        os.remove(args.checkpoint)
+
     logger.info("Evaluation Done.")
     return 0
 
 
+def save_checkpoint(context, checkpoint_path, diff_out, alignment_dump):
+    """
+    Save a checkpoint of the documents evaluated so far, with the states of the outputs written per document.
+    """
+    outputs = {}
+    if context.state.conll_writer is not None:
+        outputs["conll"] = context.state.conll_writer.get_positions()
+    if diff_out is not None:
+        outputs["comparison"] = utils.get_position(diff_out)
+    appended_outputs = {}
+    if alignment_dump is not None:
+        appended_outputs["alignment_dump"] = alignment_dump.columns
+
+    import eval_stats
+    eval_stats.write_checkpoint(context, checkpoint_path, outputs, appended_outputs)
+
+
+def eval_coref(context):
+    """
+    Run the reference coreference scorer on the CoNLL files, and read the scores.
+    """
+    from conll_coref import ConllEvaluator
+
+    config = context.config
+    state = context.state
+
+    logger.debug("Running coreference script for the final scores.")
+    if context.mutable_config.num_conll_shards > 0:
+        ConllEvaluator.run_sharded_conll_script(state.conll_writer.get_shard_paths(), config.conll_out,
+                                                context.mutable_config.parallel_conll_metrics)
+        state.conll_writer.remove_shards()
+    else:
+        ConllEvaluator.run_conll_script(config.conll_gold_file, config.conll_sys_file, config.conll_out,
+                                        context.mutable_config.parallel_conll_metrics)
+    # Get the CoNLL scores from output
+    state.overall_coref_scores = ConllEvaluator.get_conll_scores(config.conll_out)
+    state.overall_coref_details = ConllEvaluator.get_conll_score_details(config.conll_out)
+    state.doc_coref_details = ConllEvaluator.get_conll_doc_details(config.conll_out)
+
+
 def close_if_not_none(f):
     if f is not None:
         f.close()
@@ -313,7 +643,14 @@ def pad_char_before_until(s, n, c=" "):
     return c * (n - len(s)) + s
 
 
-def print_eval_results(mention_eval_out, all_attribute_combinations):
+def compute_mention_scores(context, all_attribute_combinations):
+    """
+    Compute the document level mention scores, and accumulate the statistics used by the micro and macro averages.
+    :param all_attribute_combinations: All attribute combinations to be scored.
+    :return: A tuple of (doc_scores, plain_global_scores, attribute_based_global_scores, total_gold_mentions,
+    total_system_mentions, valid_docs). Each document score is (doc_id, num_gold, num_sys, scores), where scores
+    contains (tp, prec, recall, f1) of the plain mapping, followed by each attribute combination.
+    """
     total_gold_mentions = 0
     total_system_mentions = 0
     valid_docs = 0
@@ -321,23 +658,17 @@ def print_eval_results(mention_eval_out, all_attribute_combinations):
     plain_global_scores = [0.0] * 4
     attribute_based_global_scores = [[0.0] * 4 for _ in xrange(len(all_attribute_combinations))]
 
-    doc_id_width = get_cell_width(EvalState.doc_mention_scores)
-
-    mention_eval_out.write("========Document Mention Detection Results==========\n")
-    small_header_item = "Prec  \tRec  \tF1   "
-    attribute_header_list = get_combined_attribute_header(all_attribute_combinations, len(small_header_item))
-    small_headers = [small_header_item] * (len(all_attribute_combinations) + 1)
-    mention_eval_out.write(pad_char_before_until("", doc_id_width) + "\t" + "\t|\t".join(attribute_header_list) + "\n")
-    mention_eval_out.write(pad_char_before_until("Doc ID", doc_id_width) + "\t" + "\t|\t".join(small_headers) + "\n")
+    doc_scores = []
 
-    for (tp, fp, attribute_based_counts, num_gold_mentions, num_sys_mentions, docId) in EvalState.doc_mention_scores:
+    for (tp, fp, attribute_based_counts, num_gold_mentions, num_sys_mentions, docId) in \
+            context.state.doc_mention_scores:
         tp *= 100
         fp *= 100
         prec = safe_div(tp, num_sys_mentions)
         recall = safe_div(tp, num_gold_mentions)
         doc_f1 = compute_f1(prec, recall)
 
-        attribute_based_doc_scores = []
+        scores = [(tp, prec, recall, doc_f1)]
 
         for comb_index, comb in enumerate(all_attribute_combinations):
             counts = attribute_based_counts[comb_index]
@@ -347,16 +678,13 @@ def print_eval_results(mention_eval_out, all_attribute_combinations):
             attr_recall = safe_div(attr_tp, num_gold_mentions)
             attr_f1 = compute_f1(attr_prec, attr_recall)
 
-            attribute_based_doc_scores.append("%.2f\t%.2f\t%.2f" % (attr_prec, attr_recall, attr_f1))
+            scores.append((attr_tp, attr_prec, attr_recall, attr_f1))
 
             for score_index, score in enumerate([attr_tp, attr_fp, attr_prec, attr_recall]):
                 if not math.isnan(score):
                     attribute_based_global_scores[comb_index][score_index] += score
 
-        mention_eval_out.write(
-            "%s\t%.2f\t%.2f\t%.2f\t|\t%s\n" % (
-                pad_char_before_until(docId, doc_id_width), prec, recall, doc_f1,
-                "\t|\t".join(attribute_based_doc_scores)))
+        doc_scores.append((docId, num_gold_mentions, num_sys_mentions, scores))
 
         # Compute the denominators:
         # 1. Number of valid doc does not include gold standard files that contains no mentions.
@@ -377,12 +705,36 @@ def print_eval_results(mention_eval_out, all_attribute_combinations):
             for score_index, score in enumerate([tp, fp, prec, recall]):
                 plain_global_scores[score_index] += score
 
-    if len(EvalState.doc_coref_scores) > 0:
+    return doc_scores, plain_global_scores, attribute_based_global_scores, total_gold_mentions, \
+        total_system_mentions, valid_docs
+
+
+def print_eval_results(context, mention_eval_out, all_attribute_combinations):
+    state = context.state
+
+    doc_scores, plain_global_scores, attribute_based_global_scores, total_gold_mentions, total_system_mentions, \
+        valid_docs = compute_mention_scores(context, all_attribute_combinations)
+
+    doc_id_width = get_cell_width(state.doc_mention_scores)
+
+    mention_eval_out.write("========Document Mention Detection Results==========\n")
+    small_header_item = "Prec  \tRec  \tF1   "
+    attribute_header_list = get_combined_attribute_header(all_attribute_combinations, len(small_header_item))
+    small_headers = [small_header_item] * (len(all_attribute_combinations) + 1)
+    mention_eval_out.write(pad_char_before_until("", doc_id_width) + "\t" + "\t|\t".join(attribute_header_list) + "\n")
+    mention_eval_out.write(pad_char_before_until("Doc ID", doc_id_width) + "\t" + "\t|\t".join(small_headers) + "\n")
+
+    for docId, _, _, scores in doc_scores:
+        mention_eval_out.write(
+            "%s\t%s\n" % (pad_char_before_until(docId, doc_id_width),
+                          "\t|\t".join("%.2f\t%.2f\t%.2f" % (prec, recall, f1) for _, prec, recall, f1 in scores)))
+
+    if len(state.doc_coref_scores) > 0:
         mention_eval_out.write("\n\n========Document Mention Corefrence Results (CoNLL Average)==========\n")
-        for coref_score, doc_id in EvalState.doc_coref_scores:
+        for coref_score, doc_id in state.doc_coref_scores:
             mention_eval_out.write("%s\t%.2f\n" % (doc_id, coref_score))
 
-    per_type_precision, per_type_recall, per_type_f1 = summarize_type_scores()
+    per_type_precision, per_type_recall, per_type_f1 = summarize_type_scores(context)
 
     mention_eval_out.write("\n\n========Mention Type Results==========\n")
     if len(per_type_f1) > 0:
@@ -394,8 +746,8 @@ def print_eval_results(mention_eval_out, all_attribute_combinations):
                 utils.nan_as_zero(utils.get_or_else(per_type_precision, mention_type, 0)),
                 utils.nan_as_zero(utils.get_or_else(per_type_recall, mention_type, 0)),
                 utils.nan_as_zero(utils.get_or_else(per_type_f1, mention_type, 0)),
-                utils.nan_as_zero(utils.get_or_else(EvalState.per_type_num_gold, mention_type, 0)),
-                utils.nan_as_zero(utils.get_or_else(EvalState.per_type_num_response, mention_type, 0))
+                utils.nan_as_zero(utils.get_or_else(state.per_type_num_gold, mention_type, 0)),
+                utils.nan_as_zero(utils.get_or_else(state.per_type_num_response, mention_type, 0))
             ))
 
     # Use the denominators above to calculate the averages.
@@ -420,28 +772,29 @@ def print_eval_results(mention_eval_out, all_attribute_combinations):
                                   max_attribute_name_width) + "\t" + "\t".join(
                 "%.2f" % f for f in attr_average_scores) + "\n")
 
-    if len(EvalState.overall_coref_scores) > 0:
+    if len(state.doc_alignment_gaps) > 0:
+        print_alignment_gaps(context, mention_eval_out, attribute_header_list, max_attribute_name_width)
+
+    if len(state.overall_coref_scores) > 0:
         mention_eval_out.write("\n=======Final Mention Coreference Results=========\n")
-        conll_sum = 0.0
-        num_metric = 0
-        for metric, score in EvalState.overall_coref_scores.iteritems():
+        for metric, score in state.overall_coref_scores.iteritems():
             formatter = "Metric : %s\tScore\t%.2f\n"
             if metric in Config.skipped_metrics:
                 formatter = "Metric : %s\tScore\t%.2f *\n"
-            else:
-                conll_sum += score
-                num_metric += 1
             mention_eval_out.write(formatter % (metric, score))
         mention_eval_out.write(
-            "Overall Average CoNLL score\t%.2f\n" % (conll_sum / num_metric))
+            "Overall Average CoNLL score\t%.2f\n" % get_conll_average(state.overall_coref_scores))
         mention_eval_out.write("\n* Score not included for final CoNLL score.\n")
 
-    if Config.script_result_dir is not None:
+    if len(context.mutable_config.coref_sweep_criteria) > 0:
+        print_coref_sweep(context, mention_eval_out)
+
+    if context.config.script_result_dir is not None:
         mention_eval_out.write("\n")
 
         for eval_type in Config.script_types + ["All"]:
-            for filename in os.listdir(os.path.join(Config.script_result_dir, eval_type)):
-                script_eval_path = os.path.join(Config.script_result_dir, eval_type, filename)
+            for filename in os.listdir(os.path.join(context.config.script_result_dir, eval_type)):
+                script_eval_path = os.path.join(context.config.script_result_dir, eval_type, filename)
                 if os.path.isfile(script_eval_path):
                     if filename == Config.script_out:
                         with open(script_eval_path, 'r') as out:
@@ -449,7 +802,7 @@ def print_eval_results(mention_eval_out, all_attribute_combinations):
                             for l in out:
                                 mention_eval_out.write(l)
 
-                    if Config.eval_cluster_level_links:
+                    if context.config.eval_cluster_level_links:
                         if filename == Config.script_out_cluster:
                             with open(script_eval_path, 'r') as out:
                                 mention_eval_out.write(
@@ -463,6 +816,196 @@ def print_eval_results(mention_eval_out, all_attribute_combinations):
         mention_eval_out.close()
 
 
+def print_alignment_gaps(context, mention_eval_out, attribute_header_list, name_width):
+    """
+    Write out how much the greedy true positives differ from the optimal ones, summed over all documents.
+    :param mention_eval_out: The output stream.
+    :param attribute_header_list: Names of the plain and all attribute combinations.
+    :param name_width: Width of the attribute name column.
+    """
+    greedy_totals = [0.0] * len(attribute_header_list)
+    optimal_totals = [0.0] * len(attribute_header_list)
+    num_docs_differ = 0
+
+    for greedy_tp, optimal_tp, greedy_attribute_tps, optimal_attribute_tps, _ in context.state.doc_alignment_gaps:
+        greedy_tps = [greedy_tp] + list(greedy_attribute_tps)
+        optimal_tps = [optimal_tp] + list(optimal_attribute_tps)
+
+        differ = False
+        for index in xrange(len(attribute_header_list)):
+            greedy_totals[index] += greedy_tps[index]
+            optimal_totals[index] += optimal_tps[index]
+            if optimal_tps[index] - greedy_tps[index] > Config.alignment_gap_tolerance:
+                differ = True
+        if differ:
+            num_docs_differ += 1
+
+    mention_eval_out.write("\n=======Greedy vs. Optimal Alignment (True Positives)=========\n")
+    mention_eval_out.write("%s\tGreedy\tOptimal\tDiff\n" % pad_char_before_until("Attributes", name_width))
+    for index, attribute_header in enumerate(attribute_header_list):
+        mention_eval_out.write("%s\t%.2f\t%.2f\t%.2f\n" % (
+            pad_char_before_until(attribute_header.strip(), name_width), greedy_totals[index], optimal_totals[index],
+            optimal_totals[index] - greedy_totals[index]))
+    mention_eval_out.write("Greedy alignment is not optimal in %d out of %d documents.\n" % (
+        num_docs_differ, len(context.state.doc_alignment_gaps)))
+
+
+def get_conll_average(coref_scores):
+    """
+    Average the coreference metric scores, the skipped metrics are not included.
+    :param coref_scores: Map from metric name to score.
+    :return:
+    """
+    conll_sum = 0.0
+    num_metric = 0
+    for metric, score in coref_scores.iteritems():
+        if metric not in Config.skipped_metrics:
+            conll_sum += score
+            num_metric += 1
+    return conll_sum / num_metric
+
+
+def get_metrics_conll_average(metric_scores):
+    """
+    Average the F1 of the coreference scores computed in process.
+    :param metric_scores: Map from metric name to the scores, as computed by coref_metrics.
+    :return:
+    """
+    return get_conll_average(dict((metric, scores["f1"]) for metric, scores in metric_scores.iteritems()))
+
+
+def get_coref_sweep_results(context):
+    """
+    Combine the document scores of each mapping criteria and threshold in the coreference sweep.
+    :return: A list of (criteria name, threshold, metric scores), ordered as the criteria are given, then by
+    threshold.
+    """
+    import coref_metrics
+
+    results = []
+    for criteria in context.mutable_config.coref_sweep_criteria:
+        criteria_name = utils.get_criteria_name(criteria)
+        for threshold in context.mutable_config.coref_mention_thresholds:
+            doc_metrics = context.state.coref_sweep_metrics.get((criteria_name, threshold), [])
+            results.append((criteria_name, threshold, coref_metrics.sum_scores(doc_metrics)))
+    return results
+
+
+def print_coref_sweep(context, mention_eval_out):
+    import coref_metrics
+
+    sweep_results = get_coref_sweep_results(context)
+    name_width = max(len(criteria_name) for criteria_name, _, _ in sweep_results + [("Mapping", None, None)])
+
+    mention_eval_out.write("\n=======Coreference Threshold Sweep=========\n")
+    mention_eval_out.write("%s\tThreshold\t%s\tAverage\n" % (pad_char_before_until("Mapping", name_width),
+                                                              "\t".join(coref_metrics.metric_names)))
+    for criteria_name, threshold, metric_scores in sweep_results:
+        mention_eval_out.write("%s\t%.2f\t%s\t%.2f\n" % (
+            pad_char_before_until(criteria_name, name_width), threshold,
+            "\t".join("%.2f" % metric_scores[metric]["f1"] for metric in coref_metrics.metric_names),
+            get_metrics_conll_average(metric_scores)))
+    mention_eval_out.write("* Scores are computed in process, %s is not included in the average.\n" % ",".join(
+        sorted(Config.skipped_metrics)))
+
+
+def get_structured_results(context, all_attribute_combinations):
+    """
+    Collect all the evaluation results into a structure that can be serialized, such as to JSON. Scores that are not
+    defined (NaN) are stored as None.
+    :param all_attribute_combinations: All attribute combinations to be scored.
+    :return: A map containing the document, type, averaged, coreference and sequencing results.
+    """
+    state = context.state
+
+    doc_scores, plain_global_scores, attribute_based_global_scores, total_gold_mentions, total_system_mentions, \
+        valid_docs = compute_mention_scores(context, all_attribute_combinations)
+
+    score_names = ["plain"] + ["+".join(attr_pair[1] for attr_pair in comb) for comb in all_attribute_combinations]
+
+    def score_map(prec, recall, f1):
+        return {"precision": utils.nan_as_none(prec), "recall": utils.nan_as_none(recall),
+                "f1": utils.nan_as_none(f1)}
+
+    documents = []
+    for doc_id, num_gold, num_sys, scores in doc_scores:
+        doc_result = {"doc_id": doc_id, "num_gold": num_gold, "num_system": num_sys, "scores": {}}
+        for name, (tp, prec, recall, f1) in zip(score_names, scores):
+            doc_result["scores"][name] = score_map(prec, recall, f1)
+            doc_result["scores"][name]["tp"] = tp / 100
+        documents.append(doc_result)
+
+    micro = {}
+    macro = {}
+    for name, global_scores in zip(score_names, [plain_global_scores] + attribute_based_global_scores):
+        averages = get_averages(global_scores, total_gold_mentions, total_system_mentions, valid_docs)
+        micro[name] = score_map(*averages[:3])
+        macro[name] = score_map(*averages[3:])
+
+    per_type_precision, per_type_recall, per_type_f1 = summarize_type_scores(context)
+    types = {}
+    for mention_type in per_type_f1:
+        # Per type scores are not in percentage, we convert them here to be consistent with other scores.
+        types[mention_type] = score_map(100 * per_type_precision[mention_type], 100 * per_type_recall[mention_type],
+                                        100 * per_type_f1[mention_type])
+        types[mention_type]["num_gold"] = utils.get_or_else(state.per_type_num_gold, mention_type, 0)
+        types[mention_type]["num_system"] = utils.get_or_else(state.per_type_num_response, mention_type, 0)
+
+    results = {
+        "system_id": state.system_id,
+        "num_documents": len(doc_scores),
+        "num_valid_documents": valid_docs,
+        "num_gold": total_gold_mentions,
+        "num_system": total_system_mentions,
+        "documents": documents,
+        "types": types,
+        "micro_average": micro,
+        "macro_average": macro,
+    }
+
+    if len(state.overall_coref_scores) > 0:
+        metrics = {}
+        for metric, score in state.overall_coref_scores.iteritems():
+            metrics[metric] = {
+                "f1": score,
+                "in_average": metric not in Config.skipped_metrics,
+                "details": utils.get_or_else(state.overall_coref_details, metric, {}),
+            }
+        results["coreference"] = {
+            "metrics": metrics,
+            "conll_average": get_conll_average(state.overall_coref_scores),
+            "documents": [{"doc_id": doc_id, "conll_average": score,
+                           "metrics": state.doc_coref_metrics[doc_id]} for score, doc_id in
+                          state.doc_coref_scores],
+            "document_details": state.doc_coref_details,
+        }
+
+    if len(context.mutable_config.coref_sweep_criteria) > 0:
+        results["coreference_sweep"] = [
+            {"mapping": criteria_name, "threshold": threshold, "metrics": metric_scores,
+             "conll_average": get_metrics_conll_average(metric_scores)} for criteria_name, threshold, metric_scores in
+            get_coref_sweep_results(context)]
+
+    if len(state.overall_seq_scores) > 0:
+        results["sequencing"] = state.overall_seq_scores
+        if len(state.overall_seq_cluster_scores) > 0:
+            results["sequencing_cluster"] = state.overall_seq_cluster_scores
+
+    if len(state.doc_alignment_gaps) > 0:
+        results["alignment_gaps"] = [
+            {"doc_id": doc_id, "greedy_tps": dict(zip(score_names, [greedy_tp] + list(greedy_attribute_tps))),
+             "optimal_tps": dict(zip(score_names, [optimal_tp] + list(optimal_attribute_tps)))}
+            for greedy_tp, optimal_tp, greedy_attribute_tps, optimal_attribute_tps, doc_id in
+            state.doc_alignment_gaps]
+
+    return results
+
+
+def write_json_results(context, json_out, all_attribute_combinations):
+    json.dump(get_structured_results(context, all_attribute_combinations), json_out, indent=2, sort_keys=True)
+    json_out.write("\n")
+
+
 def get_averages(scores, num_gold, num_sys, num_docs):
     micro_prec = safe_div(scores[0], num_sys)
     micro_recall = safe_div(scores[0], num_gold)
@@ -531,23 +1074,29 @@ def compute_f1(p, r):
     return safe_div(2 * p * r, (p + r))
 
 
-def read_all_doc(gf, sf, single_doc_id_to_eval):
+def read_all_doc(context, gf, sf, single_doc_id_to_eval):
     """
     Read all the documents, collect the document ids that are shared by both gold and system. It will populate the
-    gold_docs and system_docs, stored as map from doc id to raw annotation strings.
+    gold_docs and system_docs, stored as map from doc id to raw annotation strings. The gold documents are the parsed
+    mention tables and relations if the gold standard is an evaluation pack.
 
     The document ids considered to be scored are those presented in the gold documents.
 
-    :param gf: Gold standard file
+    :param gf: Gold standard file, not used if the context has an evaluation pack.
     :param sf:  System response file
     :param single_doc_id_to_eval: If not None, we will evaluate only this doc id.
     :return:
     """
-    EvalState.gold_docs, _ = read_docs_with_doc_id_and_name(gf)
-    EvalState.system_docs, EvalState.system_id = read_docs_with_doc_id_and_name(sf)
+    state = context.state
+
+    if state.gold_pack is not None:
+        state.gold_docs = state.gold_pack.docs
+    else:
+        state.gold_docs, _ = read_docs_with_doc_id_and_name(gf)
+    state.system_docs, state.system_id = read_docs_with_doc_id_and_name(sf)
 
-    g_doc_ids = EvalState.gold_docs.keys()
-    s_doc_ids = EvalState.system_docs.keys()
+    g_doc_ids = state.gold_docs.keys()
+    s_doc_ids = state.system_docs.keys()
 
     g_id_set = set(g_doc_ids)
     s_id_set = set(s_doc_ids)
@@ -561,7 +1110,7 @@ def read_all_doc(gf, sf, single_doc_id_to_eval):
         if single_doc_id_to_eval not in s_id_set:
             logger.error("This document is not found in system standard")
 
-        EvalState.doc_ids_to_score = [single_doc_id_to_eval]
+        state.doc_ids_to_score = [single_doc_id_to_eval]
     else:
         g_minus_s = g_id_set - common_id_set
         s_minus_g = s_id_set - common_id_set
@@ -579,7 +1128,7 @@ def read_all_doc(gf, sf, single_doc_id_to_eval):
         if len(common_id_set) == 0:
             logger.warning("No document to score, file names are all different!")
 
-        EvalState.doc_ids_to_score = sorted(g_id_set)
+        state.doc_ids_to_score = sorted(g_id_set)
 
 
 def read_docs_with_doc_id_and_name(f):
@@ -616,19 +1165,21 @@ def read_docs_with_doc_id_and_name(f):
     return all_docs, run_id
 
 
-def get_next_doc():
+def get_next_doc(context):
     """
     Get next document pair of gold standard and system response.
     :return: A tuple of 4 element
         (has_next, gold_annotation, system_annotation, doc_id)
     """
-    if EvalState.has_next_doc():  # A somewhat redundant check
-        doc_id = EvalState.doc_ids_to_score[EvalState.evaluating_index]
-        EvalState.advance_index()
-        if doc_id in EvalState.system_docs:
-            return True, EvalState.gold_docs[doc_id], EvalState.system_docs[doc_id], doc_id, EvalState.system_id
+    state = context.state
+
+    if state.has_next_doc():  # A somewhat redundant check
+        doc_id = state.doc_ids_to_score[state.evaluating_index]
+        state.advance_index()
+        if doc_id in state.system_docs:
+            return True, state.gold_docs[doc_id], state.system_docs[doc_id], doc_id, state.system_id
         else:
-            return True, EvalState.gold_docs[doc_id], ([], []), doc_id, EvalState.system_id
+            return True, state.gold_docs[doc_id], ([], []), doc_id, state.system_id
     else:
         logger.error("Reaching end of all documents")
         return False, ([], []), ([], []), "End_Of_Documents"
@@ -667,7 +1218,7 @@ def parse_token_ids(s, invisible_ids):
     return filtered_token_ids, original_token_ids
 
 
-def parse_line(l, invisible_ids):
+def parse_line(context, l, invisible_ids):
     """
     Parse the line, get the token ids, remove invisible ones.
     :param l: A line in the tbf file.
@@ -678,7 +1229,7 @@ def parse_line(l, invisible_ids):
     if len(fields) < 5 + num_attributes:
         utils.terminate_with_error("System line has too few fields:\n ---> %s" % l)
 
-    if MutableConfig.eval_mode == EvalMethod.Token:
+    if context.mutable_config.eval_mode == EvalMethod.Token:
         spans, original_spans = parse_token_ids(fields[3], invisible_ids)
         if len(spans) == 0:
             logger.warn("Find mention with only invisible words, will not be mapped to anything")
@@ -687,16 +1238,31 @@ def parse_line(l, invisible_ids):
         spans = parse_characters(fields[3])
         original_spans = spans
 
-    attributes = [canonicalize_string(a) for a in fields[5:5 + num_attributes]]
-
-    if EvalState.white_listed_types:
-        if attributes[0] not in EvalState.white_listed_types:
-            return None
-
     event_id = fields[2]
     text = fields[4]
     # span_id = fields[script_column] if len(fields) > script_column else None
 
+    return create_mention(context, spans, original_spans, fields[5:5 + num_attributes], event_id, text)
+
+
+def create_mention(context, spans, original_spans, attributes, event_id, text):
+    """
+    Create one row of the mention table, the attributes are canonicalized.
+    :param context: The evaluation context, which contains the type white list.
+    :param spans: The characters or the token ids of the mention.
+    :param original_spans: The spans before filtering.
+    :param attributes: The attribute values, in the same order as Config.attribute_names.
+    :param event_id: The mention id.
+    :param text: The mention text.
+    :return: The mention as (spans, attributes, event_id, original_spans, text), or None if the type is not in the
+    white list.
+    """
+    attributes = [canonicalize_string(a) for a in attributes]
+
+    if context.state.white_listed_types:
+        if attributes[0] not in context.state.white_listed_types:
+            return None
+
     return spans, attributes, event_id, original_spans, text
 
 
@@ -869,7 +1435,30 @@ def get_tp_greedy(all_gold_system_mapping_scores, all_attribute_combinations, go
     return tp, attribute_based_tps, greedy_mention_only_mapping, greedy_all_attributed_mapping
 
 
-def per_type_eval(system_mention_table, gold_mention_table, type_mapping):
+def get_tp_optimal(all_gold_system_mapping_scores, all_attribute_combinations, gold_mention_table,
+                   system_mention_table, doc_id):
+    """
+    Compute the true positives with the maximum overlap alignment. The results are in the same form as
+    get_tp_greedy. Unlike the greedy version, the mapping scores are not consumed.
+    """
+    edges = [(gold_index, system_index, -neg_mapping_score) for neg_mapping_score, system_index, gold_index in
+             all_gold_system_mapping_scores]
+
+    tp, optimal_mention_only_mapping = alignment.get_optimal_mapping(edges, len(gold_mention_table))
+
+    attribute_based_tps = []
+    optimal_all_attributed_mapping = []
+    for attr_comb in all_attribute_combinations:
+        attribute_edges = [e for e in edges if attribute_based_match(attr_comb, gold_mention_table[e[0]][1],
+                                                                     system_mention_table[e[1]][1], doc_id)]
+        attr_tp, attr_mapping = alignment.get_optimal_mapping(attribute_edges, len(gold_mention_table))
+        attribute_based_tps.append(attr_tp)
+        optimal_all_attributed_mapping.append(attr_mapping)
+
+    return tp, attribute_based_tps, optimal_mention_only_mapping, optimal_all_attributed_mapping
+
+
+def per_type_eval(context, system_mention_table, gold_mention_table, type_mapping):
     """
     Accumulate per type statistics.
     :param system_mention_table:
@@ -877,6 +1466,8 @@ def per_type_eval(system_mention_table, gold_mention_table, type_mapping):
     :param type_mapping:
     :return:
     """
+    state = context.state
+
     # print type_mapping
 
     for gold_index, (sys_index, score) in enumerate(type_mapping):
@@ -888,37 +1479,39 @@ def per_type_eval(system_mention_table, gold_mention_table, type_mapping):
         # print "System", system_mention_table[sys_index]
 
         if sys_index >= 0:
-            utils.put_or_increment(EvalState.per_type_tp, mention_type, score)
+            utils.put_or_increment(state.per_type_tp, mention_type, score)
 
     for gold_row in gold_mention_table:
         attributes = gold_row[1]
         mention_type = attributes[0]
-        utils.put_or_increment(EvalState.per_type_num_gold, mention_type, 1)
+        utils.put_or_increment(state.per_type_num_gold, mention_type, 1)
 
     for sys_row in system_mention_table:
         attributes = sys_row[1]
         mention_type = attributes[0]
-        utils.put_or_increment(EvalState.per_type_num_response, mention_type, 1)
+        utils.put_or_increment(state.per_type_num_response, mention_type, 1)
 
-        # print EvalState.per_type_tp
-        # print EvalState.per_type_num_gold
-        # print EvalState.per_type_num_response
+        # print state.per_type_tp
+        # print state.per_type_num_gold
+        # print state.per_type_num_response
         #
         # sys.stdin.readline()
 
 
-def summarize_type_scores():
+def summarize_type_scores(context):
     """
     Calculate the overall type scores from the accumulated statistics.
     :return:
     """
+    state = context.state
+
     per_type_precision = {}
     per_type_recall = {}
     per_type_f1 = {}
 
-    for mention_type, num_gold in EvalState.per_type_num_gold.iteritems():
-        tp = utils.get_or_else(EvalState.per_type_tp, mention_type, 0)
-        num_sys = utils.get_or_else(EvalState.per_type_num_response, mention_type, 0)
+    for mention_type, num_gold in state.per_type_num_gold.iteritems():
+        tp = utils.get_or_else(state.per_type_tp, mention_type, 0)
+        num_sys = utils.get_or_else(state.per_type_num_response, mention_type, 0)
         prec = safe_div(tp, num_sys)
         recall = safe_div(tp, num_gold)
         f_score = safe_div(2 * prec * recall, prec + recall)
@@ -929,81 +1522,97 @@ def summarize_type_scores():
     return per_type_precision, per_type_recall, per_type_f1
 
 
-def evaluate(token_dir, coref_out, all_attribute_combinations, token_offset_fields, token_file_ext, diff_out):
+def evaluate(context, token_dir, coref_out, all_attribute_combinations, token_offset_fields, token_file_ext, diff_out,
+             alignment_dump=None):
     """
     Conduct the main evaluation steps.
+    :param context: The evaluation context, where the document scores are accumulated.
     :param token_dir:
     :param coref_out:
     :param all_attribute_combinations:
     :param token_offset_fields:
     :param token_file_ext:
     :param diff_out:
+    :param alignment_dump: If provided, all the alignments of this document are added to it.
     :return:
     """
-    if EvalState.has_next_doc():
-        res, (g_mention_lines, g_relation_lines), (
-            s_mention_lines, s_relation_lines), doc_id, system_id = get_next_doc()
+    state = context.state
+
+    if state.has_next_doc():
+        res, (g_mentions, g_relations), (
+            s_mention_lines, s_relation_lines), doc_id, system_id = get_next_doc(context)
     else:
         return False
 
     logger.info("Evaluating Document %s" % doc_id)
 
-    if len(g_mention_lines) == 0:
+    if len(g_mentions) == 0:
         logger.warn(
             "[%s] does not contain gold standard mentions. Document level F score will not be valid, but the micro "
             "score will be fine." % doc_id)
 
     invisible_ids = []
-    if MutableConfig.eval_mode == EvalMethod.Token:
+    if state.gold_pack is not None:
+        invisible_ids = state.gold_pack.invisible_ids.get(doc_id, set())
+    elif context.mutable_config.eval_mode == EvalMethod.Token:
         invisible_ids, id2token, id2span = read_token_ids(token_dir, doc_id, token_file_ext, token_offset_fields)
 
-    # Parse the lines and save them as a table from id to content.
-    system_mention_table = []
-    gold_mention_table = []
+    logger.debug("Reading gold and response mentions.")
 
-    # Save the raw text for visualization.
-    sys_id_2_text = {}
-    gold_id_2_text = {}
+    # Parse the lines and save them as a table from id to content, the rejected lines are ignored.
+    system_mention_table = [m for m in (parse_line(context, sl, invisible_ids) for sl in s_mention_lines) if m]
 
-    logger.debug("Reading gold and response mentions.")
+    if state.gold_pack is not None:
+        # The pack is already parsed, only the types out of the white list of this evaluation are removed.
+        gold_mention_table = [m for m in g_mentions if
+                              not state.white_listed_types or m[1][0] in state.white_listed_types]
+        gold_relations = g_relations
+    else:
+        gold_mention_table = [m for m in (parse_line(context, gl, invisible_ids) for gl in g_mentions) if m]
+        gold_relations = [utils.parse_relation_line(l) for l in g_relations]
 
-    remaining_sys_ids = set()
-    num_system_mentions = 0
-    for sl in s_mention_lines:
-        parse_result = parse_line(sl, invisible_ids)
+    evaluate_document(context, doc_id, system_id, gold_mention_table, system_mention_table, gold_relations,
+                      [utils.parse_relation_line(l) for l in s_relation_lines],
+                      all_attribute_combinations, coref_out is not None, diff_out, alignment_dump)
 
-        # If parse result is rejected, we ignore this line.
-        if not parse_result:
-            continue
+    return True
 
-        num_system_mentions += 1
 
-        sys_attributes = parse_result[1]
-        sys_mention_id = parse_result[2]
-        text = parse_result[4]
+def evaluate_document(context, doc_id, system_id, gold_mention_table, system_mention_table, gold_relations,
+                      sys_relations, all_attribute_combinations, eval_coref=False, diff_out=None,
+                      alignment_dump=None):
+    """
+    Evaluate one document from the parsed mentions and relations.
+    :param context: The evaluation context, where the document scores are accumulated.
+    :param doc_id: The document id.
+    :param system_id: The system id.
+    :param gold_mention_table: The gold mentions, each one is created by create_mention.
+    :param system_mention_table: The system mentions.
+    :param gold_relations: The gold relations, each one is (relation name, relation id, mention ids).
+    :param sys_relations: The system relations.
+    :param all_attribute_combinations: All attribute combinations to be scored.
+    :param eval_coref: Whether to evaluate coreference, the CoNLL lines are written if the context has a CoNLL writer.
+    :param diff_out: If provided, the comparison output is written to it.
+    :param alignment_dump: If provided, all the alignments of this document are added to it.
+    """
+    state = context.state
+
+    # Save the raw text for visualization.
+    sys_id_2_text = {}
+    gold_id_2_text = {}
 
-        system_mention_table.append(parse_result)
-        EvalState.all_possible_types.add(sys_attributes[0])
+    remaining_sys_ids = set()
+    for _, sys_attributes, sys_mention_id, _, text in system_mention_table:
+        state.all_possible_types.add(sys_attributes[0])
         remaining_sys_ids.add(sys_mention_id)
         sys_id_2_text[sys_mention_id] = text
 
-    if not num_system_mentions == len(remaining_sys_ids):
+    if not len(system_mention_table) == len(remaining_sys_ids):
         logger.warn("Duplicated mention id for doc %s, one of them is randomly removed." % doc_id)
 
     remaining_gold_ids = set()
-    for gl in g_mention_lines:
-        parse_result = parse_line(gl, invisible_ids)
-
-        # If parse result is rejected, we ignore this line.
-        if not parse_result:
-            continue
-
-        gold_attributes = parse_result[1]
-        gold_mention_id = parse_result[2]
-        text = parse_result[4]
-
-        gold_mention_table.append(parse_result)
-        EvalState.all_possible_types.add(gold_attributes[0])
+    for _, gold_attributes, gold_mention_id, _, text in gold_mention_table:
+        state.all_possible_types.add(gold_attributes[0])
         gold_id_2_text[gold_mention_id] = text
         remaining_gold_ids.add(gold_mention_id)
 
@@ -1037,10 +1646,23 @@ def evaluate(token_dir, coref_out, all_attribute_combinations, token_offset_fiel
         if print_score_matrix:
             print
 
+    if context.mutable_config.optimal_alignment:
+        optimal_results = get_tp_optimal(all_gold_system_mapping_scores, all_attribute_combinations,
+                                         gold_mention_table, system_mention_table, doc_id)
+
     greedy_tp, greedy_attribute_tps, greedy_mention_only_mapping, greedy_all_attribute_mapping = get_tp_greedy(
         all_gold_system_mapping_scores, all_attribute_combinations, gold_mention_table,
         system_mention_table, doc_id)
 
+    if context.mutable_config.optimal_alignment:
+        state.doc_alignment_gaps.append((greedy_tp, optimal_results[0], greedy_attribute_tps,
+                                         optimal_results[1], doc_id))
+        if optimal_results[0] - greedy_tp > Config.alignment_gap_tolerance:
+            logger.debug("Greedy alignment is not optimal for doc [%s], greedy TP is %.2f, optimal TP is %.2f." % (
+                doc_id, greedy_tp, optimal_results[0]))
+        # The rest of the evaluation will use the optimal alignment instead.
+        greedy_tp, greedy_attribute_tps, greedy_mention_only_mapping, greedy_all_attribute_mapping = optimal_results
+
     write_if_provided(diff_out, Config.bod_marker + " " + doc_id + "\n")
     if diff_out is not None:
         # Here if you change the mapping used, you will see what's wrong on different level!
@@ -1051,6 +1673,10 @@ def evaluate(token_dir, coref_out, all_attribute_combinations, token_offset_fiel
         write_gold_and_system_mappings(system_id, greedy_mention_only_mapping, gold_mention_table, system_mention_table,
                                        diff_out)
 
+    if alignment_dump is not None:
+        alignment_dump.add_document(system_id, doc_id, greedy_mention_only_mapping, greedy_all_attribute_mapping,
+                                    all_attribute_combinations, gold_mention_table, system_mention_table)
+
     attribute_based_fps = [0.0] * len(all_attribute_combinations)
     for attribute_comb_index, abtp in enumerate(greedy_attribute_tps):
         attribute_based_fps[attribute_comb_index] = num_system_predictions - abtp
@@ -1058,74 +1684,101 @@ def evaluate(token_dir, coref_out, all_attribute_combinations, token_offset_fiel
     # Unmapped system mentions and the partial scores are considered as false positive.
     fp = len(remaining_sys_ids) - greedy_tp
 
-    EvalState.doc_mention_scores.append((greedy_tp, fp, zip(greedy_attribute_tps, attribute_based_fps),
-                                         num_gold_predictions, num_system_predictions, doc_id))
+    state.doc_mention_scores.append((greedy_tp, fp, zip(greedy_attribute_tps, attribute_based_fps),
+                                     num_gold_predictions, num_system_predictions, doc_id))
 
     # Select a computed mapping, we currently select the mapping based on mention type. This means that in order to get
     # coreference right, your mention type should also be right. This can be changed by change Config.coref_criteria
     # settings.
-    mention_mapping = None
+    mention_mapping = select_mention_mapping(context.config.coref_criteria, all_attribute_combinations,
+                                             greedy_all_attribute_mapping, greedy_mention_only_mapping)
     type_mapping = None
     for attribute_comb_index, attribute_comb in enumerate(all_attribute_combinations):
-        if attribute_comb == Config.coref_criteria:
-            mention_mapping = greedy_all_attribute_mapping[attribute_comb_index]
-            logger.debug("Select mapping that matches criteria [%s]" % (Config.coref_criteria[0][1]))
         if attribute_comb[0][1] == "mention_type":
             type_mapping = greedy_all_attribute_mapping[attribute_comb_index]
 
-    if Config.coref_criteria == "span_only":
-        mention_mapping = greedy_mention_only_mapping
-
-    if mention_mapping is None:
-        # In case when we don't do attribute scoring.
-        mention_mapping = greedy_mention_only_mapping
-
     # Evaluate how the performance of each type.
-    per_type_eval(system_mention_table, gold_mention_table, type_mapping)
+    per_type_eval(context, system_mention_table, gold_mention_table, type_mapping)
 
-    gold_directed_relations, gold_corefs = utils.parse_relation_lines(g_relation_lines, remaining_gold_ids)
-    sys_directed_relations, sys_corefs = utils.parse_relation_lines(s_relation_lines, remaining_sys_ids)
+    gold_directed_relations, gold_corefs = utils.get_relations_by_type(gold_relations, remaining_gold_ids,
+                                                                       state.white_listed_types)
+    sys_directed_relations, sys_corefs = utils.get_relations_by_type(sys_relations, remaining_sys_ids,
+                                                                     state.white_listed_types)
 
-    if Config.script_result_dir:
-        seq_eval = TemporalEval(mention_mapping, gold_mention_table, gold_directed_relations, system_mention_table,
-                                sys_directed_relations, gold_corefs, sys_corefs)
+    if context.mutable_config.eval_sequencing:
+        from temporal import TemporalEval
+        seq_eval = TemporalEval(context, mention_mapping, gold_mention_table, gold_directed_relations,
+                                system_mention_table, sys_directed_relations, gold_corefs, sys_corefs)
 
-        if not Config.no_script_validation:
+        if not context.config.no_script_validation:
             if not seq_eval.validate_gold():
-                logger.error("The gold edges cannot form a valid script graph.")
-                utils.exit_on_fail()
+                raise utils.ScoringError("The gold edges cannot form a valid script graph.",
+                                         utils.validation_exit_status)
 
             if not seq_eval.validate_sys():
-                logger.error("The system edges cannot form a valid script graph.")
-                utils.exit_on_fail()
+                raise utils.ScoringError("The system edges cannot form a valid script graph.",
+                                         utils.validation_exit_status)
 
         seq_eval.write_time_ml(doc_id)
 
     # Evaluate coreference links.
-    if coref_out is not None:
+    if eval_coref or len(context.mutable_config.coref_sweep_criteria) > 0:
+        import coref_metrics
+        from conll_coref import ConllEvaluator
+        conll_converter = ConllEvaluator(doc_id, system_id, sys_id_2_text, gold_id_2_text)
+
+        # The mention mappings are computed once for all the criteria, and shared by all thresholds, only the aligned
+        # tables are created for each one.
+        for criteria in context.mutable_config.coref_sweep_criteria:
+            criteria_mapping = select_mention_mapping(criteria, all_attribute_combinations,
+                                                      greedy_all_attribute_mapping, greedy_mention_only_mapping)
+            criteria_name = utils.get_criteria_name(criteria)
+            for threshold in context.mutable_config.coref_mention_thresholds:
+                gold_coref_fields, sys_coref_fields = conll_converter.prepare_coref_fields(
+                    gold_corefs, sys_corefs, gold_mention_table, system_mention_table, criteria_mapping, threshold)
+                state.coref_sweep_metrics.setdefault((criteria_name, threshold), []).append(
+                    coref_metrics.score_document(ConllEvaluator.get_clusters(gold_coref_fields),
+                                                 ConllEvaluator.get_clusters(sys_coref_fields)))
+
+    if eval_coref:
         logger.debug("Start preparing coreference files.")
 
         # Prepare CoNLL style coreference input for this document.
-        conll_converter = ConllEvaluator(doc_id, system_id, sys_id_2_text, gold_id_2_text)
-        gold_conll_lines, sys_conll_lines = conll_converter.prepare_conll_lines(gold_corefs, sys_corefs,
-                                                                                gold_mention_table,
-                                                                                system_mention_table,
-                                                                                mention_mapping,
-                                                                                MutableConfig.coref_mention_threshold)
-
-        # If we are selecting among multiple mappings, it is easy to write in our file.
-        write_mode = 'w' if EvalState.claim_write_flag() else 'a'
-        g_conll_out = open(Config.conll_gold_file, write_mode)
-        s_conll_out = open(Config.conll_sys_file, write_mode)
-        g_conll_out.writelines(gold_conll_lines)
-        s_conll_out.writelines(sys_conll_lines)
+        gold_coref_fields, sys_coref_fields = conll_converter.prepare_coref_fields(
+            gold_corefs, sys_corefs, gold_mention_table, system_mention_table, mention_mapping,
+            context.mutable_config.coref_mention_threshold)
+
+        if state.conll_writer is not None:
+            state.conll_writer.write_document(conll_converter.generate_lines(gold_coref_fields),
+                                              conll_converter.generate_lines(sys_coref_fields))
+
+        # The reference scorer is only run once on all documents, the document scores are computed here.
+        doc_metrics = coref_metrics.score_document(ConllEvaluator.get_clusters(gold_coref_fields),
+                                                   ConllEvaluator.get_clusters(sys_coref_fields))
+        state.doc_coref_metrics[doc_id] = doc_metrics
+        state.doc_coref_scores.append((get_metrics_conll_average(doc_metrics), doc_id))
 
         if diff_out is not None:
             write_gold_and_system_corefs(diff_out, gold_corefs, sys_corefs, gold_id_2_text, sys_id_2_text)
 
     write_if_provided(diff_out, Config.eod_marker + " " + "\n")
 
-    return True
+
+def select_mention_mapping(criteria, all_attribute_combinations, all_attribute_mapping, mention_only_mapping):
+    """
+    Select the mention mapping used by coreference.
+    :param criteria: The attributes that should match, one of Config.possible_coref_mapping.
+    :param all_attribute_combinations: All attribute combinations.
+    :param all_attribute_mapping: The mapping of each attribute combination.
+    :param mention_only_mapping: The mapping that only consider spans.
+    :return: The mapping of the criteria, or the span only mapping if the criteria is not among the combinations.
+    """
+    for attribute_comb_index, attribute_comb in enumerate(all_attribute_combinations):
+        if attribute_comb == criteria:
+            logger.debug("Select mapping that matches criteria [%s]" % utils.get_criteria_name(criteria))
+            return all_attribute_mapping[attribute_comb_index]
+    # Span only, or in case when we don't do attribute scoring.
+    return mention_only_mapping
 
 
 def natural_order(key):
@@ -1141,4 +1794,4 @@ def natural_order(key):
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
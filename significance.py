@@ -0,0 +1,348 @@
+#!/usr/bin/python
+
+"""
+    Significance testing between evaluation runs, by resampling documents.
+
+    Instead of re-running the scorer on each resample, this reads the per document sufficient statistics from the JSON
+    results of the scorer (the -jo option), i.e. true positives, gold and system counts of mentions, the recall,
+    precision numerators and denominators of the coreference metrics, and the link counts of BLANC. Since all these
+    scores are computed from sums of the document statistics, a resample is simply a weighted sum, and all the resamples
+    can be computed with a single matrix product.
+
+    Two tests are provided:
+     1. Paired bootstrap: documents are resampled with replacement, the same resamples are used for all the runs,
+     which give the confidence intervals of each run, and the p-values between each pair of runs.
+     2. Approximate randomization: for each pair of runs, the document statistics are randomly swapped between the two
+     runs, to test whether the difference can be obtained by chance.
+
+    Author: Zhengzhong Liu ( liu@cs.cmu.edu )
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import utils
+from config import Config
+
+logger = logging.getLogger()
+
+mention_score_names = ["plain", "mention_type", "realis_status", "mention_type+realis_status"]
+
+# The metrics averaged as the CoNLL score, the same as the scorer.
+conll_metric_names = [m for m in Config.conll_metrics if m not in Config.skipped_metrics]
+
+coref_count_names = ["recall_numerator", "recall_denominator", "precision_numerator", "precision_denominator"]
+
+# BLANC is not reported at document level by the reference scorer, its link counts are computed in process by the
+# scorer, and stored with the document scores.
+blanc_link_names = ["coreference_links", "non_coreference_links"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Significance testing between evaluation runs, using the JSON results produced by the scorer "
+                    "(-jo). All runs should be evaluated against the same gold standard.")
+    parser.add_argument("-r", "--runs", nargs="+", required=True, help="JSON results of the runs to be compared.")
+    parser.add_argument("-n", "--num_samples", type=int, default=10000, help="Number of resamples, default is 10000.")
+    parser.add_argument("-m", "--method", choices=["bootstrap", "randomization"], default="bootstrap",
+                        help="Paired bootstrap or approximate randomization, default is bootstrap.")
+    parser.add_argument("-c", "--confidence", type=float, default=0.95,
+                        help="Confidence level of the bootstrap intervals, default is 0.95.")
+    parser.add_argument("-sd", "--seed", type=int, default=1, help="Random seed.")
+    parser.add_argument("-o", "--output", help="Optional output path, standard out by default.")
+    parser.add_argument("-b", "--debug", help="turn debug mode on", action="store_true")
+
+    args = parser.parse_args()
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s : %(message)s'))
+    logger.addHandler(stream_handler)
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    if numpy is None:
+        utils.terminate_with_error("NumPy is required for significance testing.")
+
+    runs = []
+    for path in args.runs:
+        with open(path) as f:
+            runs.append(json.load(f))
+    run_names = [os.path.basename(path) for path in args.runs]
+
+    doc_ids = get_common_doc_ids(runs, run_names)
+    random_state = numpy.random.RandomState(args.seed)
+
+    out = sys.stdout
+    if args.output is not None:
+        utils.create_parent_dir(args.output)
+        out = open(args.output, 'w')
+
+    for metric_name, (stats, metric_func) in get_all_metrics(runs, doc_ids):
+        if args.method == "bootstrap":
+            scores, intervals, p_values = paired_bootstrap(stats, metric_func, args.num_samples, args.confidence,
+                                                           random_state)
+        else:
+            scores = metric_func(stats.sum(axis=1))
+            intervals = None
+            p_values = approximate_randomization(stats, metric_func, args.num_samples, random_state)
+        write_results(out, metric_name, run_names, scores, intervals, p_values, args.confidence)
+
+    if out is not sys.stdout:
+        out.close()
+
+
+def get_common_doc_ids(runs, run_names):
+    """
+    Find the documents scored in all the runs.
+    """
+    doc_id_sets = [set(doc["doc_id"] for doc in run["documents"]) for run in runs]
+    common = set.intersection(*doc_id_sets)
+
+    for name, doc_id_set in zip(run_names, doc_id_sets):
+        if len(doc_id_set) != len(common):
+            logger.warning("Run [%s] contains %d documents not found in other runs, they will be ignored." % (
+                name, len(doc_id_set) - len(common)))
+
+    return sorted(common)
+
+
+def get_mention_stats(runs, doc_ids, score_name):
+    """
+    Collect the mention sufficient statistics as an array of (runs, documents, [tp, #gold, #system]). Documents
+    without gold mentions are not counted, in the same way as the scorer's micro average.
+    """
+    stats = numpy.zeros((len(runs), len(doc_ids), 3))
+    doc_index = dict((doc_id, i) for i, doc_id in enumerate(doc_ids))
+    for run_index, run in enumerate(runs):
+        for doc in run["documents"]:
+            if doc["doc_id"] not in doc_index or doc["num_gold"] == 0:
+                continue
+            stats[run_index, doc_index[doc["doc_id"]]] = [doc["scores"][score_name]["tp"], doc["num_gold"],
+                                                          doc["num_system"]]
+    return stats
+
+
+def get_num_counts(metric):
+    return len(coref_count_names) * (len(blanc_link_names) if metric == "blanc" else 1)
+
+
+def get_doc_counts(coreference, metric):
+    """
+    Find the counts of each document of the metric.
+    :param coreference: The coreference results of one run.
+    :return: Map from doc id to the counts, which are recall and precision numerators and denominators, of the
+    coreference links then the non-coreference links for BLANC.
+    """
+    if metric == "blanc":
+        return dict((doc["doc_id"], [doc["metrics"]["blanc"][link][name] for link in blanc_link_names for name in
+                                     coref_count_names]) for doc in coreference["documents"])
+    return dict((doc_id, [details[name] for name in coref_count_names]) for doc_id, details in
+                coreference["document_details"][metric].iteritems())
+
+
+def is_metric_available(run, metric):
+    coreference = run.get("coreference", {})
+    if metric == "blanc":
+        return all("blanc" in doc.get("metrics", {}) for doc in coreference.get("documents", []))
+    return metric in coreference.get("document_details", {})
+
+
+def get_coref_stats(runs, doc_ids, metric_names):
+    """
+    Collect the coreference sufficient statistics as an array of (runs, documents, [counts of each metric]).
+    """
+    stats = numpy.zeros((len(runs), len(doc_ids), sum(get_num_counts(m) for m in metric_names)))
+    for run_index, run in enumerate(runs):
+        all_doc_counts = [get_doc_counts(run["coreference"], metric) for metric in metric_names]
+        for doc_index, doc_id in enumerate(doc_ids):
+            counts = []
+            for metric, doc_counts in zip(metric_names, all_doc_counts):
+                counts.extend(doc_counts.get(doc_id, [0] * get_num_counts(metric)))
+            stats[run_index, doc_index] = counts
+    return stats
+
+
+def mention_f1(sums):
+    """
+    Micro F1 of summed mention statistics, the F1 of precision (tp / #system) and recall (tp / #gold) is the same as
+    2 * tp / (#gold + #system).
+    :param sums: Array of summed statistics, the last dimension is [tp, #gold, #system].
+    """
+    return 100 * safe_divide(2 * sums[..., 0], sums[..., 1] + sums[..., 2])
+
+
+def coref_f1(sums):
+    """
+    Coreference F1 of summed counts, the last dimension is [recall numerator, recall denominator, precision
+    numerator, precision denominator].
+    """
+    recall = safe_divide(sums[..., 0], sums[..., 1])
+    precision = safe_divide(sums[..., 2], sums[..., 3])
+    return 100 * safe_divide(2 * precision * recall, precision + recall)
+
+
+def blanc_f1(sums):
+    """
+    BLANC F1 of summed link counts, the average F1 of the coreference and non-coreference links, in the same way as
+    the reference scorer, where a link type without any key link is not considered.
+    """
+    coref_link_f1 = coref_f1(sums[..., :len(coref_count_names)])
+    non_coref_link_f1 = coref_f1(sums[..., len(coref_count_names):])
+    has_coref_links = sums[..., 1] > 0
+    has_non_coref_links = sums[..., len(coref_count_names) + 1] > 0
+    return numpy.where(has_coref_links & has_non_coref_links, (coref_link_f1 + non_coref_link_f1) / 2,
+                       numpy.where(has_coref_links, coref_link_f1,
+                                   numpy.where(has_non_coref_links, non_coref_link_f1, 0.0)))
+
+
+def get_metric_func(metric):
+    return blanc_f1 if metric == "blanc" else coref_f1
+
+
+def conll_average(sums):
+    """
+    Average F1 of the CoNLL metrics, the counts of each metric are concatenated in the last dimension, in the order of
+    conll_metric_names.
+    """
+    total = 0
+    begin = 0
+    for metric in conll_metric_names:
+        end = begin + get_num_counts(metric)
+        total += get_metric_func(metric)(sums[..., begin:end])
+        begin = end
+    return total / len(conll_metric_names)
+
+
+def safe_divide(n, dn):
+    """
+    Element-wise division, where division by zero gives zero.
+    """
+    return numpy.where(dn > 0, n / numpy.where(dn > 0, dn, 1), 0.0)
+
+
+def get_all_metrics(runs, doc_ids):
+    """
+    Collect the statistics and the metric function of all metrics available in the runs.
+    :return: An ordered list of (metric name, (statistics, metric function)).
+    """
+    metrics = []
+    for score_name in mention_score_names:
+        if all(score_name in run["micro_average"] for run in runs):
+            metrics.append(("Mention F1 (%s)" % score_name, (get_mention_stats(runs, doc_ids, score_name),
+                                                             mention_f1)))
+
+    if all("coreference" in run and "document_details" in run["coreference"] for run in runs):
+        available = [m for m in Config.conll_metrics if all(is_metric_available(run, m) for run in runs)]
+        for metric in available:
+            metrics.append(("Coreference %s" % metric, (get_coref_stats(runs, doc_ids, [metric]),
+                                                        get_metric_func(metric))))
+        if all(m in available for m in conll_metric_names):
+            metrics.append(("Coreference CoNLL average (%s)" % ",".join(conll_metric_names),
+                            (get_coref_stats(runs, doc_ids, conll_metric_names), conll_average)))
+        else:
+            logger.info("Not all the CoNLL metrics are found in all runs, will not test the CoNLL average.")
+    else:
+        logger.info("Coreference results are not found in all runs, will only test mention scores.")
+
+    return metrics
+
+
+def resample_weights(num_docs, num_samples, random_state):
+    """
+    Each resample is represented by how many times each document is drawn.
+    :return: An array of (samples, documents).
+    """
+    return random_state.multinomial(num_docs, [1.0 / num_docs] * num_docs, size=num_samples).astype(numpy.float64)
+
+
+def paired_bootstrap(stats, metric_func, num_samples, confidence, random_state):
+    """
+    Paired bootstrap test, all the runs share the same resamples.
+    :param stats: Array of (runs, documents, statistics).
+    :param metric_func: Function that compute the score from summed statistics.
+    :param num_samples: Number of resamples.
+    :param confidence: Confidence level of the intervals.
+    :param random_state: NumPy random state.
+    :return: The scores, the confidence intervals of each run, and the p-values between each pair of runs, where
+    p_values[i][j] is the fraction of resamples that run j does not beat run i, smoothed in the same way as
+    approximate_randomization so that it is never 0.
+    """
+    num_runs, num_docs, _ = stats.shape
+    weights = resample_weights(num_docs, num_samples, random_state)
+
+    scores = metric_func(stats.sum(axis=1))
+
+    # Array of (runs, samples), each resampled sum is a weighted sum of the documents.
+    sampled_scores = numpy.array([metric_func(weights.dot(stats[r])) for r in range(num_runs)])
+
+    alpha = (1 - confidence) / 2
+    intervals = numpy.percentile(sampled_scores, [100 * alpha, 100 * (1 - alpha)], axis=1).T
+
+    p_values = numpy.ones((num_runs, num_runs))
+    for i in range(num_runs):
+        for j in range(num_runs):
+            if i != j:
+                p_values[i, j] = (numpy.sum(sampled_scores[j] <= sampled_scores[i]) + 1.0) / (num_samples + 1)
+
+    return scores, intervals, p_values
+
+
+def approximate_randomization(stats, metric_func, num_samples, random_state):
+    """
+    Approximate randomization test between each pair of runs, the document statistics of the two runs are swapped
+    randomly.
+    :return: The two-sided p-values between each pair of runs.
+    """
+    num_runs, num_docs, _ = stats.shape
+
+    p_values = numpy.ones((num_runs, num_runs))
+    for i in range(num_runs):
+        for j in range(i + 1, num_runs):
+            observed = abs(metric_func(stats[i].sum(axis=0)) - metric_func(stats[j].sum(axis=0)))
+
+            # Array of (samples, documents), 1 means the statistics of this document are swapped.
+            swaps = random_state.randint(0, 2, size=(num_samples, num_docs)).astype(numpy.float64)
+            difference = stats[j] - stats[i]
+            sums_i = stats[i].sum(axis=0) + swaps.dot(difference)
+            sums_j = stats[j].sum(axis=0) - swaps.dot(difference)
+
+            shuffled = numpy.abs(metric_func(sums_i) - metric_func(sums_j))
+            p_value = (numpy.sum(shuffled >= observed - 1e-9) + 1.0) / (num_samples + 1)
+            p_values[i, j] = p_value
+            p_values[j, i] = p_value
+
+    return p_values
+
+
+def write_results(out, metric_name, run_names, scores, intervals, p_values, confidence):
+    name_width = max(len(name) for name in run_names)
+
+    out.write("=======%s=========\n" % metric_name)
+    if intervals is not None:
+        out.write("%s\tScore\tCI (%d%%)\n" % ("Run".ljust(name_width), 100 * confidence))
+        for name, score, (low, high) in zip(run_names, scores, intervals):
+            out.write("%s\t%.2f\t[%.2f, %.2f]\n" % (name.ljust(name_width), score, low, high))
+    else:
+        out.write("%s\tScore\n" % "Run".ljust(name_width))
+        for name, score in zip(run_names, scores):
+            out.write("%s\t%.2f\n" % (name.ljust(name_width), score))
+
+    if len(run_names) > 1:
+        out.write("Pairwise p-values:\n")
+        for i in range(len(run_names)):
+            for j in range(i + 1, len(run_names)):
+                out.write("%s vs. %s\tDiff\t%.2f\tp-value\t%.4f\n" % (
+                    run_names[i], run_names[j], scores[j] - scores[i],
+                    p_values[i, j] if scores[j] >= scores[i] else p_values[j, i]))
+    out.write("\n")
+
+
+if __name__ == "__main__":
+    main()
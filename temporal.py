@@ -6,10 +6,11 @@ Utilities to convert AFTER relations into TimeML format and compute the scoring
 
 import logging
 import os
-import subprocess
-from xml.dom import minidom
-from xml.etree import ElementTree
-from xml.etree.ElementTree import Element, SubElement
+import threading
+import zipfile
+from contextlib import closing
+from cStringIO import StringIO
+from xml.sax.saxutils import quoteattr
 
 from config import Config
 from utils import TransitiveGraph
@@ -17,6 +18,10 @@ import utils
 
 logger = logging.getLogger()
 
+# The TimeML evaluator keeps the counts in its module and writes to the standard output, so only one evaluation can run
+# at a time.
+eval_lock = threading.Lock()
+
 
 def validate(nuggets, edges_by_type, gold_cluster_lookup, gold_clusters):
     """
@@ -56,26 +61,79 @@ def validate(nuggets, edges_by_type, gold_cluster_lookup, gold_clusters):
     return True
 
 
-def make_event(parent, eid):
-    event = SubElement(parent, "EVENT")
-    event.set("eid", eid)
+def xml_element(tag, attributes):
+    """
+    Format an empty XML element, the attributes are sorted by name, same as the ElementTree serializer.
+    """
+    return "<%s %s/>" % (tag, " ".join("%s=%s" % (name, quoteattr(value)) for name, value in sorted(attributes)))
+
 
+class TimeMLWriter:
+    """
+    Write TimeML files directly as text. The nodes (events and instances) of a document are formatted once, and shared
+    by the files of all link types, only the links are formatted for each file.
+
+    The pretty output is the same as the indented XML produced by minidom, the compact output does not indent lines.
+    """
 
-def create_root():
-    timeml = Element('TimML')
-    timeml.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
-    timeml.set("xsi:noNamespaceSchemaLocation", "http://timeml.org/timeMLdocs/TimeML_1.2.1.xsd")
+    root_attributes = [("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance"),
+                       ("xsi:noNamespaceSchemaLocation", "http://timeml.org/timeMLdocs/TimeML_1.2.1.xsd")]
 
-    # Add a dummy DCT (document creation time).
-    dct = SubElement(timeml, "DCT")
-    timex3 = SubElement(dct, "TIMEX3")
-    timex3.set("tid", "t0")
-    timex3.set("type", "TIME")
-    timex3.set("value", "")
-    timex3.set("scriptFunction", "false")
-    timex3.set("functionInDocument", "CREATION_TIME")
+    # A dummy DCT (document creation time).
+    dct_attributes = [("tid", "t0"), ("type", "TIME"), ("value", ""), ("scriptFunction", "false"),
+                      ("functionInDocument", "CREATION_TIME")]
 
-    return timeml
+    def __init__(self, nodes, pretty=True):
+        self.indent = "  " if pretty else ""
+        self.header = self.format_header(nodes)
+
+    def format_header(self, nodes):
+        lines = ['<?xml version="1.0" ?>',
+                 "<TimML %s>" % " ".join("%s=%s" % (name, quoteattr(value)) for name, value in self.root_attributes),
+                 self.indent + "<DCT>",
+                 self.indent * 2 + xml_element("TIMEX3", self.dct_attributes),
+                 self.indent + "</DCT>"]
+
+        if len(nodes) > 0:
+            lines.append(self.indent + "<TEXT>")
+            lines.extend(self.indent * 2 + xml_element("EVENT", [("eid", node)]) for node in nodes)
+            lines.append(self.indent + "</TEXT>")
+        else:
+            lines.append(self.indent + "<TEXT/>")
+
+        lines.extend(self.indent + xml_element("MAKEINSTANCE", [("eiid", "instance_" + node), ("eid", node)]) for node
+                     in nodes)
+
+        return "".join(l + "\n" for l in lines)
+
+    def write(self, out, links, normalized_nodes):
+        """
+        Write one TimeML file.
+        :param out: The output file.
+        :param links: The links to be written, as (left, right, relation type).
+        :param normalized_nodes: Map from the link arguments to the TimeML nodes.
+        """
+        out.write(self.header)
+
+        unknown_nodes = set()
+
+        for left, right, relation_type in links:
+            if left not in normalized_nodes:
+                unknown_nodes.add(left)
+                continue
+
+            if right not in normalized_nodes:
+                unknown_nodes.add(right)
+                continue
+
+            out.write(self.indent + xml_element("TLINK", [("lid", "l0"), ("relType", relation_type),
+                                                          ("eventInstanceID", normalized_nodes[left]),
+                                                          ("relatedToEventInstance", normalized_nodes[right])]) + "\n")
+
+        out.write("</TimML>\n")
+
+        for node in unknown_nodes:
+            logger.error("Node %s is not a known node." % node)
 
 
 def convert_links(links_by_name):
@@ -114,15 +172,6 @@ def convert_name(name):
         logger.warn("Unsupported relations name %s found." % name)
 
 
-def pretty_xml(element):
-    """
-    Return a pretty-printed XML string for the Element.
-    """
-    rough_string = ElementTree.tostring(element, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    return reparsed.toprettyxml(indent="  ")
-
-
 def find_equivalent_sets(clusters, nodes):
     node_2_set = {}
     set_2_nodes = {}
@@ -261,24 +310,111 @@ def compute_reduced_graph(set_links):
     return reduced_links
 
 
-def run_eval(link_type, script_output, gold_dir, sys_dir):
-    gold_sub_dir = os.path.join(Config.script_result_dir, link_type, gold_dir)
-    sys_sub_dir = os.path.join(Config.script_result_dir, link_type, sys_dir)
+def run_eval(script_result_dir, link_type, script_output, gold_dir, sys_dir, archive=None):
+    """
+    Run the TimeML evaluator on the given directories, the evaluator output is written to the script output.
+    :param script_result_dir: The result directory of this evaluation.
+    :param script_output: Path of the evaluator output, the output is discarded if not provided.
+    :param archive: The zip archive containing the TimeML files, if they are not written as separate files.
+    :return: The evaluation counts and scores, read directly from the evaluator.
+    """
+    import sys
+    import evaluation_relations.temporal_evaluation as eval
 
+    with eval_lock:
+        old_stdout = sys.stdout
+        eval.global_prec_matched = 0
+        eval.global_rec_matched = 0
+        eval.global_system_total = 0
+        eval.global_gold_total = 0
+
+        out_file = StringIO() if script_output is None else open(script_output, 'wb', 0)
+        # The evaluator prints to stdout, which is restored even if it fails, the other threads still print there.
+        try:
+            with closing(out_file):
+                if archive is None:
+                    gold_sub_dir = os.path.join(script_result_dir, link_type, gold_dir)
+                    sys_sub_dir = os.path.join(script_result_dir, link_type, sys_dir)
+                    logger.info("Evaluating directory: %s" % sys_sub_dir)
+                    sys.stdout = out_file
+                    eval.input_and_evaluate(
+                        [Config.temp_eval_executable, gold_sub_dir, sys_sub_dir, 0, "implicit_in_recall"])
+                else:
+                    logger.info("Evaluating archive directory: %s" % get_archive_dir(link_type, sys_dir))
+                    sys.stdout = out_file
+                    eval.debug = 0
+                    eval.evaluation_method = "implicit_in_recall"
+                    eval.evaluate_archive(archive, get_archive_dir(link_type, gold_dir),
+                                          get_archive_dir(link_type, sys_dir))
+                    eval.final_score()
+        finally:
+            sys.stdout = old_stdout
+
+        return get_eval_scores(eval.global_prec_matched, eval.global_rec_matched, eval.global_system_total,
+                               eval.global_gold_total)
+
+
+def write_eval_output(scores, script_output):
+    """
+    Write the evaluator output from the matching counts, such as the counts summed from several evaluations, in the same
+    form as the TimeML evaluator.
+    :param scores: The counts and scores, as returned by run_eval.
+    :param script_output: Path of the evaluator output.
+    """
     import sys
-    old_stdout = sys.stdout
     import evaluation_relations.temporal_evaluation as eval
-    eval.global_prec_matched = 0
-    eval.global_rec_matched = 0
-    eval.global_system_total = 0
-    eval.global_gold_total = 0
 
-    with open(script_output, 'wb', 0) as out_file:
-        logger.info("Evaluating directory: %s" % sys_sub_dir)
-        sys.stdout = out_file
-        eval.input_and_evaluate([Config.temp_eval_executable, gold_sub_dir, sys_sub_dir, 0, "implicit_in_recall"])
+    with eval_lock:
+        old_stdout = sys.stdout
+        eval.global_prec_matched = scores["precision_matched"]
+        eval.global_rec_matched = scores["recall_matched"]
+        eval.global_system_total = scores["system_total"]
+        eval.global_gold_total = scores["gold_total"]
+        eval.evaluation_method = "implicit_in_recall"
+
+        utils.create_parent_dir(script_output)
+        with open(script_output, 'wb', 0) as out_file:
+            sys.stdout = out_file
+            try:
+                eval.final_score()
+            finally:
+                sys.stdout = old_stdout
+
+
+def get_script_output(config, link_type, script_out):
+    """
+    The path of the evaluator output of the link type, the output is not kept if there is no result directory.
+    """
+    if config.script_result_dir is None:
+        return None
+    return os.path.join(config.script_result_dir, link_type, script_out)
+
 
-    sys.stdout = old_stdout
+def get_archive_dir(link_type, subdir):
+    """
+    The directory of the TimeML files in the archive, the same layout as the files under the result directory.
+    """
+    return "%s/%s" % (link_type, subdir)
+
+
+def get_eval_scores(prec_matched, rec_matched, system_total, gold_total):
+    """
+    Compute the temporal awareness scores from the matching counts, in the same way as the TimeML evaluator.
+    :return: A map containing the counts, and the precision, recall, F1 in percentage.
+    """
+    precision = prec_matched * 1.0 / system_total if system_total > 0 else 0
+    recall = rec_matched * 1.0 / gold_total if gold_total > 0 else 0
+    f1 = 2.0 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+
+    return {
+        "precision_matched": prec_matched,
+        "recall_matched": rec_matched,
+        "system_total": system_total,
+        "gold_total": gold_total,
+        "precision": 100 * precision,
+        "recall": 100 * recall,
+        "f1": 100 * f1,
+    }
 
 
 def store_cluster_nodes(gold_clusters, gold_cluster_lookup, gold_nuggets, sys_nuggets, g2s_mapping):
@@ -403,8 +539,11 @@ class TemporalEval:
     Interpreting the Temporal Aspects of Language, Naushad UzZaman, 2012
     """
 
-    def __init__(self, g2s_mapping, gold_nugget_table, raw_gold_links, sys_nugget_table,
+    def __init__(self, context, g2s_mapping, gold_nugget_table, raw_gold_links, sys_nugget_table,
                  raw_sys_links, gold_corefs, sys_corefs):
+        # The evaluation context, where the TimeML files are written.
+        self.context = context
+
         self.gold_nugget_table = gold_nugget_table
         self.sys_nugget_table = sys_nugget_table
 
@@ -439,65 +578,108 @@ class TemporalEval:
         Write the TimeML file to disk.
         :return:
         """
-        # Store another set of time ML nodes that represents clusters.
-        gold_cluster_nodes, sys_cluster_nodes, gold_cluster_to_node, sys_cluster_to_node, rewritten_lookup \
-            = store_cluster_nodes(self.gold_clusters, self.gold_cluster_lookup, self.gold_nuggets,
-                                  self.sys_nuggets, self.g2s_mapping)
+        self.write_all_time_ml(convert_links(self.gold_links_by_type), self.gold_nugget_to_node, self.gold_nodes,
+                               Config.script_gold_dir, doc_id)
+        self.write_all_time_ml(convert_links(self.sys_links_by_type), self.system_nugget_to_node, self.sys_nodes,
+                               Config.script_sys_dir, doc_id)
+
+        if self.context.config.eval_cluster_level_links:
+            # Store another set of time ML nodes that represents clusters.
+            gold_cluster_nodes, sys_cluster_nodes, gold_cluster_to_node, sys_cluster_to_node, rewritten_lookup \
+                = store_cluster_nodes(self.gold_clusters, self.gold_cluster_lookup, self.gold_nuggets,
+                                      self.sys_nuggets, self.g2s_mapping)
+
+            gold_cluster_links = convert_to_cluster_links(self.gold_links_by_type, self.gold_cluster_lookup)
+            sys_cluster_links = convert_to_cluster_links(self.sys_links_by_type, rewritten_lookup)
+
+            self.write_all_time_ml(convert_links(gold_cluster_links), gold_cluster_to_node, gold_cluster_nodes,
+                                   Config.script_gold_dir + "_cluster", doc_id)
+            self.write_all_time_ml(convert_links(sys_cluster_links), sys_cluster_to_node, sys_cluster_nodes,
+                                   Config.script_sys_dir + "_cluster", doc_id)
+
+    def write_all_time_ml(self, links_by_name, normalized_nodes, nodes, subdir, doc_id):
+        """
+        Write out the TimeML files of each link type, and of all the links, into sub directories.
+        :param links_by_name: The converted links of each link type.
+        :param normalized_nodes: Map from the link arguments to the TimeML nodes.
+        :param nodes: All the TimeML nodes.
+        :param subdir: The sub directory to write to, under the directory of each link type.
+        :param doc_id: The document id, used as the file name.
+        :return:
+        """
+        writer = TimeMLWriter(nodes, self.context.config.pretty_time_ml)
 
-        gold_cluster_links = convert_to_cluster_links(self.gold_links_by_type, self.gold_cluster_lookup)
-        sys_cluster_links = convert_to_cluster_links(self.sys_links_by_type, rewritten_lookup)
+        all_links = []
+        for name in Config.script_types:
+            links = links_by_name.get(name, [])
+            self.write(writer, links, normalized_nodes, name, subdir, doc_id)
+            all_links.extend(links)
 
-        gold_time_ml = self.make_all_time_ml(convert_links(self.gold_links_by_type), self.gold_nugget_to_node,
-                                             self.gold_nodes)
-        sys_time_ml = self.make_all_time_ml(convert_links(self.sys_links_by_type), self.system_nugget_to_node,
-                                            self.sys_nodes)
+        self.write(writer, all_links, normalized_nodes, "All", subdir, doc_id)
 
-        gold_cluster_time_ml = self.make_all_time_ml(convert_links(gold_cluster_links), gold_cluster_to_node,
-                                                     gold_cluster_nodes)
-        sys_cluster_time_ml = self.make_all_time_ml(convert_links(sys_cluster_links), sys_cluster_to_node,
-                                                    sys_cluster_nodes)
+    def write(self, writer, links, normalized_nodes, name, subdir, doc_id):
+        time_ml_archive = self.context.state.time_ml_archive
+        if time_ml_archive is not None:
+            time_ml = StringIO()
+            writer.write(time_ml, links, normalized_nodes)
+            time_ml_archive.writestr("%s/%s.tml" % (get_archive_dir(name, subdir), doc_id), time_ml.getvalue())
+            return
 
-        TemporalEval.write(gold_time_ml, Config.script_gold_dir, doc_id)
-        TemporalEval.write(sys_time_ml, Config.script_sys_dir, doc_id)
+        output_dir = os.path.join(self.context.config.script_result_dir, name, subdir)
+        utils.supermakedirs(output_dir)
 
-        if Config.eval_cluster_level_links:
-            TemporalEval.write(gold_cluster_time_ml, Config.script_gold_dir + "_cluster", doc_id)
-            TemporalEval.write(sys_cluster_time_ml, Config.script_sys_dir + "_cluster", doc_id)
+        with open(os.path.join(output_dir, "%s.tml" % doc_id), 'w') as temp_file:
+            writer.write(temp_file, links, normalized_nodes)
 
     @staticmethod
-    def write(time_ml_data, subdir, doc_id):
+    def open_archive(context):
         """
-        Write out time ml files into sub directories.
-        :param time_ml_data:
-        :param time_ml_dir:
-        :param subdir:
-        :return:
+        Store all the TimeML files in a single zip archive under the result directory, instead of writing one file per
+        document and link type. The archive is kept in memory if there is no result directory.
         """
-        for name, time_ml in time_ml_data.iteritems():
-            output_dir = os.path.join(Config.script_result_dir, name, subdir)
-            utils.supermakedirs(output_dir)
-
-            temp_file = open(os.path.join(output_dir, "%s.tml" % doc_id), 'w')
-            temp_file.write(pretty_xml(time_ml))
-            temp_file.close()
+        if context.config.script_result_dir is None:
+            context.state.time_ml_archive_file = StringIO()
+            logger.debug("TimeML files will be stored in memory.")
+        else:
+            context.state.time_ml_archive_file = os.path.join(context.config.script_result_dir,
+                                                              Config.time_ml_archive_name)
+            logger.info("TimeML files will be stored in " + context.state.time_ml_archive_file)
+        context.state.time_ml_archive = zipfile.ZipFile(context.state.time_ml_archive_file, 'w', zipfile.ZIP_STORED,
+                                                        allowZip64=True)
 
     @staticmethod
-    def eval_time_ml():
+    def eval_time_ml(context):
         logger.info("Running TimeML scorer.")
 
+        config = context.config
+        state = context.state
+
+        archive = None
+        if state.time_ml_archive is not None:
+            # Finish writing the archive, and read it back for evaluation.
+            state.time_ml_archive.close()
+            state.time_ml_archive = None
+            archive = zipfile.ZipFile(state.time_ml_archive_file, 'r', allowZip64=True)
+
         for link_type in Config.script_types + ["All"]:
             # Evaluate mention level links.
-            run_eval(link_type, os.path.join(Config.script_result_dir, link_type, Config.script_out),
-                     Config.script_gold_dir, Config.script_sys_dir)
+            state.overall_seq_scores[link_type] = run_eval(
+                config.script_result_dir, link_type, get_script_output(config, link_type, Config.script_out),
+                Config.script_gold_dir, Config.script_sys_dir, archive)
 
-            if Config.eval_cluster_level_links:
+            if config.eval_cluster_level_links:
                 # Evaluate cluster level links.
-                run_eval(link_type, os.path.join(Config.script_result_dir, link_type, Config.script_out_cluster),
-                         Config.script_gold_dir + "_cluster", Config.script_sys_dir + "_cluster")
+                state.overall_seq_cluster_scores[link_type] = run_eval(
+                    config.script_result_dir, link_type,
+                    get_script_output(config, link_type, Config.script_out_cluster),
+                    Config.script_gold_dir + "_cluster", Config.script_sys_dir + "_cluster", archive)
+
+        if archive is not None:
+            archive.close()
 
     @staticmethod
-    def get_eval_output():
-        script_output = os.path.join(Config.script_result_dir, Config.script_out)
+    def get_eval_output(context):
+        script_output = os.path.join(context.config.script_result_dir, Config.script_out)
         with open(script_output, 'r') as f:
             score_line = False
             for l in f:
@@ -507,72 +689,3 @@ class TemporalEval:
 
                 if l.startswith("Temporal Score"):
                     score_line = True
-
-    def make_all_time_ml(self, links_by_name, normalized_nodes, nodes):
-        all_time_ml = {}
-
-        all_links = []
-
-        for name in Config.script_types:
-            if name in links_by_name:
-                links = links_by_name[name]
-                all_time_ml[name] = self.make_time_ml(links, normalized_nodes, nodes)
-                all_links.extend(links)
-            else:
-                all_time_ml[name] = self.make_time_ml([], normalized_nodes, nodes)
-
-        all_time_ml["All"] = self.make_time_ml(all_links, normalized_nodes, nodes)
-
-        return all_time_ml
-
-    def make_time_ml(self, links, normalized_nodes, nodes):
-        # Create the root.
-        time_ml = create_root()
-        # Add TEXT.
-        self.annotate_timeml_events(time_ml, nodes)
-
-        # Add instances.
-        self.create_instance(time_ml, nodes)
-        self.create_tlinks(time_ml, links, normalized_nodes)
-
-        return time_ml
-
-    @staticmethod
-    def create_instance(parent, nodes):
-        for node in nodes:
-            instance = SubElement(parent, "MAKEINSTANCE")
-            instance.set("eiid", "instance_" + node)
-            instance.set("eid", node)
-
-    @staticmethod
-    def annotate_timeml_events(parent, nodes):
-        text = SubElement(parent, "TEXT")
-        for tid in nodes:
-            make_event(text, tid)
-
-    @staticmethod
-    def create_tlinks(time_ml, links, normalized_nodes):
-        lid = 0
-
-        unknown_nodes = set()
-
-        for left, right, relation_type in links:
-            if left not in normalized_nodes:
-                unknown_nodes.add(left)
-                continue
-
-            if right not in normalized_nodes:
-                unknown_nodes.add(right)
-                continue
-
-            normalized_left = normalized_nodes[left]
-            normalized_right = normalized_nodes[right]
-
-            link = SubElement(time_ml, "TLINK")
-            link.set("lid", "l%d" % lid)
-            link.set("relType", relation_type)
-            link.set("eventInstanceID", normalized_left)
-            link.set("relatedToEventInstance", normalized_right)
-
-        for node in unknown_nodes:
-            logger.error("Node %s is not a known node." % node)
@@ -8,10 +8,12 @@ detailed features and usage please refer to the README file.
     Author: Zhengzhong Liu ( liu@cs.cmu.edu )
 """
 import argparse
+import bisect
 import logging
 import sys
 import os
 import errno
+import multiprocessing
 import re
 
 bratSpanMarker = "T"
@@ -29,11 +31,6 @@ coreference_cluster_prefix = "C"
 
 missingAttributePlaceholder = "NOT_ANNOTATED"
 
-text_bounds = {}  # all text bounds
-events = {}  # all events
-atts = {}  # all attributes
-rels = {}  # all relations
-
 out = "converted"
 out_ext = ".tbf"  # short for token based format
 engine_id = "brat_conversion"
@@ -105,6 +102,9 @@ def main():
         "-ae", "--annotation_extension",
         help="any extension appended after docid of annotation files. "
              "Default is " + brat_annotation_ext)
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of processes used to convert the annotation files of a directory, default is 1")
     parser.add_argument(
         "-b", "--debug", help="turn debug mode on", action="store_true")
     parser.set_defaults(debug=False)
@@ -167,13 +167,26 @@ def main():
 
     if args.dir is not None:
         # parse directory
-        count = 0
-        for f in os.listdir(args.dir):
-            if f.endswith(brat_annotation_ext):
-                parse_annotation_file(
-                    os.path.join(args.dir, f), args.token_path, out_file)
-                count += 1
-        logger.info("Finish converting %d files" % count)
+        file_names = sorted((f for f in os.listdir(args.dir) if f.endswith(brat_annotation_ext)),
+                            key=natural_order)
+        tasks = [(os.path.join(args.dir, f), args.token_path) for f in file_names]
+
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs)
+            # The results are returned in the order of the tasks, so the output is the same as the sequential one.
+            converted = pool.imap(convert_annotation_file, tasks)
+        else:
+            pool = None
+            converted = (convert_annotation_file(task) for task in tasks)
+
+        for document in converted:
+            if document is not None:
+                out_file.write(document)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        logger.info("Finish converting %d files" % len(tasks))
     elif args.file is not None:
         # parse one annotation file
         if args.file.endswith(brat_annotation_ext):
@@ -182,13 +195,6 @@ def main():
         logger.error("No annotations provided\n")
 
 
-def clear():
-    text_bounds.clear()  # all text bounds
-    events.clear()  # all events
-    atts.clear()  # all attributes
-    rels.clear()  # all relations
-
-
 def chop(s, begin):
     if s.startswith(begin):
         return s[len(begin):]
@@ -202,6 +208,19 @@ def rchop(s, ending):
 
 
 def parse_annotation_file(file_path, token_dir, of):
+    document = convert_annotation_file((file_path, token_dir))
+    if document is not None:
+        of.write(document)
+
+
+def convert_annotation_file(task):
+    """
+    Convert one annotation file, all the annotations are kept locally so that files can be converted in parallel.
+    :param task: The annotation file path and the token directory (None in character mode).
+    :return: The document in TBF format, or None if the annotation file is not found.
+    """
+    file_path, token_dir = task
+
     # Otherwise use the provided directory to search for it.
     basename = os.path.basename(file_path)
     logger.debug("Processing file " + basename)
@@ -212,14 +231,15 @@ def parse_annotation_file(file_path, token_dir, of):
         f = open(file_path)
         text_id = rchop(os.path.basename(f.name), brat_annotation_ext)
         logger.debug("Document id is " + text_id)
-        read_all_anno(f)
+        text_bounds, events, atts, rels = read_all_anno(f)
 
         # Match from text bound to token ids.
+        text_bound_id_2_token_id = {}
         if is_token_mode:
             token_path = os.path.join(token_dir, basename[:-len(brat_annotation_ext)] + token_offset_ext)
             if os.path.isfile(token_path):
                 token_file = open(token_path)
-                text_bound_id_2_token_id = get_text_bound_2_token_mapping(token_file)
+                text_bound_id_2_token_id = get_text_bound_2_token_mapping(token_file, text_bounds)
 
         eids = events.keys()
         eids.sort(key=natural_order)
@@ -243,8 +263,10 @@ def parse_annotation_file(file_path, token_dir, of):
                     filtered.append((rel_id, a1, a2))
             filtered_rels[rel_name] = filtered
 
+        lines = []
+
         # write begin of document
-        of.write(outputBodMarker + " " + text_id + "\n")
+        lines.append(outputBodMarker + " " + text_id + "\n")
         # write each mention in a line
         for eid in eids:
             event_type = events[eid][0][0]
@@ -274,14 +296,15 @@ def parse_annotation_file(file_path, token_dir, of):
 
             eid2sorted_tokens[eid] = tuple(span_tuple)
 
-            of.write("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
+            lines.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\n" % (
                 engine_id, text_id, eid, span_str, text, event_type, realis_status))
 
         for rel_name, relations in filtered_rels.iteritems():
             if rel_name != coreference_relation_name:
                 for relation in relations:
-                    if relation[1] in eids and relation[2] in eids:
-                        of.write(
+                    # The relations of the mentions skipped above (such as the ones without tokens) are removed.
+                    if relation[1] in eid2sorted_tokens and relation[2] in eid2sorted_tokens:
+                        lines.append(
                             "%s%s\t%s\t%s,%s\n" % (
                                 outputRelationMarker, rel_name, relation[0], relation[1],
                                 relation[2]))
@@ -289,15 +312,16 @@ def parse_annotation_file(file_path, token_dir, of):
                 logger.debug("Resolving coreference")
                 resolved_coref_chains = resolve_transitive_closure_and_duplicates(relations, eid2sorted_tokens)
                 for chain in resolved_coref_chains:
-                    of.write("%s%s\t%s%s\t%s\n" % (
+                    lines.append("%s%s\t%s%s\t%s\n" % (
                         outputRelationMarker, rel_name, coreference_cluster_prefix, chain[0], ",".join(chain[1])))
 
                     # write end of sentence
-        of.write(outputEodMarker + "\n")
+        lines.append(outputEodMarker + "\n")
+        return "".join(lines)
     else:
         # the missing file will be skipped but others will still be done
         logger.error("Annotation path %s not found. Will still try to process other annotation files." % file_path)
-    clear()
+        return None
 
 
 def transitive_merge(clusters):
@@ -337,7 +361,8 @@ def resolve_transitive_closure_and_duplicates(coref_relations, eid2span):
     """
     Resolve
     :param coref_relations: Raw coreference relation string read from annotation file.
-    :param eid2span: Map from event id to its span representation.
+    :param eid2span: Map from event id to its span representation, the mentions not in the map are not converted,
+    so they are removed from the clusters.
     :return:
     """
     clusters = []
@@ -366,9 +391,16 @@ def resolve_transitive_closure_and_duplicates(coref_relations, eid2span):
     id = 0
 
     for raw_cluster_mentions in clusters:
+        converted_mentions = [mention for mention in raw_cluster_mentions if mention in eid2span]
+        if len(converted_mentions) < len(raw_cluster_mentions):
+            logger.warning("Removing mentions not converted from coreference cluster: [%s]" % ",".join(
+                sorted((m for m in raw_cluster_mentions if m not in eid2span), key=natural_order)))
+        if len(converted_mentions) < 2:
+            continue
+
         cluster_span_control = set()
         deduplicated_cluster_mentions = []
-        for mention in raw_cluster_mentions:
+        for mention in converted_mentions:
             span = eid2span[mention]
             if span not in cluster_span_control:
                 deduplicated_cluster_mentions.append(mention)
@@ -382,8 +414,9 @@ def resolve_transitive_closure_and_duplicates(coref_relations, eid2span):
     return clusters_with_id
 
 
-def get_text_bound_2_token_mapping(token_file):
+def get_text_bound_2_token_mapping(token_file, text_bounds):
     text_bound_id_2_token_id = {}
+    text_bound_index = TextBoundIndex(text_bounds)
 
     is_first_line = True
     for tokenLine in token_file:
@@ -403,22 +436,50 @@ def get_text_bound_2_token_mapping(token_file):
         token_span = (int(fields[token_offset_fields[0]]), int(fields[token_offset_fields[1]]))
 
         # One token maps to multiple text bound is possible
-        for text_bound_id in find_corresponding_text_bound(token_span):
+        for text_bound_id in find_corresponding_text_bound(token_span, text_bound_index):
             if text_bound_id not in text_bound_id_2_token_id:
                 text_bound_id_2_token_id[text_bound_id] = []
             text_bound_id_2_token_id[text_bound_id].append(fields[0])
     return text_bound_id_2_token_id
 
 
-def find_corresponding_text_bound(token_span):
+class TextBoundIndex:
+    """
+    A sorted index of the text bound spans, so that a token only need to be compared with the spans that begins
+    nearby. A span covering the token cannot begin before the token end minus the longest span length, and a span
+    covered by the token begins within the token.
+    """
+
+    def __init__(self, all_text_bounds):
+        entries = []
+        for text_bound_id, text_bound in all_text_bounds.iteritems():
+            for ann_span in text_bound[1]:
+                entries.append((ann_span[0], ann_span[1], text_bound_id))
+        entries.sort()
+
+        self.begins = [e[0] for e in entries]
+        self.entries = entries
+        self.max_length = max(e[1] - e[0] for e in entries) if entries else 0
+
+    def candidates(self, token_span):
+        """
+        Spans that begin in the range where they may cover or be covered by the token span.
+        """
+        lowest_begin = min(token_span[0], token_span[1] - self.max_length)
+        start = bisect.bisect_left(self.begins, lowest_begin)
+        end = bisect.bisect_right(self.begins, token_span[1])
+        return self.entries[start:end]
+
+
+def find_corresponding_text_bound(token_span, text_bound_index):
     text_bound_ids = []
 
-    for text_bound_id, text_bound in text_bounds.iteritems():
-        for ann_span in text_bound[1]:
-            if covers(ann_span, token_span):
-                text_bound_ids.append(text_bound_id)
-            elif covers(token_span, ann_span):
-                text_bound_ids.append(text_bound_id)
+    for ann_begin, ann_end, text_bound_id in text_bound_index.candidates(token_span):
+        ann_span = (ann_begin, ann_end)
+        if covers(ann_span, token_span):
+            text_bound_ids.append(text_bound_id)
+        elif covers(token_span, ann_span):
+            text_bound_ids.append(text_bound_id)
 
     return text_bound_ids
 
@@ -492,6 +553,11 @@ def parse_relation(fields):
 
 
 def read_all_anno(f):
+    text_bounds = {}  # all text bounds
+    events = {}  # all events
+    atts = {}  # all attributes
+    rels = {}  # all relations
+
     for line in f:
         if line.startswith(outputCommentMarker):
             pass
@@ -515,6 +581,8 @@ def read_all_anno(f):
                 rels[rel_name] = []
             rels[rel_name].append((rel_id, a1, a2))
 
+    return text_bounds, events, atts, rels
+
 
 if __name__ == "__main__":
     main()
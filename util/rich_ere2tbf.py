@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+"""
+    Convert LDC's Rich ERE XML annotations directly to the TBF format, the same output as the Rich ERE to TBF converter
+(bin/rich_ere_to_tbf_converter.jar), without starting a JVM. The XML files are parsed incrementally, only one event
+mention is kept in memory as an XML element at a time, and all files of a directory are written to one output in a
+single pass.
+
+    When a token directory is provided, mentions are mapped to token ids in the same way as brat2tbf.py.
+
+    Author: Zhengzhong Liu ( liu@cs.cmu.edu )
+"""
+import argparse
+import errno
+import logging
+import os
+import sys
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+import brat2tbf
+
+outputBodMarker = "#BeginOfDocument"  # mark begin of a document
+outputEodMarker = "#EndOfDocument"  # mark end of a document
+outputRelationMarker = "@"  # append before relation
+coreference_relation_name = "Coreference"  # mark coreference
+coreference_cluster_prefix = "C"
+
+event_mention_prefix = "em-"
+hopper_prefix = "h-"
+
+input_mode_event_nugget = "event-nugget"
+
+# Subtypes written in one word in Rich ERE, but hyphenated in the TBF types.
+hyphenated_subtypes = {
+    "Transfermoney": "Transfer-Money",
+    "Transferownership": "Transfer-Ownership",
+    "Startorg": "Start-Org",
+    "Endorg": "End-Org",
+    "Declarebankruptcy": "Declare-Bankruptcy",
+    "Mergeorg": "Merge-Org",
+    "Startposition": "Start-Position",
+    "Endposition": "End-Position",
+    "Arrestjail": "Arrest-Jail",
+    "Chargeindict": "Charge-Indict",
+    "Releaseparole": "Release-Parole",
+    "Trialhearing": "Trial-Hearing",
+    "Transportartifact": "Transport-Artifact",
+    "Transportperson": "Transport-Person",
+}
+
+out = "converted"
+out_ext = ".tbf"
+engine_id = "rich_ere"
+annotation_ext = "rich_ere.xml"
+inner_span_joiner = ","
+
+logger = logging.getLogger()
+
+
+def main():
+    global out
+    global out_ext
+    global engine_id
+    global annotation_ext
+
+    parser = argparse.ArgumentParser(
+        description="This converter converts Rich ERE XML annotation files to one single TBF file. It accepts a single "
+                    "file or a directory containing the annotation files. If a token directory is provided, the "
+                    "mentions are represented as token ids, otherwise as character offsets.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-d", "--dir", help="directory of the annotation files")
+    group.add_argument("-f", "--file", help="name of one annotation file")
+
+    parser.add_argument("-t", "--token_path", help="provide directory to search for the corresponding token files if "
+                                                   "you use the token based format.")
+    parser.add_argument("-o", "--out", help="output path, '" + out + "' in the current path by default")
+    parser.add_argument("-oe", "--ext", help="output extension, '" + out_ext + "' by default")
+    parser.add_argument("-i", "--eid", help="an engine id that will appears at each line of the output file. '" +
+                                            engine_id + "' will be used by default")
+    parser.add_argument("-w", "--overwrite", help="force overwrite existing output file", action='store_true')
+    parser.add_argument(
+        "-m", "--input_mode", help="input mode, use '%s' for files without hoppers, where no coreference is produced"
+                                   % input_mode_event_nugget)
+    parser.add_argument(
+        "-of", "--offset_field", help="A pair of integer indicates which column we should read the offset in the token "
+                                      "mapping file, index starts at 0, default value will be %s"
+                                      % brat2tbf.token_offset_fields)
+    parser.add_argument("-te", "--token_table_extension",
+                        help="any extension appended after docid of token table files. "
+                             "Default is " + brat2tbf.token_offset_ext)
+    parser.add_argument("-ae", "--annotation_extension",
+                        help="any extension appended after docid of annotation files. Default is " + annotation_ext)
+    parser.add_argument("-b", "--debug", help="turn debug mode on", action="store_true")
+    parser.set_defaults(debug=False)
+
+    args = parser.parse_args()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    logger.addHandler(stream_handler)
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+    stream_handler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s : %(message)s'))
+
+    if args.input_mode is not None and args.input_mode != input_mode_event_nugget:
+        logger.error("Invalid input mode: %s" % args.input_mode)
+        sys.exit(1)
+
+    if args.token_path is not None:
+        if not os.path.isdir(args.token_path):
+            logger.error("Token directory does not exists (or is not a directory) \n\n")
+            parser.print_help()
+            sys.exit(1)
+    else:
+        logger.info("Token directory not provided, will generate character based format.")
+
+    # The token alignment is done by brat2tbf, so the token settings are set there.
+    if args.token_table_extension is not None:
+        brat2tbf.token_offset_ext = args.token_table_extension
+
+    if args.offset_field is not None:
+        try:
+            brat2tbf.token_offset_fields = [int(x) for x in args.offset_field.split(",")]
+        except ValueError as _:
+            logger.error("Should provide two integer with comma in between")
+
+    if args.annotation_extension is not None:
+        annotation_ext = args.annotation_extension
+    if args.out is not None:
+        out = args.out
+    if args.ext is not None:
+        out_ext = args.ext
+    if args.eid is not None:
+        engine_id = args.eid
+
+    # Ensure output directory exists.
+    try:
+        head, tail = os.path.split(out)
+        if head != "":
+            os.makedirs(head)
+    except OSError:
+        (t, v, trace) = sys.exc_info()
+        if v.errno != errno.EEXIST:
+            raise
+
+    out_path = out + out_ext
+    if not args.overwrite and os.path.isfile(out_path):
+        logger.error("Output path [%s] already exists, use '-w' flag to force overwrite" % out_path)
+        sys.exit(1)
+
+    with_hoppers = args.input_mode != input_mode_event_nugget
+
+    with open(out_path, 'w') as out_file:
+        if args.dir is not None:
+            file_names = sorted((f for f in os.listdir(args.dir) if f.endswith(annotation_ext)),
+                                key=brat2tbf.natural_order)
+            for f in file_names:
+                convert_file(os.path.join(args.dir, f), args.token_path, with_hoppers, out_file)
+            logger.info("Finish converting %d files" % len(file_names))
+        elif args.file.endswith(annotation_ext):
+            convert_file(args.file, args.token_path, with_hoppers, out_file)
+
+
+def to_event_type(ere_type, ere_subtype):
+    subtype = capitalize(ere_subtype)
+    return capitalize(ere_type) + "_" + hyphenated_subtypes.get(subtype, subtype)
+
+
+def capitalize(s):
+    return " ".join(w[:1].upper() + w[1:] for w in s.split(" "))
+
+
+def parse_id(id_str, prefix):
+    """
+    Parse the number of a Rich ERE id, such as 12 of "em-12".
+    :return: The number, or None if the id is invalid, the element is then skipped.
+    """
+    if id_str is None or not id_str.startswith(prefix) or not id_str[len(prefix):].isdigit():
+        logger.warning("Invalid id [%s], it should be [%s] followed by a number, the element will be ignored."
+                       % (id_str, prefix))
+        return None
+    return int(id_str[len(prefix):])
+
+
+def read_event_mentions(xml_path, with_hoppers):
+    """
+    Read the event mentions incrementally from a Rich ERE file, the elements are discarded once read.
+    :param xml_path: Path to the Rich ERE file.
+    :param with_hoppers: Whether the event mentions are grouped in hoppers.
+    :return: The event mentions as (mention id, begin, end, text, event type, realis), and the mention ids of each
+    hopper, in document order.
+    """
+    mentions = []
+    hoppers = []
+
+    hopper_id = None
+    parents = []
+
+    for event, elem in ElementTree.iterparse(xml_path, events=("start", "end")):
+        if event == "start":
+            parents.append(elem.tag)
+            if elem.tag == "hopper":
+                # The mentions of a hopper with an invalid id are not clustered.
+                hopper_id = parse_id(elem.get("id"), hopper_prefix)
+                if hopper_id is not None:
+                    hoppers.append((hopper_id, []))
+            continue
+
+        parents.pop()
+
+        if elem.tag == "event_mention":
+            in_hopper = len(parents) > 0 and parents[-1] == "hopper"
+            # In the event nugget mode the mentions are directly under the root.
+            mention_id = parse_id(elem.get("id"), event_mention_prefix) if in_hopper == with_hoppers else None
+            if mention_id is not None:
+                trigger = elem.find("trigger")
+                begin = int(trigger.get("offset"))
+                end = begin + int(trigger.get("length"))
+                text = " ".join((trigger.text or "").split())
+                mentions.append((mention_id, begin, end, text, to_event_type(elem.get("type"), elem.get("subtype")),
+                                 capitalize(elem.get("realis"))))
+                if in_hopper and hopper_id is not None:
+                    hoppers[-1][1].append(mention_id)
+            elem.clear()
+        elif elem.tag in ("hopper", "entity", "filler", "relation"):
+            elem.clear()
+
+    # Following the Java converter, mentions are ordered by their offsets.
+    mentions.sort(key=lambda m: (m[1], m[2]))
+
+    return mentions, hoppers
+
+
+def get_mention_tokens(doc_id, mentions, token_dir):
+    """
+    Map the mentions to the token ids, using the text bound mapping of brat2tbf.
+    :return: Map from mention id to the token ids.
+    """
+    text_bounds = {}
+    for mention_id, begin, end, text, event_type, realis in mentions:
+        text_bounds[mention_id] = (event_type, [(begin, end)], text)
+
+    token_path = os.path.join(token_dir, doc_id + brat2tbf.token_offset_ext)
+    if not os.path.isfile(token_path):
+        logger.error("Cannot find token file for doc [%s] at [%s]." % (doc_id, token_path))
+        return {}
+
+    with open(token_path) as token_file:
+        return brat2tbf.get_text_bound_2_token_mapping(token_file, text_bounds)
+
+
+def convert_file(xml_path, token_dir, with_hoppers, of):
+    basename = os.path.basename(xml_path)
+    logger.debug("Processing file " + basename)
+
+    doc_id = brat2tbf.rchop(brat2tbf.rchop(basename, annotation_ext), ".")
+    mentions, hoppers = read_event_mentions(xml_path, with_hoppers)
+
+    mention_tokens = None
+    if token_dir is not None:
+        mention_tokens = get_mention_tokens(doc_id, mentions, token_dir)
+
+    written = set()
+
+    of.write("%s %s\n" % (outputBodMarker, doc_id))
+    for mention_id, begin, end, text, event_type, realis in mentions:
+        if mention_tokens is not None:
+            if mention_id not in mention_tokens:
+                logger.warning("Cannot find corresponding token for mention [em-%d] - [%s] in document [%s], it will "
+                               "be ignored." % (mention_id, text, doc_id))
+                continue
+            span_str = inner_span_joiner.join(sorted(mention_tokens[mention_id], key=brat2tbf.natural_order))
+        else:
+            span_str = "%d%s%d" % (begin, inner_span_joiner, end)
+
+        written.add(mention_id)
+        of.write("%s\t%s\tE%d\t%s\t%s\t%s\t%s\n" % (engine_id, doc_id, mention_id, span_str, text, event_type, realis))
+
+    for hopper_id, mention_ids in hoppers:
+        cluster = ["E%d" % m for m in mention_ids if m in written]
+        if len(cluster) > 1:
+            of.write("%s%s\t%s%d\t%s\n" % (outputRelationMarker, coreference_relation_name, coreference_cluster_prefix,
+                                           hopper_id, ",".join(cluster)))
+    of.write(outputEodMarker + "\n")
+
+
+if __name__ == "__main__":
+    main()
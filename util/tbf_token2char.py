@@ -4,6 +4,7 @@
 Convert a token based tbf file to character based tbf file.
 """
 import argparse
+import bisect
 import logging
 import os
 import re
@@ -16,6 +17,9 @@ token_suffix = ".tab"
 inner_span_joiner = ","
 inter_span_joiner = ";"
 
+# Token tables already read in this run, a document may appear multiple times in the source.
+token_tables = {}
+
 
 def main():
     parser = argparse.ArgumentParser(description="Convert between token based and character based tbf format.")
@@ -40,30 +44,56 @@ def main():
         for line in source:
             if line.startswith("#BeginOfDocument"):
                 docid = line.split()[1]
-                token_id_2_span = parse_token_file(os.path.join(args.token_dir, docid + token_suffix))
+                token_table = load_token_table(os.path.join(args.token_dir, docid + token_suffix))
                 output.write(line)
                 continue
 
             fields = line.split("\t")
             if len(fields) >= 7:
                 span = fields[3]
-                converted_span = convert_func(span, token_id_2_span)
+                converted_span = convert_func(span, token_table)
                 fields[3] = converted_span
                 output.write("\t".join(fields))
             else:
                 output.write(line)
 
-# Check here? probably not correct.
-def char_2_token(char_span_str, token_id_2_span):
+class TokenTable:
+    """
+    The token spans of one document, also sorted by begin offsets so that the tokens within a character span can be
+    found by binary search.
+    """
+
+    def __init__(self, token_id_2_span):
+        self.token_id_2_span = token_id_2_span
+        self.sorted_tokens = sorted((span[0], span[1], tid) for tid, span in token_id_2_span.iteritems())
+        self.begins = [t[0] for t in self.sorted_tokens]
+
+    def covered_tokens(self, char_span):
+        """
+        Find the tokens covered by the character span, in the order of their offsets.
+        """
+        start = bisect.bisect_left(self.begins, char_span[0])
+        end = bisect.bisect_right(self.begins, char_span[1])
+        return [tid for begin, token_end, tid in self.sorted_tokens[start:end] if
+                covers(char_span, (begin, token_end))]
+
+
+def load_token_table(token_file_path):
+    if token_file_path not in token_tables:
+        token_tables[token_file_path] = TokenTable(parse_token_file(token_file_path))
+    return token_tables[token_file_path]
+
+
+def char_2_token(char_span_str, token_table):
     ids = []
-    for char_span in char_span_str.split(inter_span_joiner):
-        for tid, tspan in token_id_2_span.iteritems():
-            if covers(char_span, tspan):
-                ids.append(tid)
+    for char_span_str in char_span_str.split(inter_span_joiner):
+        char_span = [int(c) for c in char_span_str.split(inner_span_joiner)]
+        ids.extend(token_table.covered_tokens(char_span))
     return inner_span_joiner.join(ids)
 
 
-def token_2_char(token_id_str, token_id_2_span):
+def token_2_char(token_id_str, token_table):
+    token_id_2_span = token_table.token_id_2_span
     convert = lambda text: int(text) if text.isdigit() else text
 
     char_spans = []
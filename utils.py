@@ -5,10 +5,24 @@ import sys
 import os
 import errno
 from collections import defaultdict
-from config import Config, EvalMethod, EvalState
+from config import Config, EvalMethod
 
 logger = logging.getLogger(__name__)
 
+# The exit status when the input fails the validation.
+validation_exit_status = 255
+
+
+class ScoringError(Exception):
+    """
+    Raised when the input cannot be scored. The command line tools terminate on it (see terminate_on_error), while the
+    callers of the API can handle it.
+    """
+
+    def __init__(self, msg, exit_status=1):
+        Exception.__init__(self, msg)
+        self.exit_status = exit_status
+
 
 def terminate_with_error(msg):
     logger.error(msg)
@@ -16,6 +30,17 @@ def terminate_with_error(msg):
     sys.exit(1)
 
 
+def terminate_on_error(error):
+    """
+    Terminate the command line tool on a scoring error, with the exit status of the error.
+    :param error: The ScoringError raised.
+    """
+    if error.exit_status == validation_exit_status:
+        logger.error(error)
+        exit_on_fail()
+    terminate_with_error(error)
+
+
 def natural_order(key):
     """
     Compare order based on the numeric values in key, for example, 't1 < t2'
@@ -37,6 +62,15 @@ def nan_as_zero(v):
     return 0 if math.isnan(v) else v
 
 
+def nan_as_none(v):
+    """
+    Treat NaN as None, used when writing out scores in formats that do not support NaN, such as JSON.
+    :param v:
+    :return:
+    """
+    return None if math.isnan(v) else v
+
+
 def get_or_else(dictionary, key, value):
     if key in dictionary:
         return dictionary[key]
@@ -51,6 +85,14 @@ def get_or_terminate(dictionary, key, error_msg):
         terminate_with_error(error_msg)
 
 
+def get_criteria_name(criteria):
+    """
+    The name of the coreference mapping criteria, such as "mention_type+realis_status".
+    :param criteria: One of Config.possible_coref_mapping.
+    """
+    return "+".join(attribute_name for _, attribute_name in criteria)
+
+
 def check_unique(keys):
     return len(keys) == len(set(keys))
 
@@ -154,17 +196,58 @@ def create_parent_dir(p):
             raise
 
 
+def open_output(path, position=None):
+    """
+    Open an output file for writing, or continue writing at the position, where the content after it is removed. Used
+    to resume the outputs of an evaluation from a checkpoint.
+    :param path: Path of the output file.
+    :param position: The size of the file when the checkpoint is created, a new file is created if None.
+    """
+    if position is None:
+        return open(path, 'w')
+    out = open(path, 'r+')
+    out.truncate(position)
+    out.seek(position)
+    return out
+
+
+def is_pack(path):
+    """
+    Check whether the file is an evaluation pack, from its first line.
+    """
+    with open(path, 'rb') as f:
+        return f.readline().startswith(Config.pack_magic)
+
+
+def get_position(out):
+    """
+    The size of an output file written so far, the file is flushed first.
+    """
+    out.flush()
+    return out.tell()
+
+
 def exit_on_fail():
     logger.error("Validation failed.")
     logger.error("Please fix the warnings/errors.")
-    sys.exit(255)
+    sys.exit(validation_exit_status)
 
 
-def parse_relation_lines(g_relation_lines, remaining_gold_ids):
+def parse_relation_lines(g_relation_lines, remaining_gold_ids, white_listed_types=None):
     # Parse relations.
     g_relations = [parse_relation_line(l) for l in g_relation_lines]
+    return get_relations_by_type(g_relations, remaining_gold_ids, white_listed_types)
 
-    if EvalState.white_listed_types:
+
+def get_relations_by_type(g_relations, remaining_gold_ids, white_listed_types=None):
+    """
+    Separate the parsed relations into the directed relations by type and the coreference clusters.
+    :param g_relations: The relations, each one is (relation name, relation id, mention ids).
+    :param remaining_gold_ids: The mentions that are kept, used to filter the relations with the type white list.
+    :param white_listed_types: The type white list, the relations are only filtered when it is provided.
+    :return: A map from relation name to the directed relations, and the coreference relations.
+    """
+    if white_listed_types:
         g_relations = filter_relations(g_relations, remaining_gold_ids)
 
     gold_relations_by_type = separate_relations(g_relations)
@@ -258,9 +341,8 @@ def parse_relation_line(relation_line):
     parts = relation_line.split("\t")
 
     if not len(parts) == 3:
-        logger.error("Incorrect format of relation line, it should have 3 fields:")
-        logger.error(relation_line)
-        exit_on_fail()
+        raise ScoringError("Incorrect format of relation line, it should have 3 fields:\n%s" % relation_line,
+                           validation_exit_status)
 
     relation_arguments = parts[2].split(",")
 
@@ -268,9 +350,8 @@ def parse_relation_line(relation_line):
         if parts[0] == "Coreference":
             logger.warn("Singleton clusters are not necessary")
         else:
-            logger.error("A relation should have at least two arguments, maybe incorrect formatted:")
-            logger.error(relation_line)
-            exit_on_fail()
+            raise ScoringError("A relation should have at least two arguments, maybe incorrect formatted:\n%s"
+                               % relation_line, validation_exit_status)
 
     return parts[0], parts[1], relation_arguments
 
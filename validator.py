@@ -13,8 +13,7 @@ import logging
 import os
 import re
 import sys
-from temporal import TemporalEval
-from config import Config, EvalMethod, MutableConfig
+from config import Config, EvalContext, EvalMethod, MutableConfig
 import utils
 
 logger = logging.getLogger()
@@ -39,7 +38,6 @@ attribute_names = ["mention_type", "realis_status"]
 gold_docs = {}
 doc_ids_to_score = []
 all_possible_types = set()
-evaluating_index = 0
 
 token_joiner = ","
 span_separator = ";"
@@ -52,6 +50,28 @@ total_mentions = 0
 unrecognized_relation_count = 0
 total_tokens_not_found = 0
 
+# Check levels, each level also includes the checks of the levels before it.
+check_levels = ["format", "token", "coreference", "script"]
+
+# Settings shared by all document checks, also set in each worker process in parallel mode.
+validation_settings = {}
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Count the number of errors logged, so that the validation can stop early.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+error_counter = ErrorCounter()
+
 
 def exit_on_fail():
     logger.error("Validation failed.")
@@ -76,12 +96,26 @@ def main():
     parser.add_argument(
         "-te", "--token_table_extension",
         help="any extension appended after docid of token table files. Default is [%s]" % default_token_file_ext)
+    parser.add_argument(
+        "-gp", "--gold_pack",
+        help="An evaluation pack compiled by gold_pack.py in token mode, the token tables are taken from it instead of "
+             "the token files.")
     parser.add_argument(
         "-wc", "--word_count_file",
         help="A word count file that can be used to help validation, such as the character_counts.tsv in LDC2016E64."
     )
     parser.add_argument("-ty", "--type_file",
                         help="If provided, the validator will check whether the type subtype pair is valid.")
+    parser.add_argument(
+        "-cl", "--check_level", choices=check_levels, default=check_levels[-1],
+        help="Checks to perform, each level includes the previous ones: format only, token (token ids in token "
+             "mode), coreference (relations and coreference clusters), script (script graph of the after links). "
+             "Default is [%s]." % check_levels[-1])
+    parser.add_argument(
+        "-me", "--max_errors", type=int,
+        help="Stop the validation after this number of errors is found, by default all documents are validated.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes used to validate documents in parallel, default is 1.")
 
     parser.add_argument(
         "-b", "--debug", help="turn debug mode on", action="store_true")
@@ -93,6 +127,7 @@ def main():
     formatter = logging.Formatter('[%(levelname)s] %(asctime)s : %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+    logger.addHandler(error_counter)
 
     if os.path.isfile(args.system):
         sf = open(args.system)
@@ -139,14 +174,33 @@ def main():
         except ValueError as _:
             logger.error("Should provide two integer with comma in between")
 
+    pack_token_tables = None
+    if args.gold_pack is not None and MutableConfig.eval_mode == EvalMethod.Token:
+        from gold_pack import GoldPack
+        pack = GoldPack.load(args.gold_pack)
+        if not pack.token_based:
+            logger.error("The evaluation pack %s is not token based." % args.gold_pack)
+            exit_on_fail()
+        pack_token_tables = pack.token_ids, pack.invisible_ids
+
     if not read_all_doc(sf):
         exit_on_fail()
 
-    validation_success = True
-    while has_next_doc():
-        if not validate_next(doc_lengths, possible_types, token_dir, token_offset_fields,
-                             args.token_table_extension):
-            validation_success = False
+    settings = {
+        "doc_lengths": doc_lengths,
+        "possible_types": possible_types,
+        "token_dir": token_dir,
+        "token_offset_fields": token_offset_fields,
+        "token_file_ext": args.token_table_extension,
+        "pack_token_tables": pack_token_tables,
+        "check_level": check_levels.index(args.check_level),
+    }
+
+    validation_success = validate_all(settings, args.jobs, args.max_errors)
+
+    if unrecognized_relation_count > 10:
+        logger.error("Too many unrecognized relations : %d" % unrecognized_relation_count)
+        validation_success = False
 
     if not validation_success:
         exit_on_fail()
@@ -261,20 +315,54 @@ def read_docs_with_doc_id(f):
     return all_docs
 
 
-def has_next_doc():
-    return evaluating_index < len(doc_ids_to_score)
+def set_validation_settings(settings):
+    global validation_settings
+    validation_settings = settings
 
 
-def get_next_doc():
-    global gold_docs
-    global evaluating_index
-    if evaluating_index < len(doc_ids_to_score):
-        doc_id = doc_ids_to_score[evaluating_index]
-        evaluating_index += 1
-        return True, gold_docs[doc_id], ([], []), doc_id
+def validate_all(settings, num_jobs, max_errors):
+    """
+    Validate all the documents, sequentially or with a process pool.
+    :param settings: Settings shared by all document checks.
+    :param num_jobs: Number of processes.
+    :param max_errors: Stop after this number of errors, None means no limit.
+    :return: Whether all the validated documents are valid.
+    """
+    global total_mentions
+    global unrecognized_relation_count
+
+    set_validation_settings(settings)
+
+    docs = [(doc_id, gold_docs[doc_id]) for doc_id in doc_ids_to_score]
+
+    pool = None
+    if num_jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(num_jobs, set_validation_settings, (settings,))
+        results = pool.imap(validate_doc, docs)
     else:
-        logger.error("Reaching end of all documents")
-        return False, ([], []), ([], []), "End_Of_Documents"
+        results = (validate_doc(doc) for doc in docs)
+
+    success = True
+    num_errors = 0
+    for doc_success, num_mentions, types, num_unrecognized, doc_errors in results:
+        success = success and doc_success
+        total_mentions += num_mentions
+        all_possible_types.update(types)
+        unrecognized_relation_count += num_unrecognized
+
+        # Errors logged by the workers are not seen by the counter in this process.
+        num_errors += doc_errors if pool is not None else 0
+        if max_errors is not None and num_errors + error_counter.count >= max_errors:
+            logger.error("Stop validation after finding %d errors." % (num_errors + error_counter.count))
+            success = False
+            break
+
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+    return success
 
 
 def parse_token_ids(s, invisible_ids):
@@ -312,10 +400,10 @@ def parse_line(l, invisible_ids):
     min_len = num_attributes + 5
     if len(fields) < min_len:
         logger.error("System line has too few fields:\n ---> %s" % l)
-        exit_on_fail()
+        return None
 
     if MutableConfig.eval_mode == EvalMethod.Token:
-        spans, original_spans = parse_token_ids(fields[3], invisible_ids)
+        spans = parse_token_ids(fields[3], invisible_ids)
         if len(spans) == 0:
             logger.warn("Find mention with only invisible words, will not be mapped to anything")
     else:
@@ -357,13 +445,22 @@ def get_eid_2_character_span(mention_table):
     return event_mention_id_2_span
 
 
-def validate_next(doc_lengths, possible_types, token_dir, token_offset_fields, token_file_ext):
-    global total_mentions
-    global unrecognized_relation_count
+def validate_doc(doc):
+    """
+    Validate one document, this only reads the shared settings so that documents can be checked in parallel.
+    :param doc: The document id and the (mention lines, relation lines) of the document.
+    :return: Whether the document is valid, the number of mentions, the mention types, the number of unrecognized
+    relations and the number of errors found.
+    """
+    doc_id, (mention_lines, relation_lines) = doc
+    errors_before = error_counter.count
 
-    success = True
+    doc_lengths = validation_settings["doc_lengths"]
+    possible_types = validation_settings["possible_types"]
+    check_level = validation_settings["check_level"]
 
-    res, (mention_lines, relation_lines), (_, _), doc_id = get_next_doc()
+    success = True
+    unrecognized_count = 0
 
     max_length = None
     if doc_lengths is not None:
@@ -373,9 +470,19 @@ def validate_next(doc_lengths, possible_types, token_dir, token_offset_fields, t
         else:
             max_length = doc_lengths[doc_id]
 
-    if MutableConfig.eval_mode == EvalMethod.Token:
-        invisible_ids, id2token_map, id2span_map = read_token_ids(token_dir, doc_id, token_file_ext,
-                                                                  token_offset_fields)
+    check_tokens = MutableConfig.eval_mode == EvalMethod.Token and check_level >= check_levels.index("token")
+
+    if check_tokens and validation_settings["pack_token_tables"] is not None:
+        token_ids, pack_invisible_ids = validation_settings["pack_token_tables"]
+        if doc_id not in token_ids:
+            logger.error("Cannot find the token table of doc [%s] in the evaluation pack." % doc_id)
+            success = False
+        invisible_ids = pack_invisible_ids.get(doc_id, set())
+        id2token_map = token_ids.get(doc_id, set())
+    elif check_tokens:
+        invisible_ids, id2token_map, id2span_map = read_token_ids(validation_settings["token_dir"], doc_id,
+                                                                  validation_settings["token_file_ext"],
+                                                                  validation_settings["token_offset_fields"])
     else:
         invisible_ids = set()
         id2token_map = {}
@@ -385,9 +492,14 @@ def validate_next(doc_lengths, possible_types, token_dir, token_offset_fields, t
 
     mention_ids = []
     remaining_gold_ids = set()
+    types = set()
 
     for l in mention_lines:
-        mention_id, spans, attributes = parse_line(l, invisible_ids)
+        parsed = parse_line(l, invisible_ids)
+        if parsed is None:
+            success = False
+            continue
+        mention_id, spans, attributes = parsed
 
         if found_invalid_range(spans, max_length):
             logger.error(
@@ -403,63 +515,56 @@ def validate_next(doc_lengths, possible_types, token_dir, token_offset_fields, t
 
         mention_table.append((spans, attributes, mention_id))
         mention_ids.append(mention_id)
-        all_possible_types.add(attributes[0])
+        types.add(attributes[0])
         remaining_gold_ids.add(mention_id)
 
-    total_mentions += len(mention_table)
-
     if not check_unique(mention_ids):
         logger.error("Duplicated mention id for doc %s" % doc_id)
         success = False
 
-    if MutableConfig.eval_mode == EvalMethod.Token and has_invented_token(id2token_map, mention_table):
+    if check_tokens and has_invented_token(id2token_map, mention_table):
         logger.error("Invented token id was found for doc %s" % doc_id)
         logger.error("Tokens not in tbf not found in token map : %d" % total_tokens_not_found)
         success = False
 
-    clusters = {}
-    cluster_id = 0
-    for l in relation_lines:
-        relation = utils.parse_relation_line(l)
-        if relation[0] == Config.coreference_relation_name:
-            clusters[cluster_id] = set(relation[2])
-            cluster_id += 1
-        elif relation[0] not in Config.all_relations:
-            unrecognized_relation_count += 1
-            logger.warning("Relation [%s] is not recognized, this task only takes: [%s]", relation[0],
-                           ";".join(Config.all_relations))
-
-        if has_invented_mentions(relation[2], set(mention_ids)):
-            logger.error("This relation was found in file %s" % doc_id)
-            success = False
-
-    if unrecognized_relation_count > 10:
-        logger.error("Too many unrecognized relations : %d" % unrecognized_relation_count)
-        success = False
-
-    if transitive_not_resolved(clusters):
-        logger.error("Coreference transitive closure is not resolved! Please resolve before submitting.")
-        logger.error("Problem was found in file %s" % doc_id)
-        success = False
+    if check_level >= check_levels.index("coreference"):
+        clusters = {}
+        cluster_id = 0
+        for l in relation_lines:
+            try:
+                relation = utils.parse_relation_line(l)
+            except utils.ScoringError as e:
+                logger.error(e)
+                exit_on_fail()
+            if relation[0] == Config.coreference_relation_name:
+                clusters[cluster_id] = set(relation[2])
+                cluster_id += 1
+            elif relation[0] not in Config.all_relations:
+                unrecognized_count += 1
+                logger.warning("Relation [%s] is not recognized, this task only takes: [%s]", relation[0],
+                               ";".join(Config.all_relations))
+
+            if has_invented_mentions(relation[2], set(mention_ids)):
+                logger.error("This relation was found in file %s" % doc_id)
+                success = False
 
-    if EvalMethod.Char:
-        event_mention_id_2_span = get_eid_2_character_span(mention_table)
-    else:
-        event_mention_id_2_span = get_eid_2_sorted_token_map(mention_table)
+        if transitive_not_resolved(clusters):
+            logger.error("Coreference transitive closure is not resolved! Please resolve before submitting.")
+            logger.error("Problem was found in file %s" % doc_id)
+            success = False
 
-    # for cluster_id, cluster in clusters.iteritems():
-    #     if invented_mention_check(cluster, event_mention_id_2_span):
-    #         logger.error("Found invented id in clusters at doc [%s]" % doc_id)
-    #         success = False
+    if check_level >= check_levels.index("script"):
+        # The sequencing module is only loaded when the scripts are checked.
+        from temporal import TemporalEval
 
-    directed_relations, corefs = utils.parse_relation_lines(relation_lines, remaining_gold_ids)
+        directed_relations, corefs = utils.parse_relation_lines(relation_lines, remaining_gold_ids)
 
-    seq_eval = TemporalEval([], mention_table, directed_relations, [], {}, corefs, [])
-    if not seq_eval.validate_gold():
-        logger.error("The edges cannot form a valid script graph at doc [%s]." % doc_id)
-        utils.exit_on_fail()
+        seq_eval = TemporalEval(EvalContext(), [], mention_table, directed_relations, [], {}, corefs, [])
+        if not seq_eval.validate_gold():
+            logger.error("The edges cannot form a valid script graph at doc [%s]." % doc_id)
+            success = False
 
-    return success
+    return success, len(mention_table), types, unrecognized_count, error_counter.count - errors_before
 
 
 def canonicalize_string(str):